@@ -7,6 +7,7 @@
 from datasets.imdb import imdb
 import datasets.ds_utils as ds_utils
 from fast_rcnn.config import cfg
+from fast_rcnn.detection_store import ClassDetections
 import os.path as osp
 import sys
 import os
@@ -16,6 +17,7 @@ import scipy.io as sio
 import cPickle
 import json
 import uuid
+import multiprocessing
 # COCO API
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
@@ -50,7 +52,9 @@ class coco(imdb):
                        'use_salt' : True,
                        'cleanup' : True,
                        'crowd_thresh' : 0.7,
-                       'min_size' : 2}
+                       'min_size' : 2,
+                       # processes evaluating the categories (0: one per CPU)
+                       'eval_workers' : 0}
         # name, paths
         self._year = year
         self._image_set = image_set
@@ -100,6 +104,11 @@ class coco(imdb):
         widths = [ann['width'] for ann in anns]
         return widths
 
+    def _get_sizes(self):
+        anns = self._COCO.loadImgs(self._image_index)
+        sizes = [(ann['width'], ann['height']) for ann in anns]
+        return sizes
+
     def image_path_at(self, i):
         """
         Return the absolute path to image i in the image sequence.
@@ -134,13 +143,11 @@ class coco(imdb):
         Creates a roidb from pre-computed proposals of a particular methods.
         """
         top_k = self.config['top_k']
-        cache_file = osp.join(self.cache_path, self.name +
-                              '_{:s}_top{:d}'.format(method, top_k) +
-                              '_roidb.pkl')
+        cache_file = self._roidb_cache_file(
+            self.name + '_{:s}_top{:d}'.format(method, top_k) + '_roidb')
 
-        if osp.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = cPickle.load(fid)
+        roidb = self._load_roidb_cache(cache_file)
+        if roidb is not None:
             print '{:s} {:s} roidb loaded from {:s}'.format(self.name, method,
                                                             cache_file)
             return roidb
@@ -153,8 +160,7 @@ class coco(imdb):
             roidb = _filter_crowd_proposals(roidb, self.config['crowd_thresh'])
         else:
             roidb = self._load_proposals(method, None)
-        with open(cache_file, 'wb') as fid:
-            cPickle.dump(roidb, fid, cPickle.HIGHEST_PROTOCOL)
+        roidb = self._save_roidb_cache(roidb, cache_file)
         print 'wrote {:s} roidb to {:s}'.format(method, cache_file)
         return roidb
 
@@ -210,18 +216,16 @@ class coco(imdb):
         Return the database of ground-truth regions of interest.
         This function loads/saves from/to a cache file to speed up future calls.
         """
-        cache_file = osp.join(self.cache_path, self.name + '_gt_roidb.pkl')
-        if osp.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = cPickle.load(fid)
+        cache_file = self._roidb_cache_file(self.name + '_gt_roidb')
+        roidb = self._load_roidb_cache(cache_file)
+        if roidb is not None:
             print '{} gt roidb loaded from {}'.format(self.name, cache_file)
             return roidb
 
         gt_roidb = [self._load_coco_annotation(index)
                     for index in self._image_index]
 
-        with open(cache_file, 'wb') as fid:
-            cPickle.dump(gt_roidb, fid, cPickle.HIGHEST_PROTOCOL)
+        gt_roidb = self._save_roidb_cache(gt_roidb, cache_file)
         print 'wrote gt roidb to {}'.format(cache_file)
         return gt_roidb
 
@@ -320,12 +324,13 @@ class coco(imdb):
         print '~~~~ Summary metrics ~~~~'
         coco_eval.summarize()
 
-    def _do_detection_eval(self, res_file, output_dir):
+    def _do_detection_eval(self, results, output_dir):
         ann_type = 'bbox'
-        coco_dt = self._COCO.loadRes(res_file)
+        coco_dt = self._COCO.loadRes(results)
         coco_eval = COCOeval(self._COCO, coco_dt)
         coco_eval.params.useSegm = (ann_type == 'segm')
-        coco_eval.evaluate()
+        coco_eval.evaluate(numProcs=self.config['eval_workers'] or
+                           multiprocessing.cpu_count())
         coco_eval.accumulate()
         self._print_detection_eval_metrics(coco_eval)
         eval_file = osp.join(output_dir, 'detection_results.pkl')
@@ -334,28 +339,36 @@ class coco(imdb):
         print 'Wrote COCO eval results to: {}'.format(eval_file)
 
     def _coco_results_one_category(self, boxes, cat_id):
+        """Detections of one category as an N x 7 array of
+        [image_id, x, y, w, h, score, category_id] rows (see COCO.loadRes)."""
+        if isinstance(boxes, ClassDetections):
+            # the detections of a store are already in one array
+            dets = boxes.dets.astype(np.float)
+            rows = np.empty((dets.shape[0], 7))
+            rows[:, 0] = np.asarray(self.image_index)[boxes.image_inds]
+            rows[:, 1:3] = dets[:, 0:2]
+            rows[:, 3:5] = dets[:, 2:4] - dets[:, 0:2] + 1
+            rows[:, 5] = dets[:, -1]
+            rows[:, 6] = cat_id
+            return rows
         results = []
         for im_ind, index in enumerate(self.image_index):
-            dets = boxes[im_ind].astype(np.float)
-            if dets == []:
+            dets = boxes[im_ind]
+            if dets == [] or len(dets) == 0:
                 continue
-            scores = dets[:, -1]
-            xs = dets[:, 0]
-            ys = dets[:, 1]
-            ws = dets[:, 2] - xs + 1
-            hs = dets[:, 3] - ys + 1
-            results.extend(
-              [{'image_id' : index,
-                'category_id' : cat_id,
-                'bbox' : [xs[k], ys[k], ws[k], hs[k]],
-                'score' : scores[k]} for k in xrange(dets.shape[0])])
-        return results
-
-    def _write_coco_results_file(self, all_boxes, res_file):
-        # [{"image_id": 42,
-        #   "category_id": 18,
-        #   "bbox": [258.15,41.29,348.26,243.78],
-        #   "score": 0.236}, ...]
+            dets = dets.astype(np.float)
+            rows = np.empty((dets.shape[0], 7))
+            rows[:, 0] = index
+            rows[:, 1:3] = dets[:, 0:2]
+            rows[:, 3:5] = dets[:, 2:4] - dets[:, 0:2] + 1
+            rows[:, 5] = dets[:, -1]
+            rows[:, 6] = cat_id
+            results.append(rows)
+        if len(results) == 0:
+            return np.zeros((0, 7))
+        return np.vstack(results)
+
+    def _coco_results(self, all_boxes):
         results = []
         for cls_ind, cls in enumerate(self.classes):
             if cls == '__background__':
@@ -363,11 +376,29 @@ class coco(imdb):
             print 'Collecting {} results ({:d}/{:d})'.format(cls, cls_ind,
                                                           self.num_classes - 1)
             coco_cat_id = self._class_to_coco_cat_id[cls]
-            results.extend(self._coco_results_one_category(all_boxes[cls_ind],
+            results.append(self._coco_results_one_category(all_boxes[cls_ind],
                                                            coco_cat_id))
+        return np.vstack(results)
+
+    def _write_coco_results_file(self, results, res_file):
+        # [{"image_id": 42,
+        #   "category_id": 18,
+        #   "bbox": [258.15,41.29,348.26,243.78],
+        #   "score": 0.236}, ...]
+        # streamed one detection at a time rather than built as one list
         print 'Writing results json to {}'.format(res_file)
         with open(res_file, 'w') as fid:
-            json.dump(results, fid)
+            fid.write('[')
+            for i in xrange(0, results.shape[0], 10000):
+                chunk = results[i:i + 10000]
+                fid.write(', '.join(
+                    '{{"image_id": {:d}, "category_id": {:d}, '
+                    '"bbox": [{!r}, {!r}, {!r}, {!r}], "score": {!r}}}'
+                    .format(int(im), int(cat), x, y, w, h, score)
+                    for im, x, y, w, h, score, cat in chunk.tolist()))
+                if i + 10000 < results.shape[0]:
+                    fid.write(', ')
+            fid.write(']')
 
     def evaluate_detections(self, all_boxes, output_dir):
         res_file = osp.join(output_dir, ('detections_' +
@@ -377,13 +408,13 @@ class coco(imdb):
         if self.config['use_salt']:
             res_file += '_{}'.format(str(uuid.uuid4()))
         res_file += '.json'
-        self._write_coco_results_file(all_boxes, res_file)
+        results = self._coco_results(all_boxes)
+        # The results json file is only written if it is kept (no cleanup)
+        if not self.config['cleanup']:
+            self._write_coco_results_file(results, res_file)
         # Only do evaluation on non-test sets
         if self._image_set.find('test') == -1:
-            self._do_detection_eval(res_file, output_dir)
-        # Optionally cleanup results json file
-        if self.config['cleanup']:
-            os.remove(res_file)
+            self._do_detection_eval(results, output_dir)
 
     def competition_mode(self, on):
         if on:
@@ -0,0 +1,257 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Memory-compact roidb: the boxes of all images in flat arrays."""
+
+import collections
+import os
+import numpy as np
+import scipy.sparse
+
+class ColumnarRoidb(object):
+    """A roidb stored as columns instead of a list of per-image dicts.
+
+    The boxes of stored image j are the rows offsets[j]:offsets[j + 1] of the
+    per box columns (boxes, gt_classes, seg_areas and, once prepared for
+    training, max_classes, max_overlaps and bbox_targets) and of the
+    gt_overlaps csr matrix. Per image values (image, width, height) are in
+    image_columns.
+
+    Entry i of the roidb is stored image image_inds[i], horizontally flipped
+    if flip[i]. Flipped entries and filtered roidbs are therefore just index
+    arrays over the same storage, and roidb[i] is a read-only dict-like view
+    (RoidbEntry) that flips the boxes and regression targets when accessed.
+    """
+
+    BOX_FIELDS = ('boxes', 'gt_classes', 'seg_areas',
+                  'max_classes', 'max_overlaps', 'bbox_targets')
+    IMAGE_FIELDS = ('image', 'width', 'height')
+
+    def __init__(self, offsets, columns, gt_overlaps, image_columns,
+                 stored_flipped, image_inds=None, flip=None,
+                 bbox_flip_offsets=None):
+        self.offsets = offsets
+        self.columns = columns
+        self.gt_overlaps = gt_overlaps
+        self.image_columns = image_columns
+        # whether the stored boxes themselves are of a flipped image
+        self.stored_flipped = stored_flipped
+        if image_inds is None:
+            image_inds = np.arange(len(stored_flipped))
+        if flip is None:
+            flip = np.zeros(len(image_inds), dtype=np.bool)
+        self.image_inds = image_inds
+        self.flip = flip
+        # value of the normalized x regression target of a flipped box
+        # is -target + bbox_flip_offsets[class]
+        self.bbox_flip_offsets = bbox_flip_offsets
+
+    @classmethod
+    def from_roidb(cls, roidb):
+        """Pack a list of roidb entries, one stored image per entry."""
+        counts = np.array([entry['boxes'].shape[0] for entry in roidb],
+                          dtype=np.int64)
+        offsets = np.zeros(len(roidb) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        columns = {}
+        for name in cls.BOX_FIELDS:
+            if len(roidb) > 0 and name in roidb[0]:
+                columns[name] = np.concatenate([entry[name]
+                                                for entry in roidb])
+        if 'boxes' in columns:
+            columns['boxes'] = columns['boxes'].reshape(-1, 4)
+
+        # concatenate the csr matrices by hand, scipy.sparse.vstack is slow
+        # for this many blocks
+        mats = [entry['gt_overlaps'].tocsr() for entry in roidb]
+        num_classes = mats[0].shape[1] if mats else 0
+        nnz = np.array([mat.nnz for mat in mats], dtype=np.int64)
+        indptr = np.zeros(offsets[-1] + 1, dtype=np.int64)
+        if len(mats) > 0:
+            bases = np.repeat(np.cumsum(nnz) - nnz, counts)
+            indptr[1:] = np.concatenate(
+                [mat.indptr[1:] for mat in mats]) + bases
+            data = np.concatenate([mat.data for mat in mats])
+            indices = np.concatenate([mat.indices for mat in mats])
+        else:
+            data = np.zeros(0, dtype=np.float32)
+            indices = np.zeros(0, dtype=np.int32)
+        gt_overlaps = scipy.sparse.csr_matrix(
+            (data, indices, indptr), shape=(offsets[-1], num_classes))
+
+        image_columns = {}
+        for name in cls.IMAGE_FIELDS:
+            if len(roidb) > 0 and name in roidb[0]:
+                image_columns[name] = np.array([entry[name]
+                                                for entry in roidb])
+        stored_flipped = np.array([entry['flipped'] for entry in roidb],
+                                  dtype=np.bool)
+        return cls(offsets, columns, gt_overlaps, image_columns,
+                   stored_flipped)
+
+    def __len__(self):
+        return len(self.image_inds)
+
+    def __getitem__(self, i):
+        return RoidbEntry(self, i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield RoidbEntry(self, i)
+
+    def flipped(self, i):
+        """Entry i flipped horizontally."""
+        return RoidbEntry(self, i, flip=True)
+
+    @property
+    def num_stored_images(self):
+        return len(self.stored_flipped)
+
+    @property
+    def num_boxes(self):
+        return self.offsets[-1]
+
+    def box_image_inds(self):
+        """Index of the stored image of every box."""
+        return np.repeat(np.arange(self.num_stored_images),
+                         np.diff(self.offsets))
+
+    def set_image_column(self, name, values):
+        """Set a per image value from the values of every entry."""
+        column = np.zeros(self.num_stored_images,
+                          dtype=np.asarray(values).dtype)
+        column[self.image_inds] = values
+        self.image_columns[name] = column
+
+    def append_flipped(self, widths):
+        """Append a lazily flipped copy of every entry (widths are those of
+        the images of the entries)."""
+        self.set_image_column('width', widths)
+        self.image_inds = np.hstack((self.image_inds, self.image_inds))
+        self.flip = np.hstack((self.flip, np.logical_not(self.flip)))
+
+    def select(self, inds):
+        """A roidb of the entries inds, sharing the storage of this one."""
+        return ColumnarRoidb(self.offsets, dict(self.columns),
+                             self.gt_overlaps, dict(self.image_columns),
+                             self.stored_flipped, self.image_inds[inds],
+                             self.flip[inds], self.bbox_flip_offsets)
+
+    def extend(self, other):
+        """Append the entries of other, like list.extend."""
+        assert sorted(self.columns) == sorted(other.columns) and \
+            sorted(self.image_columns) == sorted(other.image_columns), \
+            'Cannot extend a roidb with one of different fields'
+        assert self.bbox_flip_offsets is None and \
+            other.bbox_flip_offsets is None, \
+            'Extend roidbs before adding bbox regression targets'
+        num_stored = self.num_stored_images
+        for name in self.columns:
+            self.columns[name] = np.concatenate((self.columns[name],
+                                                 other.columns[name]))
+        for name in self.image_columns:
+            self.image_columns[name] = np.concatenate(
+                (self.image_columns[name], other.image_columns[name]))
+        self.gt_overlaps = scipy.sparse.vstack(
+            (self.gt_overlaps, other.gt_overlaps), format='csr')
+        self.offsets = np.hstack((self.offsets[:-1],
+                                  other.offsets + self.offsets[-1]))
+        self.stored_flipped = np.hstack((self.stored_flipped,
+                                         other.stored_flipped))
+        self.image_inds = np.hstack((self.image_inds,
+                                     other.image_inds + num_stored))
+        self.flip = np.hstack((self.flip, other.flip))
+
+    def _arrays(self):
+        arrays = {'offsets': self.offsets,
+                  'stored_flipped': self.stored_flipped,
+                  'image_inds': self.image_inds,
+                  'flip': self.flip,
+                  'gt_overlaps_data': self.gt_overlaps.data,
+                  'gt_overlaps_indices': self.gt_overlaps.indices,
+                  'gt_overlaps_indptr': self.gt_overlaps.indptr,
+                  'gt_overlaps_shape': np.array(self.gt_overlaps.shape)}
+        for name, column in self.columns.iteritems():
+            arrays['box_' + name] = column
+        for name, column in self.image_columns.iteritems():
+            arrays['image_' + name] = column
+        if self.bbox_flip_offsets is not None:
+            arrays['bbox_flip_offsets'] = self.bbox_flip_offsets
+        return arrays
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            columns = dict((name[4:], data[name]) for name in data.files
+                           if name.startswith('box_'))
+            image_columns = dict((name[6:], data[name]) for name in data.files
+                                 if name.startswith('image_') and
+                                 name != 'image_inds')
+            gt_overlaps = scipy.sparse.csr_matrix(
+                (data['gt_overlaps_data'], data['gt_overlaps_indices'],
+                 data['gt_overlaps_indptr']),
+                shape=tuple(data['gt_overlaps_shape']))
+            bbox_flip_offsets = data['bbox_flip_offsets'] \
+                if 'bbox_flip_offsets' in data.files else None
+            return cls(data['offsets'], columns, gt_overlaps, image_columns,
+                       data['stored_flipped'], data['image_inds'],
+                       data['flip'], bbox_flip_offsets)
+
+    def save(self, filename):
+        # write and rename, so that concurrent readers never see a partial file
+        tmp_file = '{}.{}.tmp.npz'.format(filename, os.getpid())
+        np.savez(tmp_file, **self._arrays())
+        os.rename(tmp_file, filename)
+
+    def nbytes(self):
+        """Memory held by the arrays of this roidb."""
+        return sum(array.nbytes for array in self._arrays().itervalues())
+
+class RoidbEntry(collections.Mapping):
+    """Read-only dict-like view of entry i of a ColumnarRoidb, flipped
+    horizontally if flip."""
+
+    def __init__(self, roidb, i, flip=False):
+        self._roidb = roidb
+        self._image = roidb.image_inds[i]
+        self._flip = roidb.flip[i] != flip
+
+    def __getitem__(self, key):
+        roidb = self._roidb
+        j = self._image
+        if key == 'flipped':
+            return bool(roidb.stored_flipped[j] != self._flip)
+        if key in roidb.image_columns:
+            return roidb.image_columns[key][j]
+        start, stop = roidb.offsets[j], roidb.offsets[j + 1]
+        if key == 'gt_overlaps':
+            return roidb.gt_overlaps[start:stop]
+        if key not in roidb.columns:
+            raise KeyError(key)
+        value = roidb.columns[key][start:stop]
+        if self._flip and key == 'boxes':
+            width = int(roidb.image_columns['width'][j])
+            boxes = value.copy()
+            boxes[:, 0] = width - value[:, 2] - 1
+            boxes[:, 2] = width - value[:, 0] - 1
+            assert (boxes[:, 2] >= boxes[:, 0]).all()
+            return boxes
+        if self._flip and key == 'bbox_targets':
+            targets = value.copy()
+            targets[:, 1] = -value[:, 1]
+            if roidb.bbox_flip_offsets is not None:
+                targets[:, 1] += roidb.bbox_flip_offsets[
+                    value[:, 0].astype(np.int64)]
+            return targets
+        return value
+
+    def __iter__(self):
+        roidb = self._roidb
+        return iter(('flipped', 'gt_overlaps') + tuple(roidb.image_columns) +
+                    tuple(roidb.columns))
+
+    def __len__(self):
+        return 2 + len(self._roidb.image_columns) + len(self._roidb.columns)
@@ -7,11 +7,14 @@
 
 import os
 import os.path as osp
+import cPickle
 import PIL
 from utils.cython_bbox import bbox_overlaps
 import numpy as np
 import scipy.sparse
 from fast_rcnn.config import cfg
+from datasets.columnar_roidb import ColumnarRoidb
+from datasets import proposal_recall
 
 class imdb(object):
     """Image database."""
@@ -24,6 +27,8 @@ class imdb(object):
         self._obj_proposer = 'selective_search'
         self._roidb = None
         self._roidb_handler = self.default_roidb
+        # (width, height) of the images read so far, by path
+        self._image_sizes = {}
         # Use this dict for storing dataset specific config options
         self.config = {}
 
@@ -62,6 +67,7 @@ class imdb(object):
         #   gt_overlaps
         #   gt_classes
         #   flipped
+        # or a ColumnarRoidb holding the same entries (see compact_roidb)
         if self._roidb is not None:
             return self._roidb
         self._roidb = self.roidb_handler()
@@ -81,6 +87,35 @@ class imdb(object):
     def image_path_at(self, i):
         raise NotImplementedError
 
+    def _roidb_cache_file(self, name):
+        """Path of the roidb cache called name: a ColumnarRoidb .npz with
+        cfg.TRAIN.COLUMNAR_ROIDB, which loads without unpickling a dict and
+        a sparse matrix per image, else a pickle of the list of dicts."""
+        ext = '.npz' if cfg.TRAIN.COLUMNAR_ROIDB else '.pkl'
+        return osp.join(self.cache_path, name + ext)
+
+    @staticmethod
+    def _load_roidb_cache(cache_file):
+        """The roidb in cache_file, or None if there is no cache yet."""
+        if not osp.exists(cache_file):
+            return None
+        if cache_file.endswith('.npz'):
+            return ColumnarRoidb.load(cache_file)
+        with open(cache_file, 'rb') as fid:
+            return cPickle.load(fid)
+
+    @staticmethod
+    def _save_roidb_cache(roidb, cache_file):
+        """Write roidb to cache_file and return it as it will be loaded."""
+        if cache_file.endswith('.npz'):
+            if not isinstance(roidb, ColumnarRoidb):
+                roidb = ColumnarRoidb.from_roidb(roidb)
+            roidb.save(cache_file)
+        else:
+            with open(cache_file, 'wb') as fid:
+                cPickle.dump(roidb, fid, cPickle.HIGHEST_PROTOCOL)
+        return roidb
+
     def default_roidb(self):
         raise NotImplementedError
 
@@ -92,16 +127,45 @@ class imdb(object):
         or a numpy array of detection.
 
         all_boxes[class][image] = [] or np.array of shape #dets x 5
+
+        test_net passes a DetectionStore, which is indexed the same way.
         """
         raise NotImplementedError
 
+    def get_evaluator(self):
+        """
+        Return an evaluator that accumulates detections image by image
+        (add_image(i, [all_boxes[class][i] for each class]) and reports the
+        mean_ap() of the images added so far, or None if this image
+        database has no in-memory evaluation.
+        """
+        return None
+
+    def _get_sizes(self):
+      """(width, height) of every image, read once per unique image."""
+      paths = [self.image_path_at(i) for i in xrange(self.num_images)]
+      for path in paths:
+          if path not in self._image_sizes:
+              self._image_sizes[path] = PIL.Image.open(path).size
+      return [self._image_sizes[path] for path in paths]
+
     def _get_widths(self):
-      return [PIL.Image.open(self.image_path_at(i)).size[0]
-              for i in xrange(self.num_images)]
+      return [size[0] for size in self._get_sizes()]
+
+    def compact_roidb(self):
+        """Replace the roidb by a ColumnarRoidb holding the same entries."""
+        if not isinstance(self.roidb, ColumnarRoidb):
+            self._roidb = ColumnarRoidb.from_roidb(self.roidb)
+        return self._roidb
 
     def append_flipped_images(self):
         num_images = self.num_images
         widths = self._get_widths()
+        if isinstance(self.roidb, ColumnarRoidb):
+            # the flipped boxes are computed when the entries are accessed
+            self.roidb.append_flipped(widths)
+            self._image_index = self._image_index * 2
+            return
         for i in xrange(num_images):
             boxes = self.roidb[i]['boxes'].copy()
             oldx1 = boxes[:, 0].copy()
@@ -127,84 +191,38 @@ class imdb(object):
                 'thresholds': vector of IoU overlap thresholds
                 'gt_overlaps': vector of all ground-truth overlaps
         """
-        # Record max overlap value for each gt box
-        # Return vector of overlap values
-        areas = { 'all': 0, 'small': 1, 'medium': 2, 'large': 3,
-                  '96-128': 4, '128-256': 5, '256-512': 6, '512-inf': 7}
-        area_ranges = [ [0**2, 1e5**2],    # all
-                        [0**2, 32**2],     # small
-                        [32**2, 96**2],    # medium
-                        [96**2, 1e5**2],   # large
-                        [96**2, 128**2],   # 96-128
-                        [128**2, 256**2],  # 128-256
-                        [256**2, 512**2],  # 256-512
-                        [512**2, 1e5**2],  # 512-inf
-                      ]
-        assert areas.has_key(area), 'unknown area range: {}'.format(area)
-        area_range = area_ranges[areas[area]]
-        gt_overlaps = np.zeros(0)
-        num_pos = 0
-        for i in xrange(self.num_images):
-            # Checking for max_overlaps == 1 avoids including crowd annotations
-            # (...pretty hacking :/)
-            max_gt_overlaps = self.roidb[i]['gt_overlaps'].toarray().max(axis=1)
-            gt_inds = np.where((self.roidb[i]['gt_classes'] > 0) &
-                               (max_gt_overlaps == 1))[0]
-            gt_boxes = self.roidb[i]['boxes'][gt_inds, :]
-            gt_areas = self.roidb[i]['seg_areas'][gt_inds]
-            valid_gt_inds = np.where((gt_areas >= area_range[0]) &
-                                     (gt_areas <= area_range[1]))[0]
-            gt_boxes = gt_boxes[valid_gt_inds, :]
-            num_pos += len(valid_gt_inds)
-
-            if candidate_boxes is None:
-                # If candidate_boxes is not supplied, the default is to use the
-                # non-ground-truth boxes from this roidb
-                non_gt_inds = np.where(self.roidb[i]['gt_classes'] == 0)[0]
-                boxes = self.roidb[i]['boxes'][non_gt_inds, :]
-            else:
-                boxes = candidate_boxes[i]
-            if boxes.shape[0] == 0:
-                continue
-            if limit is not None and boxes.shape[0] > limit:
-                boxes = boxes[:limit, :]
-
-            overlaps = bbox_overlaps(boxes.astype(np.float),
-                                     gt_boxes.astype(np.float))
-
-            _gt_overlaps = np.zeros((gt_boxes.shape[0]))
-            for j in xrange(gt_boxes.shape[0]):
-                # find which proposal box maximally covers each gt box
-                argmax_overlaps = overlaps.argmax(axis=0)
-                # and get the iou amount of coverage for each gt box
-                max_overlaps = overlaps.max(axis=0)
-                # find which gt box is 'best' covered (i.e. 'best' = most iou)
-                gt_ind = max_overlaps.argmax()
-                gt_ovr = max_overlaps.max()
-                assert(gt_ovr >= 0)
-                # find the proposal box that covers the best covered gt box
-                box_ind = argmax_overlaps[gt_ind]
-                # record the iou coverage of this gt box
-                _gt_overlaps[j] = overlaps[box_ind, gt_ind]
-                assert(_gt_overlaps[j] == gt_ovr)
-                # mark the proposal box and the gt box as used
-                overlaps[box_ind, :] = -1
-                overlaps[:, gt_ind] = -1
-            # append recorded iou coverage level
-            gt_overlaps = np.hstack((gt_overlaps, _gt_overlaps))
-
-        gt_overlaps = np.sort(gt_overlaps)
-        if thresholds is None:
-            step = 0.05
-            thresholds = np.arange(0.5, 0.95 + 1e-5, step)
-        recalls = np.zeros_like(thresholds)
-        # compute recall for each iou threshold
-        for i, t in enumerate(thresholds):
-            recalls[i] = (gt_overlaps >= t).sum() / float(num_pos)
-        # ar = 2 * np.trapz(recalls, thresholds)
-        ar = recalls.mean()
-        return {'ar': ar, 'recalls': recalls, 'thresholds': thresholds,
-                'gt_overlaps': gt_overlaps}
+        return self.evaluate_recalls(candidate_boxes, thresholds,
+                                     [area], [limit])[area, limit]
+
+    def evaluate_recalls(self, candidate_boxes=None, thresholds=None,
+                         areas=('all',), limits=(None,), num_workers=1):
+        """Evaluate the recall of every area range in areas and every limit
+        in limits in one pass, matching the images in num_workers
+        processes.
+
+        Returns:
+            results: dictionary of the evaluate_recall results of each
+                (area, limit)
+        """
+        def images():
+            for i in xrange(self.num_images):
+                entry = self.roidb[i]
+                # Checking for max_overlaps == 1 avoids including crowd
+                # annotations (...pretty hacking :/)
+                gt_inds = np.where(entry['gt_classes'] > 0)[0]
+                gt_inds = gt_inds[proposal_recall.rows_with_overlap_one(
+                    entry['gt_overlaps'], gt_inds)]
+                if candidate_boxes is None:
+                    # If candidate_boxes is not supplied, the default is to
+                    # use the non-ground-truth boxes from this roidb
+                    boxes = entry['boxes'][entry['gt_classes'] == 0, :]
+                else:
+                    boxes = candidate_boxes[i]
+                yield (entry['boxes'][gt_inds, :],
+                       entry['seg_areas'][gt_inds], boxes)
+
+        return proposal_recall.evaluate_recalls(images(), areas, limits,
+                                                thresholds, num_workers)
 
     def create_roidb_from_box_list(self, box_list, gt_roidb):
         assert len(box_list) == self.num_images, \
@@ -238,6 +256,9 @@ class imdb(object):
     @staticmethod
     def merge_roidbs(a, b):
         assert len(a) == len(b)
+        if isinstance(a, ColumnarRoidb):
+            # the entries of a columnar roidb are read-only views
+            a = [dict(entry) for entry in a]
         for i in xrange(len(a)):
             a[i]['boxes'] = np.vstack((a[i]['boxes'], b[i]['boxes']))
             a[i]['gt_classes'] = np.hstack((a[i]['gt_classes'],
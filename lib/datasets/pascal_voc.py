@@ -8,7 +8,6 @@
 import os
 from datasets.imdb import imdb
 import datasets.ds_utils as ds_utils
-import xml.etree.ElementTree as ET
 import numpy as np
 import scipy.sparse
 import scipy.io as sio
@@ -16,7 +15,9 @@ import utils.cython_bbox
 import cPickle
 import subprocess
 import uuid
-from voc_eval import voc_eval
+import multiprocessing
+from voc_eval import voc_eval, VOCEvaluator
+from voc_annotations import load_voc_annotations, get_cachefile
 from fast_rcnn.config import cfg
 
 class pascal_voc(imdb):
@@ -39,6 +40,7 @@ class pascal_voc(imdb):
         # Default to roidb handler
         self._roidb_handler = self.selective_search_roidb
         self._salt = str(uuid.uuid4())
+        self._annotations = None
         self._comp_id = 'comp4'
 
         # PASCAL specific config options
@@ -47,7 +49,9 @@ class pascal_voc(imdb):
                        'use_diff'    : False,
                        'matlab_eval' : False,
                        'rpn_file'    : None,
-                       'min_size'    : 2}
+                       'min_size'    : 2,
+                       # processes evaluating the classes (0: one per CPU)
+                       'eval_workers': 0}
 
         assert os.path.exists(self._devkit_path), \
                 'VOCdevkit path does not exist: {}'.format(self._devkit_path)
@@ -96,17 +100,14 @@ class pascal_voc(imdb):
 
         This function loads/saves from/to a cache file to speed up future calls.
         """
-        cache_file = os.path.join(self.cache_path, self.name + '_gt_roidb.pkl')
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = cPickle.load(fid)
+        cache_file = self._roidb_cache_file(self.name + '_gt_roidb')
+        roidb = self._load_roidb_cache(cache_file)
+        if roidb is not None:
             print '{} gt roidb loaded from {}'.format(self.name, cache_file)
             return roidb
 
-        gt_roidb = [self._load_pascal_annotation(index)
-                    for index in self.image_index]
-        with open(cache_file, 'wb') as fid:
-            cPickle.dump(gt_roidb, fid, cPickle.HIGHEST_PROTOCOL)
+        gt_roidb = self._save_roidb_cache(self._load_pascal_annotations(),
+                                          cache_file)
         print 'wrote gt roidb to {}'.format(cache_file)
 
         return gt_roidb
@@ -118,12 +119,11 @@ class pascal_voc(imdb):
 
         This function loads/saves from/to a cache file to speed up future calls.
         """
-        cache_file = os.path.join(self.cache_path,
-                                  self.name + '_selective_search_roidb.pkl')
+        cache_file = self._roidb_cache_file(
+            self.name + '_selective_search_roidb')
 
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = cPickle.load(fid)
+        roidb = self._load_roidb_cache(cache_file)
+        if roidb is not None:
             print '{} ss roidb loaded from {}'.format(self.name, cache_file)
             return roidb
 
@@ -133,8 +133,7 @@ class pascal_voc(imdb):
             roidb = imdb.merge_roidbs(gt_roidb, ss_roidb)
         else:
             roidb = self._load_selective_search_roidb(None)
-        with open(cache_file, 'wb') as fid:
-            cPickle.dump(roidb, fid, cPickle.HIGHEST_PROTOCOL)
+        roidb = self._save_roidb_cache(roidb, cache_file)
         print 'wrote ss roidb to {}'.format(cache_file)
 
         return roidb
@@ -177,51 +176,55 @@ class pascal_voc(imdb):
 
         return self.create_roidb_from_box_list(box_list, gt_roidb)
 
-    def _load_pascal_annotation(self, index):
+    def _get_annotations(self):
         """
-        Load image and bounding boxes info from XML file in the PASCAL VOC
-        format.
+        Load the annotations of all images of the image set as columnar
+        arrays (see VOCAnnotations), which are cached in a .npz file
+        shared with the evaluation.
         """
-        filename = os.path.join(self._data_path, 'Annotations', index + '.xml')
-        tree = ET.parse(filename)
-        objs = tree.findall('object')
-        if not self.config['use_diff']:
+        if self._annotations is None:
+            cachedir = os.path.join(self._devkit_path, 'annotations_cache')
+            self._annotations = load_voc_annotations(
+                self._get_annopath(), self.image_index,
+                get_cachefile(cachedir, self._image_set))
+        return self._annotations
+
+    def _load_pascal_annotations(self):
+        """
+        Build the ground-truth roidb entries of all images from the
+        annotations of the XML files in the PASCAL VOC format.
+        """
+        annots = self._get_annotations()
+        if self.config['use_diff']:
+            keep = np.ones(annots.num_objects, dtype=np.bool)
+        else:
             # Exclude the samples labeled as difficult
-            non_diff_objs = [
-                obj for obj in objs if int(obj.find('difficult').text) == 0]
-            # if len(non_diff_objs) != len(objs):
-            #     print 'Removed {} difficult objects'.format(
-            #         len(objs) - len(non_diff_objs))
-            objs = non_diff_objs
-        num_objs = len(objs)
-
-        boxes = np.zeros((num_objs, 4), dtype=np.uint16)
-        gt_classes = np.zeros((num_objs), dtype=np.int32)
-        overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
+            keep = ~annots.difficult
+
+        # Make pixel indexes 0-based
+        boxes = annots.boxes - 1
+        gt_classes = np.array([self._class_to_ind[name.lower().strip()]
+                               for name in annots.names],
+                              dtype=np.int32)[annots.name_inds]
         # "Seg" area for pascal is just the box area
-        seg_areas = np.zeros((num_objs), dtype=np.float32)
-
-        # Load object bounding boxes into a data frame.
-        for ix, obj in enumerate(objs):
-            bbox = obj.find('bndbox')
-            # Make pixel indexes 0-based
-            x1 = float(bbox.find('xmin').text) - 1
-            y1 = float(bbox.find('ymin').text) - 1
-            x2 = float(bbox.find('xmax').text) - 1
-            y2 = float(bbox.find('ymax').text) - 1
-            cls = self._class_to_ind[obj.find('name').text.lower().strip()]
-            boxes[ix, :] = [x1, y1, x2, y2]
-            gt_classes[ix] = cls
-            overlaps[ix, cls] = 1.0
-            seg_areas[ix] = (x2 - x1 + 1) * (y2 - y1 + 1)
-
-        overlaps = scipy.sparse.csr_matrix(overlaps)
-
-        return {'boxes' : boxes,
-                'gt_classes': gt_classes,
-                'gt_overlaps' : overlaps,
-                'flipped' : False,
-                'seg_areas' : seg_areas}
+        seg_areas = (boxes[:, 2] - boxes[:, 0] + 1) * \
+                    (boxes[:, 3] - boxes[:, 1] + 1)
+
+        gt_roidb = []
+        for im_boxes, im_classes, im_areas in zip(
+                annots.split(boxes, keep), annots.split(gt_classes, keep),
+                annots.split(seg_areas, keep)):
+            num_objs = len(im_classes)
+            overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
+            overlaps[np.arange(num_objs), im_classes] = 1.0
+            overlaps = scipy.sparse.csr_matrix(overlaps)
+
+            gt_roidb.append({'boxes' : im_boxes.astype(np.uint16),
+                             'gt_classes': im_classes,
+                             'gt_overlaps' : overlaps,
+                             'flipped' : False,
+                             'seg_areas' : im_areas})
+        return gt_roidb
 
     def _get_comp_id(self):
         comp_id = (self._comp_id + '_' + self._salt if self.config['use_salt']
@@ -248,7 +251,7 @@ class pascal_voc(imdb):
             with open(filename, 'wt') as f:
                 for im_ind, index in enumerate(self.image_index):
                     dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
+                    if len(dets) == 0:
                         continue
                     # the VOCdevkit expects 1-based indices
                     for k in xrange(dets.shape[0]):
@@ -257,12 +260,25 @@ class pascal_voc(imdb):
                                        dets[k, 0] + 1, dets[k, 1] + 1,
                                        dets[k, 2] + 1, dets[k, 3] + 1))
 
-    def _do_python_eval(self, output_dir = 'output'):
-        annopath = os.path.join(
+    def _get_annopath(self):
+        return os.path.join(
             self._devkit_path,
             'VOC' + self._year,
             'Annotations',
             '{:s}.xml')
+
+    def _use_07_metric(self):
+        # The PASCAL VOC metric changed in 2010
+        return True if int(self._year) < 2010 else False
+
+    def get_evaluator(self):
+        """Return a VOCEvaluator of this image set."""
+        return VOCEvaluator(self._get_annotations(), self.classes,
+                            ovthresh=0.5, use_07_metric=self._use_07_metric())
+
+    def _do_python_eval(self, output_dir = 'output', all_boxes=None):
+        """Evaluate all_boxes in memory, or the results files if None."""
+        annopath = self._get_annopath()
         imagesetfile = os.path.join(
             self._devkit_path,
             'VOC' + self._year,
@@ -271,18 +287,27 @@ class pascal_voc(imdb):
             self._image_set + '.txt')
         cachedir = os.path.join(self._devkit_path, 'annotations_cache')
         aps = []
-        # The PASCAL VOC metric changed in 2010
-        use_07_metric = True if int(self._year) < 2010 else False
+        use_07_metric = self._use_07_metric()
         print 'VOC07 metric? ' + ('Yes' if use_07_metric else 'No')
         if not os.path.isdir(output_dir):
             os.mkdir(output_dir)
+        if all_boxes is not None:
+            evaluator = self.get_evaluator()
+            num_workers = self.config['eval_workers'] or \
+                multiprocessing.cpu_count()
+            evaluator.add_all_boxes(all_boxes,
+                                    min(num_workers, self.num_classes - 1))
+            results = evaluator.results()
         for i, cls in enumerate(self._classes):
             if cls == '__background__':
                 continue
-            filename = self._get_voc_results_file_template().format(cls)
-            rec, prec, ap = voc_eval(
-                filename, annopath, imagesetfile, cls, cachedir, ovthresh=0.5,
-                use_07_metric=use_07_metric)
+            if all_boxes is not None:
+                rec, prec, ap = results.get(cls, ([], [], 0.))
+            else:
+                filename = self._get_voc_results_file_template().format(cls)
+                rec, prec, ap = voc_eval(
+                    filename, annopath, imagesetfile, cls, cachedir,
+                    ovthresh=0.5, use_07_metric=use_07_metric)
             aps += [ap]
             print('AP for {} = {:.4f}'.format(cls, ap))
             with open(os.path.join(output_dir, cls + '_pr.pkl'), 'w') as f:
@@ -318,11 +343,16 @@ class pascal_voc(imdb):
         status = subprocess.call(cmd, shell=True)
 
     def evaluate_detections(self, all_boxes, output_dir):
-        self._write_voc_results_file(all_boxes)
-        self._do_python_eval(output_dir)
+        # the results files are only needed by the MATLAB code, or as
+        # competition entries
+        write_results = self.config['matlab_eval'] or \
+            not self.config['cleanup']
+        if write_results:
+            self._write_voc_results_file(all_boxes)
+        self._do_python_eval(output_dir, all_boxes)
         if self.config['matlab_eval']:
             self._do_matlab_eval(output_dir)
-        if self.config['cleanup']:
+        if write_results and self.config['cleanup']:
             for cls in self._classes:
                 if cls == '__background__':
                     continue
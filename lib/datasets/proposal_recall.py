@@ -0,0 +1,149 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Proposal recall: greedy matching of proposals to ground-truth boxes."""
+
+import multiprocessing
+import numpy as np
+from utils.cython_bbox import bbox_overlaps
+
+# ground-truth area ranges of imdb.evaluate_recall
+AREA_RANGES = {'all': [0**2, 1e5**2],
+               'small': [0**2, 32**2],
+               'medium': [32**2, 96**2],
+               'large': [96**2, 1e5**2],
+               '96-128': [96**2, 128**2],
+               '128-256': [128**2, 256**2],
+               '256-512': [256**2, 512**2],
+               '512-inf': [512**2, 1e5**2]}
+
+def rows_with_overlap_one(gt_overlaps, rows):
+    """Whether the max over classes of each of the rows of a sparse
+    gt_overlaps matrix is 1, without densifying it (overlaps are <= 1)."""
+    gt_overlaps = gt_overlaps.tocsr()
+    ones = np.zeros(gt_overlaps.nnz + 1, dtype=np.int64)
+    np.cumsum(gt_overlaps.data == 1, out=ones[1:])
+    indptr = gt_overlaps.indptr
+    return ones[indptr[rows + 1]] > ones[indptr[rows]]
+
+def greedy_gt_overlaps(overlaps):
+    """Overlap of every gt box (column of the proposals x gt overlaps) with
+    the proposal the greedy assignment gives it, or 0.
+
+    The greedy assignment repeatedly pairs the remaining proposal and gt
+    box of highest overlap, breaking ties by lowest gt then proposal index.
+    The positive overlaps that can be assigned are ranked that way with one
+    sort. Every pair
+    that ranks first among the remaining pairs of both its proposal and its
+    gt box is one the greedy assignment takes, so each round takes all of
+    them at once; few rounds are needed in practice.
+    """
+    num_boxes, num_gt = overlaps.shape
+    gt_overlaps = np.zeros(num_gt)
+    candidates = overlaps > 0
+    if num_boxes > num_gt > 0:
+        # the other gt boxes take at most num_gt - 1 proposals, so every gt
+        # box gets one of its num_gt highest overlaps
+        kth = np.partition(overlaps, num_boxes - num_gt, axis=0)
+        candidates &= overlaps >= kth[num_boxes - num_gt]
+    rows, cols = np.nonzero(candidates)
+    if len(rows) == 0:
+        return gt_overlaps
+    values = overlaps[rows, cols]
+    order = np.lexsort((rows, cols, -values))
+    rows, cols, values = rows[order], cols[order], values[order]
+    while len(rows) > 0:
+        # the first remaining pair of every proposal and of every gt box
+        _, row_first = np.unique(rows, return_index=True)
+        _, col_first = np.unique(cols, return_index=True)
+        taken = np.intersect1d(row_first, col_first, assume_unique=True)
+        gt_overlaps[cols[taken]] = values[taken]
+        row_taken = np.zeros(num_boxes, dtype=np.bool)
+        row_taken[rows[taken]] = True
+        col_taken = np.zeros(num_gt, dtype=np.bool)
+        col_taken[cols[taken]] = True
+        keep = ~(row_taken[rows] | col_taken[cols])
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+    return gt_overlaps
+
+def _image_gt_overlaps(args):
+    """Greedy gt overlaps of one image for every area range and limit (a
+    pool task); None if the image has no proposals."""
+    gt_boxes, gt_areas, boxes, area_ranges, limits = args
+    if boxes.shape[0] == 0:
+        return None
+    # the overlaps of the most proposals any limit uses, computed once
+    if None not in limits:
+        boxes = boxes[:max(limits), :]
+    overlaps = bbox_overlaps(boxes.astype(np.float),
+                             gt_boxes.astype(np.float))
+    results = []
+    for area_range in area_ranges:
+        valid = (gt_areas >= area_range[0]) & (gt_areas <= area_range[1])
+        area_overlaps = overlaps[:, valid]
+        results.append([greedy_gt_overlaps(area_overlaps[:limit, :])
+                        for limit in limits])
+    return results
+
+def recall_results(gt_overlaps, num_pos, thresholds=None):
+    """The results dict of imdb.evaluate_recall from the greedy overlaps of
+    the gt boxes and the number num_pos of gt boxes."""
+    gt_overlaps = np.sort(gt_overlaps)
+    if thresholds is None:
+        step = 0.05
+        thresholds = np.arange(0.5, 0.95 + 1e-5, step)
+    # number of gt boxes covered at each iou threshold
+    covered = len(gt_overlaps) - np.searchsorted(gt_overlaps, thresholds)
+    recalls = covered / float(num_pos)
+    # ar = 2 * np.trapz(recalls, thresholds)
+    ar = recalls.mean()
+    return {'ar': ar, 'recalls': recalls, 'thresholds': thresholds,
+            'gt_overlaps': gt_overlaps}
+
+def evaluate_recalls(images, areas, limits, thresholds=None, num_workers=1):
+    """Recall of the proposals of images for every area range name in
+    areas and every limit (number of proposals used, None for all) in
+    limits, in one pass over the images.
+
+    images yields (gt_boxes, gt_areas, boxes) per image. They are matched
+    in num_workers processes. Returns {(area, limit): results} with the
+    results dict of imdb.evaluate_recall.
+    """
+    for area in areas:
+        assert area in AREA_RANGES, 'unknown area range: {}'.format(area)
+    area_ranges = [AREA_RANGES[area] for area in areas]
+    num_pos = np.zeros(len(areas), dtype=np.int64)
+    gt_overlaps = [[[] for _ in limits] for _ in areas]
+
+    def tasks():
+        for gt_boxes, gt_areas, boxes in images:
+            for a, area_range in enumerate(area_ranges):
+                num_pos[a] += np.sum((gt_areas >= area_range[0]) &
+                                     (gt_areas <= area_range[1]))
+            yield gt_boxes, gt_areas, boxes, area_ranges, limits
+
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            image_results = list(pool.imap(_image_gt_overlaps, tasks(),
+                                           chunksize=16))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        image_results = [_image_gt_overlaps(task) for task in tasks()]
+
+    for results in image_results:
+        if results is None:
+            continue
+        for a in xrange(len(areas)):
+            for l in xrange(len(limits)):
+                gt_overlaps[a][l].append(results[a][l])
+    return dict(((area, limit),
+                 recall_results(np.hstack([np.zeros(0)] +
+                                          gt_overlaps[a][l]),
+                                num_pos[a], thresholds))
+                for a, area in enumerate(areas)
+                for l, limit in enumerate(limits))
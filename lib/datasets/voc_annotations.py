@@ -0,0 +1,125 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Columnar store of the PASCAL VOC annotations of an image set."""
+
+import xml.etree.ElementTree as ET
+import os
+import numpy as np
+
+class VOCAnnotations(object):
+    """The objects of all images of an image set in flat arrays.
+
+    Objects are stored in image order: the objects of image i are the rows
+    offsets[i]:offsets[i + 1] of boxes (x1, y1, x2, y2 as in the XML files,
+    i.e. 1-based), name_inds (indexes into names, the class names as they
+    appear in the XML files), difficult and truncated. The arrays are saved
+    to and loaded from a single .npz file.
+    """
+
+    FIELDS = ('imagenames', 'offsets', 'boxes', 'names', 'name_inds',
+              'difficult', 'truncated')
+
+    def __init__(self, imagenames, offsets, boxes, names, name_inds,
+                 difficult, truncated):
+        self.imagenames = imagenames
+        self.offsets = offsets
+        self.boxes = boxes
+        self.names = names
+        self.name_inds = name_inds
+        self.difficult = difficult
+        self.truncated = truncated
+
+    @classmethod
+    def from_xml(cls, annopath, imagenames):
+        """Parse the XML file annopath.format(imagename) of every image."""
+        counts = np.zeros(len(imagenames), dtype=np.int64)
+        boxes = []
+        names = []
+        difficult = []
+        truncated = []
+        for i, imagename in enumerate(imagenames):
+            tree = ET.parse(annopath.format(imagename))
+            objs = tree.findall('object')
+            counts[i] = len(objs)
+            for obj in objs:
+                bbox = obj.find('bndbox')
+                boxes.append([float(bbox.find(tag).text)
+                              for tag in ('xmin', 'ymin', 'xmax', 'ymax')])
+                names.append(obj.find('name').text)
+                difficult.append(int(obj.find('difficult').text))
+                truncated.append(int(obj.find('truncated').text))
+            if i % 1000 == 0:
+                print 'Reading annotation for {:d}/{:d}'.format(
+                    i + 1, len(imagenames))
+
+        offsets = np.zeros(len(imagenames) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        unique_names, name_inds = np.unique(np.array(names, dtype=np.str_),
+                                            return_inverse=True)
+        return cls(np.array(imagenames, dtype=np.str_), offsets,
+                   np.array(boxes, dtype=np.float32).reshape(-1, 4),
+                   unique_names, name_inds.astype(np.int32),
+                   np.array(difficult, dtype=np.bool),
+                   np.array(truncated, dtype=np.bool))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(*[data[field] for field in cls.FIELDS])
+
+    def save(self, filename):
+        # write and rename, so that concurrent readers never see a partial file
+        tmp_file = '{}.{}.tmp.npz'.format(filename, os.getpid())
+        np.savez(tmp_file, **dict((field, getattr(self, field))
+                                  for field in self.FIELDS))
+        os.rename(tmp_file, filename)
+
+    @property
+    def num_images(self):
+        return len(self.imagenames)
+
+    @property
+    def num_objects(self):
+        return len(self.boxes)
+
+    def image_inds(self):
+        """Index of the image of every object."""
+        return np.repeat(np.arange(self.num_images), np.diff(self.offsets))
+
+    def class_mask(self, classname):
+        """Whether every object is of class classname."""
+        name_ind = np.where(self.names == classname)[0]
+        if len(name_ind) == 0:
+            return np.zeros(self.num_objects, dtype=np.bool)
+        return self.name_inds == name_ind[0]
+
+    def split(self, values, mask=None):
+        """Split per object values (of the objects in mask) by image."""
+        if mask is None:
+            return np.split(values, self.offsets[1:-1])
+        counts = np.bincount(self.image_inds()[mask],
+                             minlength=self.num_images)
+        return np.split(values[mask], np.cumsum(counts)[:-1])
+
+def load_voc_annotations(annopath, imagenames, cachefile):
+    """Load the annotations of imagenames, parsing the XML files only if
+    cachefile does not exist or holds another image set."""
+    if os.path.isfile(cachefile):
+        annots = VOCAnnotations.load(cachefile)
+        if annots.imagenames.tolist() == list(imagenames):
+            return annots
+        print 'Cached annotations {:s} are of other images'.format(cachefile)
+    annots = VOCAnnotations.from_xml(annopath, imagenames)
+    cachedir = os.path.dirname(cachefile)
+    if cachedir and not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    print 'Saving cached annotations to {:s}'.format(cachefile)
+    annots.save(cachefile)
+    return annots
+
+def get_cachefile(cachedir, image_set):
+    """Cache file of the annotations of image_set (e.g. 'test')."""
+    return os.path.join(cachedir, image_set + '_annots.npz')
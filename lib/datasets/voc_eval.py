@@ -6,8 +6,9 @@
 
 import xml.etree.ElementTree as ET
 import os
-import cPickle
+import multiprocessing
 import numpy as np
+from voc_annotations import load_voc_annotations, get_cachefile
 
 def parse_rec(filename):
     """ Parse a PASCAL VOC xml file """
@@ -61,6 +62,58 @@ def voc_ap(rec, prec, use_07_metric=False):
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 
+def _match_image(BB, BBGT, difficult, ovthresh):
+    """Mark the detections of one image as true or false positives.
+
+    BB holds the detection boxes in decreasing order of confidence. A
+    detection is a true positive if its best overlapping ground truth box
+    overlaps it by more than ovthresh, is not difficult and was not matched
+    by a more confident detection; detections matching difficult boxes are
+    neither.
+    """
+    nd = BB.shape[0]
+    tp = np.zeros(nd)
+    fp = np.ones(nd)
+    if nd == 0 or BBGT.shape[0] == 0:
+        return tp, fp
+
+    # overlaps of all detections (rows) with all ground truth boxes
+    ixmin = np.maximum(BBGT[:, 0], BB[:, 0, np.newaxis])
+    iymin = np.maximum(BBGT[:, 1], BB[:, 1, np.newaxis])
+    ixmax = np.minimum(BBGT[:, 2], BB[:, 2, np.newaxis])
+    iymax = np.minimum(BBGT[:, 3], BB[:, 3, np.newaxis])
+    iw = np.maximum(ixmax - ixmin + 1., 0.)
+    ih = np.maximum(iymax - iymin + 1., 0.)
+    inters = iw * ih
+    uni = ((BB[:, 2, np.newaxis] - BB[:, 0, np.newaxis] + 1.) *
+           (BB[:, 3, np.newaxis] - BB[:, 1, np.newaxis] + 1.) +
+           (BBGT[:, 2] - BBGT[:, 0] + 1.) *
+           (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
+    overlaps = inters / uni
+    jmax = overlaps.argmax(axis=1)
+    ovmax = overlaps[np.arange(nd), jmax]
+
+    matched = ovmax > ovthresh
+    fp[matched & difficult[jmax]] = 0.
+    # the first (most confident) detection of each ground truth box is the
+    # true positive, the others are duplicates
+    cands = np.where(matched & ~difficult[jmax])[0]
+    _, first = np.unique(jmax[cands], return_index=True)
+    tp[cands[first]] = 1.
+    fp[cands[first]] = 0.
+    return tp, fp
+
+def _pr_curve(tp, fp, npos, use_07_metric):
+    """Recall, precision and AP of the tp and fp flags sorted by confidence."""
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    ap = voc_ap(rec, prec, use_07_metric)
+    return rec, prec, ap
+
 def voc_eval(detpath,
              annopath,
              imagesetfile,
@@ -91,46 +144,22 @@ def voc_eval(detpath,
     # assumes detections are in detpath.format(classname)
     # assumes annotations are in annopath.format(imagename)
     # assumes imagesetfile is a text file with each line an image name
-    # cachedir caches the annotations in a pickle file
+    # cachedir caches the annotations in a .npz file per image set
 
-    # first load gt
-    if not os.path.isdir(cachedir):
-        os.mkdir(cachedir)
-    cachefile = os.path.join(cachedir, 'annots.pkl')
     # read list of images
     with open(imagesetfile, 'r') as f:
         lines = f.readlines()
     imagenames = [x.strip() for x in lines]
 
-    if not os.path.isfile(cachefile):
-        # load annots
-        recs = {}
-        for i, imagename in enumerate(imagenames):
-            recs[imagename] = parse_rec(annopath.format(imagename))
-            if i % 100 == 0:
-                print 'Reading annotation for {:d}/{:d}'.format(
-                    i + 1, len(imagenames))
-        # save
-        print 'Saving cached annotations to {:s}'.format(cachefile)
-        with open(cachefile, 'w') as f:
-            cPickle.dump(recs, f)
-    else:
-        # load
-        with open(cachefile, 'r') as f:
-            recs = cPickle.load(f)
+    # first load gt
+    image_set = os.path.splitext(os.path.basename(imagesetfile))[0]
+    annots = load_voc_annotations(annopath, imagenames,
+                                  get_cachefile(cachedir, image_set))
 
     # extract gt objects for this class
-    class_recs = {}
-    npos = 0
-    for imagename in imagenames:
-        R = [obj for obj in recs[imagename] if obj['name'] == classname]
-        bbox = np.array([x['bbox'] for x in R])
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-        det = [False] * len(R)
-        npos = npos + sum(~difficult)
-        class_recs[imagename] = {'bbox': bbox,
-                                 'difficult': difficult,
-                                 'det': det}
+    mask = annots.class_mask(classname)
+    npos = np.sum(~annots.difficult[mask])
+    class_recs = dict(zip(imagenames, _class_gt(annots, mask)))
 
     # read dets
     detfile = detpath.format(classname)
@@ -144,57 +173,133 @@ def voc_eval(detpath,
 
     # sort by confidence
     sorted_ind = np.argsort(-confidence)
-    sorted_scores = np.sort(-confidence)
     BB = BB[sorted_ind, :]
-    image_ids = [image_ids[x] for x in sorted_ind]
+    image_ids = np.array(image_ids)[sorted_ind]
 
-    # go down dets and mark TPs and FPs
+    # go down the dets of each image and mark TPs and FPs
     nd = len(image_ids)
     tp = np.zeros(nd)
     fp = np.zeros(nd)
-    for d in range(nd):
-        R = class_recs[image_ids[d]]
-        bb = BB[d, :].astype(float)
-        ovmax = -np.inf
-        BBGT = R['bbox'].astype(float)
-
-        if BBGT.size > 0:
-            # compute overlaps
-            # intersection
-            ixmin = np.maximum(BBGT[:, 0], bb[0])
-            iymin = np.maximum(BBGT[:, 1], bb[1])
-            ixmax = np.minimum(BBGT[:, 2], bb[2])
-            iymax = np.minimum(BBGT[:, 3], bb[3])
-            iw = np.maximum(ixmax - ixmin + 1., 0.)
-            ih = np.maximum(iymax - iymin + 1., 0.)
-            inters = iw * ih
-
-            # union
-            uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
-                   (BBGT[:, 2] - BBGT[:, 0] + 1.) *
-                   (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
-
-            overlaps = inters / uni
-            ovmax = np.max(overlaps)
-            jmax = np.argmax(overlaps)
-
-        if ovmax > ovthresh:
-            if not R['difficult'][jmax]:
-                if not R['det'][jmax]:
-                    tp[d] = 1.
-                    R['det'][jmax] = 1
-                else:
-                    fp[d] = 1.
-        else:
-            fp[d] = 1.
+    if nd > 0:
+        uniq_ids, image_inds = np.unique(image_ids, return_inverse=True)
+        # positions of the dets of each image, in decreasing confidence
+        order = np.argsort(image_inds, kind='mergesort')
+        splits = np.cumsum(np.bincount(image_inds))[:-1]
+        for imagename, inds in zip(uniq_ids, np.split(order, splits)):
+            BBGT, difficult = class_recs[imagename]
+            tp[inds], fp[inds] = _match_image(BB[inds], BBGT, difficult,
+                                              ovthresh)
 
     # compute precision recall
-    fp = np.cumsum(fp)
-    tp = np.cumsum(tp)
-    rec = tp / float(npos)
-    # avoid divide by zero in case the first detection matches a difficult
-    # ground truth
-    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-    ap = voc_ap(rec, prec, use_07_metric)
+    return _pr_curve(tp, fp, npos, use_07_metric)
 
-    return rec, prec, ap
+def _class_gt(annots, mask):
+    """(boxes, difficult) of the objects in mask of every image."""
+    return zip(annots.split(annots.boxes.astype(np.float), mask),
+               annots.split(annots.difficult, mask))
+
+def _eval_class(args):
+    """Match the detections of one class on all images (a pool task)."""
+    gts, dets_per_image, ovthresh = args
+    return [_match_dets(dets, gt, ovthresh)
+            for gt, dets in zip(gts, dets_per_image)]
+
+def _match_dets(dets, gt, ovthresh):
+    """Confidences and tp, fp flags of the detections (all_boxes) of one
+    image, sorted by decreasing confidence."""
+    if len(dets) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    order = np.argsort(-dets[:, -1], kind='mergesort')
+    # all_boxes has 0-based pixel indexes, the annotations 1-based
+    BB = dets[order, :4].astype(np.float) + 1
+    tp, fp = _match_image(BB, gt[0], gt[1], ovthresh)
+    return dets[order, -1].astype(np.float), tp, fp
+
+class VOCEvaluator(object):
+    """In-memory PASCAL VOC evaluation of the all_boxes of test_net.
+
+    Detections are matched to the ground truth image by image, as they are
+    added with add_image (e.g. while test_net is still running) or all at
+    once with add_all_boxes, which evaluates the classes in a process pool.
+    results() then computes recall, precision and AP over the images added
+    so far. Detections are not rounded as in the results files and equal
+    scores may be ordered differently, so APs can differ slightly from
+    voc_eval.
+    """
+
+    def __init__(self, annots, classes, ovthresh=0.5, use_07_metric=False):
+        """annots are the VOCAnnotations of the image set, classes lists the
+        class names in all_boxes order ('__background__' first).
+        """
+        self._classes = classes
+        self._ovthresh = ovthresh
+        self._use_07_metric = use_07_metric
+        # gt[cls_ind][im_ind] = (boxes, difficult)
+        self._gt = [None] + [_class_gt(annots, annots.class_mask(cls))
+                             for cls in classes[1:]]
+        self._added = np.zeros(annots.num_images, dtype=np.bool)
+        self._matches = [[] for _ in classes]
+        self._npos = np.zeros(len(classes), dtype=np.int)
+
+    @property
+    def num_images(self):
+        """Number of images added so far."""
+        return int(self._added.sum())
+
+    def _add_matches(self, cls_ind, im_ind, match):
+        self._matches[cls_ind].append(match)
+        self._npos[cls_ind] += np.sum(~self._gt[cls_ind][im_ind][1])
+
+    def add_image(self, im_ind, dets):
+        """Add the detections of image im_ind; dets[cls_ind] is an N x 5
+        array (or []) of (x1, y1, x2, y2, score) as in all_boxes."""
+        assert not self._added[im_ind], \
+            'Image {} was already added'.format(im_ind)
+        self._added[im_ind] = True
+        for cls_ind in xrange(1, len(self._classes)):
+            self._add_matches(cls_ind, im_ind, _match_dets(
+                dets[cls_ind], self._gt[cls_ind][im_ind], self._ovthresh))
+
+    def add_all_boxes(self, all_boxes, num_workers=1):
+        """Add the detections of every image, evaluating the classes in
+        num_workers processes."""
+        assert not self._added.any(), 'Images were already added'
+        self._added[:] = True
+        tasks = [(self._gt[cls_ind], all_boxes[cls_ind], self._ovthresh)
+                 for cls_ind in xrange(1, len(self._classes))]
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                matches = pool.map(_eval_class, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            matches = map(_eval_class, tasks)
+        for cls_ind, class_matches in enumerate(matches, 1):
+            for im_ind, match in enumerate(class_matches):
+                self._add_matches(cls_ind, im_ind, match)
+
+    def results(self):
+        """Return {classname: (rec, prec, ap)} over the images added so far.
+
+        Classes without (non difficult) ground truth yet are left out.
+        """
+        results = {}
+        for cls_ind in xrange(1, len(self._classes)):
+            if self._npos[cls_ind] == 0:
+                continue
+            scores, tp, fp = [np.concatenate(x)
+                              for x in zip(*self._matches[cls_ind])]
+            order = np.argsort(-scores, kind='mergesort')
+            results[self._classes[cls_ind]] = _pr_curve(
+                tp[order], fp[order], self._npos[cls_ind],
+                self._use_07_metric)
+        return results
+
+    def mean_ap(self):
+        """Mean AP over the classes with ground truth so far."""
+        results = self.results()
+        if not results:
+            return 0.
+        return np.mean([ap for _, _, ap in results.itervalues()])
@@ -60,9 +60,15 @@ __C.TRAIN.FG_THRESH = 0.5
 __C.TRAIN.BG_THRESH_HI = 0.5
 __C.TRAIN.BG_THRESH_LO = 0.1
 
-# Use horizontally-flipped images during training?
+# Use horizontally-flipped images during training? (flipped by the data layer
+# when it samples the entries)
 __C.TRAIN.USE_FLIPPED = True
 
+# Keep the training roidb in flat arrays (datasets.columnar_roidb) instead of
+# a list of dicts; flipped entries then share the boxes of the originals. The
+# roidb caches of the datasets are then .npz files of these arrays
+__C.TRAIN.COLUMNAR_ROIDB = False
+
 # Train bounding-box regressors
 __C.TRAIN.BBOX_REG = True
 
@@ -147,6 +153,14 @@ __C.TEST.MAX_SIZE = 1000
 # IoU >= this threshold)
 __C.TEST.NMS = 0.3
 
+# NMS method used on the detections: 'greedy', 'soft_linear' or
+# 'soft_gaussian' (Soft-NMS) or 'weighted' (greedy NMS that averages each
+# kept box with the boxes it suppresses; replaces BBOX_VOTE)
+__C.TEST.NMS_METHOD = 'greedy'
+# Soft-NMS gaussian parameter and minimum decayed score
+__C.TEST.SOFT_NMS_SIGMA = 0.5
+__C.TEST.SOFT_NMS_MIN_SCORE = 0.001
+
 # Experimental: treat the (K+1) units in the cls_score layer as linear
 # predictors (trained, eg, with one-vs-rest SVMs).
 __C.TEST.SVM = False
@@ -157,6 +171,11 @@ __C.TEST.BBOX_REG = True
 # Propose boxes
 __C.TEST.HAS_RPN = False
 
+# Pad input images up to the smallest of these [height, width] shapes that
+# fits them, so that consecutive images share the same input shape and the
+# net keeps its allocations instead of being reshaped (empty: no padding)
+__C.TEST.INPUT_BUCKETS = []
+
 # Test using these proposals
 __C.TEST.PROPOSAL_METHOD = 'selective_search'
 
@@ -169,6 +188,34 @@ __C.TEST.RPN_POST_NMS_TOP_N = 300
 # Proposal height and width both need to be greater than RPN_MIN_SIZE (at orig image scale)
 __C.TEST.RPN_MIN_SIZE = 16
 
+# Run the conv trunk and RPN, then the R-CNN head, as two forward passes, so
+# that the RoIs can be filtered by RPN objectness in between (needs an RPN
+# net whose proposal layer also outputs the scores of the RoIs)
+__C.TEST.SPLIT_FORWARD = False
+# Keep the RoIs with at least this objectness...
+__C.TEST.SPLIT_MIN_SCORE = 0.0
+# ...but at least this many of the highest scoring ones
+__C.TEST.SPLIT_MIN_ROIS = 50
+# Skip the head (no detections) for images whose best RoI has an objectness
+# below this
+__C.TEST.SPLIT_EXIT_SCORE = 0.0
+
+# Report the mAP of the images tested so far every this many images during
+# test_net (0: only at the end; needs an imdb with an in-memory evaluator,
+# e.g. PASCAL VOC)
+__C.TEST.EVAL_INTERVAL = 0
+
+# Checkpoint the detections of test_net every this many images, so that an
+# interrupted run of the same weights and TEST options resumes from the last
+# checkpoint instead of starting over (0: never)
+__C.TEST.CHECKPOINT_INTERVAL = 100
+
+# Also save the raw scores and boxes im_detect returns for every image of
+# test_net (under raw_outputs in its output directory), so that
+# tools/sweep_postproc.py can re-run the post-processing with other options
+# without running the net again
+__C.TEST.CACHE_RAW_OUTPUTS = False
+
 # Apply bounding box voting
 __C.TEST.BBOX_VOTE = False
 
@@ -217,6 +264,26 @@ __C.EXP_DIR = 'default'
 # Use GPU implementation of non-maximum suppression
 __C.USE_GPU_NMS = True
 
+# Use the multi-threaded (OpenMP) implementation of CPU non-maximum suppression
+__C.USE_PARALLEL_CPU_NMS = False
+
+# Number of threads of the OpenMP CPU kernels (0: the OpenMP default, which
+# can be set with OMP_NUM_THREADS)
+__C.CPU_THREADS = 0
+
+# NMS implementation: 'default' (GPU NMS if USE_GPU_NMS, else parallel CPU NMS
+# if USE_PARALLEL_CPU_NMS, else CPU NMS), 'auto' (the fastest implementation
+# for the number of boxes, calibrated once per machine) or one of 'python',
+# 'cpu', 'cpu_parallel' and 'gpu'
+__C.NMS_BACKEND = 'default'
+
+# Cache file of the 'auto' NMS calibration ('' for data/cache/nms_dispatch.json)
+__C.NMS_DISPATCH_CACHE = ''
+
+# Let apply_nms use GPU NMS (by default it runs on the CPU, which is faster
+# on the few detections of one class in one image)
+__C.APPLY_NMS_USE_GPU = False
+
 # Default GPU device id
 __C.GPU_ID = 0
 
@@ -235,9 +302,12 @@ def get_output_dir(imdb, net=None):
         os.makedirs(outdir)
     return outdir
 
-def _merge_a_into_b(a, b):
+def _merge_a_into_b(a, b, any_sequence=False):
     """Merge config dictionary a into config dictionary b, clobbering the
     options in b whenever they are also specified in a.
+
+    With any_sequence, a list may be given for a tuple option and vice versa
+    (it is converted to the type of the option).
     """
     if type(a) is not edict:
         return
@@ -252,6 +322,9 @@ def _merge_a_into_b(a, b):
         if old_type is not type(v):
             if isinstance(b[k], np.ndarray):
                 v = np.array(v, dtype=b[k].dtype)
+            elif any_sequence and isinstance(b[k], (list, tuple)) and \
+                    isinstance(v, (list, tuple)):
+                v = old_type(v)
             else:
                 raise ValueError(('Type mismatch ({} vs. {}) '
                                 'for config key: {}').format(type(b[k]),
@@ -260,13 +333,71 @@ def _merge_a_into_b(a, b):
         # recursively merge dicts
         if type(v) is edict:
             try:
-                _merge_a_into_b(a[k], b[k])
+                _merge_a_into_b(a[k], b[k], any_sequence)
             except:
                 print('Error under config key: {}'.format(k))
                 raise
         else:
             b[k] = v
 
+class FrozenConfig(dict):
+    """An immutable snapshot of a config, accessed like cfg.
+
+    Nested dicts are frozen as well, lists become tuples and arrays are
+    read-only copies, so a FrozenConfig can be shared between threads and
+    detectors without one of them changing the options of another.
+    """
+
+    def __init__(self, d):
+        dict.__init__(self, [(k, _freeze(v)) for k, v in d.iteritems()])
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __reduce__(self):
+        return (FrozenConfig, (dict(self),))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('FrozenConfig is immutable')
+
+    __setattr__ = __delattr__ = __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+def _freeze(v):
+    if isinstance(v, dict):
+        return FrozenConfig(v)
+    if isinstance(v, (list, tuple)):
+        return tuple(_freeze(x) for x in v)
+    if isinstance(v, np.ndarray):
+        v = v.copy()
+        v.setflags(write=False)
+    return v
+
+def _thaw(v):
+    """Return a mutable deep copy of a (frozen) config."""
+    if isinstance(v, dict):
+        return edict(dict((k, _thaw(x)) for k, x in v.iteritems()))
+    if isinstance(v, np.ndarray):
+        return v.copy()
+    return v
+
+def freeze_cfg(overrides=None, base=None):
+    """Return a FrozenConfig of base (the global cfg by default) with the
+    options in the (nested) overrides dict merged in. Sequence options may
+    be given as lists or tuples, whichever type they have in base (a frozen
+    base has tuples only).
+
+    For example, freeze_cfg({'TEST': {'SCALES': (608,), 'NMS': 0.4}}) or
+    freeze_cfg({'TEST': {'SCALES': [608], 'NMS': 0.4}}).
+    """
+    c = _thaw(base if base is not None else __C)
+    if overrides is not None:
+        _merge_a_into_b(edict(overrides), c, any_sequence=True)
+    return FrozenConfig(c)
+
 def cfg_from_file(filename):
     """Load a config file and merge it into the default options."""
     import yaml
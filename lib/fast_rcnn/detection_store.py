@@ -0,0 +1,392 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Columnar stores of the detections and raw outputs of test_net.
+
+A detection store is a directory of .npy files holding the detections of
+all classes and images sorted by class, then image:
+
+    dets.npy     N x 5 float32 (x1, y1, x2, y2, score)
+    images.npy   N int32 image indexes
+    classes.npy  N int32 class indexes
+    offsets.npy  num_classes x (num_images + 1) int64 offsets: the
+                 detections of class j in image i are the rows
+                 offsets[j, i]:offsets[j, i + 1]
+
+A DetectionWriter appends the detections to raw column files in chunks
+while testing runs, and sorts them into place when closed. Given a key, it
+also checkpoints the images added so far, and a writer with the same key
+resumes from the last checkpoint of an interrupted run. A DetectionStore
+maps the files instead of reading them, and store[j][i] is the N x 5 array
+all_boxes[j][i] would hold, so a store can be used wherever all_boxes is.
+
+A raw output store holds the scores and boxes im_detect returned for every
+image, sorted by image, so the post-processing can be re-run without the
+net:
+
+    scores.npy   R x num_classes float32 class scores of the RoIs
+    boxes.npy    R x (4 * num_classes) float32 per-class boxes of the RoIs
+    images.npy   R int32 image indexes
+    offsets.npy  num_images + 1 int64 offsets: the RoIs of image i are the
+                 rows offsets[i]:offsets[i + 1]
+
+It is written by a RawOutputWriter and read by a RawOutputStore the same
+way.
+"""
+
+import os
+import cPickle
+import numpy as np
+
+# names of the stores in the output directory of test_net
+DETECTIONS_DIR = 'detections'
+RAW_OUTPUTS_DIR = 'raw_outputs'
+
+_COLUMNS = (('dets', np.float32, (5,)),
+            ('images', np.int32, ()),
+            ('classes', np.int32, ()))
+
+def _raw_output_columns(num_classes):
+    return (('scores', np.float32, (num_classes,)),
+            ('boxes', np.float32, (4 * num_classes,)),
+            ('images', np.int32, ()))
+
+def _load_column(path, name, num_rows):
+    filename = os.path.join(path, name + '.npy')
+    if num_rows == 0:
+        # empty files cannot be mapped
+        return np.load(filename)
+    # copy-on-write, the NMS kernels want writeable arrays
+    return np.load(filename, mmap_mode='c')
+
+class _ColumnWriter(object):
+    """Append-only, checkpointed writer of the columns of a store.
+
+    If key is not None, the writer checkpoints every checkpoint_interval
+    images (and on checkpoint()). A writer of the same path and key picks up
+    the rows of the last checkpoint, and done tells which images they cover,
+    so they need not be tested again.
+    """
+
+    # rows buffered in memory before they are appended to the files
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, path, columns, num_classes, num_images, key=None,
+                 checkpoint_interval=0):
+        self.path = path
+        self.num_classes = num_classes
+        self.num_images = num_images
+        self.key = key
+        self.checkpoint_interval = checkpoint_interval
+        self._columns = columns
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # images that have been added
+        self.done = np.zeros(num_images, dtype=np.bool)
+        self._num_rows = 0
+        checkpoint = self._load_checkpoint()
+        if checkpoint is None and os.path.exists(self._checkpoint_file()):
+            # the column files are about to be overwritten
+            os.remove(self._checkpoint_file())
+        elif checkpoint is not None:
+            self.done = checkpoint['done']
+            self._num_rows = checkpoint['num_rows']
+            print 'Resuming {} from checkpoint: {:d}/{:d} images done'.format(
+                path, int(self.done.sum()), num_images)
+        self._files = {}
+        for name, dtype, shape in columns:
+            if checkpoint is None:
+                f = open(self._tmp_file(name), 'wb')
+            else:
+                # drop the rows written after the checkpoint
+                f = open(self._tmp_file(name), 'r+b')
+                f.truncate(self._num_rows * np.dtype(dtype).itemsize *
+                           int(np.prod(shape)))
+                f.seek(0, os.SEEK_END)
+            self._files[name] = f
+        self._chunks = dict((name, []) for name, _, _ in columns)
+        self._buffered = 0
+        self._since_checkpoint = 0
+
+    def _tmp_file(self, name):
+        return os.path.join(self.path, name + '.tmp')
+
+    def _checkpoint_file(self):
+        return os.path.join(self.path, 'checkpoint.pkl')
+
+    def _load_checkpoint(self):
+        """The checkpoint of a run with the same key and sizes, or None."""
+        if self.key is None or not os.path.exists(self._checkpoint_file()):
+            return None
+        with open(self._checkpoint_file(), 'rb') as f:
+            checkpoint = cPickle.load(f)
+        if (checkpoint['key'], checkpoint['num_classes'],
+                checkpoint['num_images']) != \
+                (self.key, self.num_classes, self.num_images):
+            print 'Ignoring the checkpoint of a different test run'
+            return None
+        return checkpoint
+
+    def _append(self, num_rows, **rows):
+        """Buffer num_rows rows of every column."""
+        for name, dtype, _ in self._columns:
+            self._chunks[name].append(np.asarray(rows[name], dtype=dtype))
+        self._buffered += num_rows
+        if self._buffered >= self.CHUNK_SIZE:
+            self.flush()
+
+    def _image_added(self, im_ind):
+        self.done[im_ind] = True
+        self._since_checkpoint += 1
+        if self.key is not None and self.checkpoint_interval > 0 and \
+                self._since_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def flush(self):
+        """Append the buffered rows to the files."""
+        for name, _, _ in self._columns:
+            for chunk in self._chunks[name]:
+                chunk.tofile(self._files[name])
+            self._files[name].flush()
+            self._chunks[name] = []
+        self._num_rows += self._buffered
+        self._buffered = 0
+
+    def checkpoint(self):
+        """Flush the buffered rows and record the images added so far."""
+        assert self.key is not None, 'Checkpoints need a key'
+        self.flush()
+        for f in self._files.itervalues():
+            os.fsync(f.fileno())
+        checkpoint = {'key': self.key,
+                      'num_classes': self.num_classes,
+                      'num_images': self.num_images,
+                      'num_rows': self._num_rows,
+                      'done': self.done.copy()}
+        # write and rename, so that an interruption never leaves a partial
+        # checkpoint
+        tmp_file = self._checkpoint_file() + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            cPickle.dump(checkpoint, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self._checkpoint_file())
+        self._since_checkpoint = 0
+
+    def _sort_rows(self, sort_keys, num_keys):
+        """Write the rows sorted by sort_keys(columns), integers in
+        [0, num_keys), to the .npy files and return the first row of every
+        key (and the number of rows)."""
+        self.flush()
+        for f in self._files.itervalues():
+            f.close()
+        num_rows = self._num_rows
+        columns = {}
+        for name, dtype, shape in self._columns:
+            if num_rows > 0:
+                columns[name] = np.memmap(self._tmp_file(name), dtype=dtype,
+                                          mode='r', shape=(num_rows,) + shape)
+            else:
+                columns[name] = np.zeros((0,) + shape, dtype=dtype)
+
+        keys = sort_keys(columns)
+        # stable, so the rows of an image keep their order
+        order = np.argsort(keys, kind='mergesort')
+        starts = np.searchsorted(keys[order], np.arange(num_keys + 1))
+
+        for name, dtype, shape in self._columns:
+            filename = os.path.join(self.path, name + '.npy')
+            if num_rows == 0:
+                # empty files cannot be mapped
+                np.save(filename, columns[name])
+                continue
+            out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                            shape=(num_rows,) + shape)
+            for start in xrange(0, num_rows, self.CHUNK_SIZE):
+                stop = min(start + self.CHUNK_SIZE, num_rows)
+                out[start:stop] = columns[name][order[start:stop]]
+            del out
+        return starts
+
+    def _remove_tmp_files(self):
+        if os.path.exists(self._checkpoint_file()):
+            os.remove(self._checkpoint_file())
+        for name, _, _ in self._columns:
+            os.remove(self._tmp_file(name))
+
+class DetectionWriter(_ColumnWriter):
+    """Append-only writer of a DetectionStore."""
+
+    def __init__(self, path, num_classes, num_images, key=None,
+                 checkpoint_interval=0):
+        _ColumnWriter.__init__(self, path, _COLUMNS, num_classes, num_images,
+                               key=key,
+                               checkpoint_interval=checkpoint_interval)
+
+    def add(self, cls_ind, im_ind, dets):
+        """Add the N x 5 detections of class cls_ind in image im_ind."""
+        if len(dets) == 0:
+            return
+        assert 0 <= im_ind < self.num_images and \
+            0 <= cls_ind < self.num_classes
+        self._append(len(dets), dets=dets,
+                     images=np.repeat(im_ind, len(dets)),
+                     classes=np.repeat(cls_ind, len(dets)))
+
+    def add_image(self, im_ind, cls_dets):
+        """Add the detections of image im_ind, cls_dets[j] being the N x 5
+        array (or []) of class j as in all_boxes. Images already added
+        (e.g. by the run resumed from) are skipped."""
+        if self.done[im_ind]:
+            return
+        for cls_ind, dets in enumerate(cls_dets):
+            self.add(cls_ind, im_ind, dets)
+        self._image_added(im_ind)
+
+    def close(self):
+        """Sort the detections into the store and return it."""
+        num_images = self.num_images
+        starts = self._sort_rows(
+            lambda columns: columns['classes'].astype(np.int64) *
+            num_images + columns['images'], self.num_classes * num_images)
+        offsets = np.empty((self.num_classes, num_images + 1),
+                           dtype=np.int64)
+        for j in xrange(self.num_classes):
+            offsets[j] = starts[j * num_images:(j + 1) * num_images + 1]
+        np.save(os.path.join(self.path, 'offsets.npy'), offsets)
+        self._remove_tmp_files()
+        return DetectionStore(self.path)
+
+class DetectionStore(object):
+    """Read-only, memory mapped detections, indexed like all_boxes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        for name, _, _ in _COLUMNS:
+            setattr(self, name,
+                    _load_column(path, name, self.offsets[-1, -1]))
+
+    def __reduce__(self):
+        # reopen rather than copy the detections into other processes
+        return (DetectionStore, (self.path,))
+
+    @property
+    def num_classes(self):
+        return self.offsets.shape[0]
+
+    @property
+    def num_images(self):
+        return self.offsets.shape[1] - 1
+
+    def __len__(self):
+        return self.num_classes
+
+    def __getitem__(self, cls_ind):
+        if not -self.num_classes <= cls_ind < self.num_classes:
+            raise IndexError(cls_ind)
+        return ClassDetections(self, cls_ind % self.num_classes)
+
+    def __iter__(self):
+        for cls_ind in xrange(self.num_classes):
+            yield ClassDetections(self, cls_ind)
+
+class ClassDetections(object):
+    """The detections of one class of a DetectionStore, indexed by image
+    like all_boxes[cls_ind]."""
+
+    def __init__(self, store, cls_ind):
+        self._store = store
+        self._cls_ind = cls_ind
+        self._offsets = store.offsets[cls_ind]
+
+    def __reduce__(self):
+        return (ClassDetections, (self._store, self._cls_ind))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, im_ind):
+        if not -len(self) <= im_ind < len(self):
+            raise IndexError(im_ind)
+        im_ind %= len(self)
+        return self._store.dets[self._offsets[im_ind]:
+                                self._offsets[im_ind + 1]]
+
+    def __iter__(self):
+        for im_ind in xrange(len(self)):
+            yield self[im_ind]
+
+    @property
+    def dets(self):
+        """The N x 5 detections of the class in all images."""
+        return self._store.dets[self._offsets[0]:self._offsets[-1]]
+
+    @property
+    def image_inds(self):
+        """The image index of each row of dets."""
+        return self._store.images[self._offsets[0]:self._offsets[-1]]
+
+class RawOutputWriter(_ColumnWriter):
+    """Append-only writer of a RawOutputStore."""
+
+    def __init__(self, path, num_classes, num_images, key=None,
+                 checkpoint_interval=0):
+        _ColumnWriter.__init__(self, path, _raw_output_columns(num_classes),
+                               num_classes, num_images, key=key,
+                               checkpoint_interval=checkpoint_interval)
+
+    def add_image(self, im_ind, scores, boxes):
+        """Add the R x num_classes scores and R x (4 * num_classes) boxes
+        im_detect returned for image im_ind. Images already added are
+        skipped."""
+        if self.done[im_ind]:
+            return
+        assert scores.shape == (boxes.shape[0], self.num_classes) and \
+            boxes.shape[1] == 4 * self.num_classes
+        self._append(len(scores), scores=scores, boxes=boxes,
+                     images=np.repeat(im_ind, len(scores)))
+        self._image_added(im_ind)
+
+    def close(self):
+        """Sort the outputs into the store and return it."""
+        starts = self._sort_rows(lambda columns: columns['images'],
+                                 self.num_images)
+        np.save(os.path.join(self.path, 'offsets.npy'), starts)
+        self._remove_tmp_files()
+        return RawOutputStore(self.path)
+
+class RawOutputStore(object):
+    """Read-only, memory mapped raw outputs; store[i] is the (scores, boxes)
+    im_detect returned for image i."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        for name in ('scores', 'boxes', 'images'):
+            setattr(self, name, _load_column(path, name, self.offsets[-1]))
+
+    def __reduce__(self):
+        return (RawOutputStore, (self.path,))
+
+    @property
+    def num_classes(self):
+        return self.scores.shape[1]
+
+    @property
+    def num_images(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, im_ind):
+        if not -self.num_images <= im_ind < self.num_images:
+            raise IndexError(im_ind)
+        im_ind %= self.num_images
+        start, stop = self.offsets[im_ind], self.offsets[im_ind + 1]
+        return self.scores[start:stop], self.boxes[start:stop]
+
+    def __iter__(self):
+        for im_ind in xrange(self.num_images):
+            yield self[im_ind]
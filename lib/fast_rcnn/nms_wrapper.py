@@ -5,16 +5,301 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
+import bisect
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import numpy as np
 from fast_rcnn.config import cfg
 from nms.gpu_nms import gpu_nms
-from nms.cpu_nms import cpu_nms
+from nms.cpu_nms import cpu_nms, cpu_nms_parallel, cpu_soft_nms, cpu_weighted_nms
+from nms.py_cpu_nms import py_cpu_nms
 
-def nms(dets, thresh, force_cpu=False):
-    """Dispatch to either CPU or GPU NMS implementations."""
+# NMS methods that rescore or refine the detections they keep
+_CPU_NMS_METHODS = {
+    'soft_linear': lambda dets, thresh, sigma, min_score, labels:
+        cpu_soft_nms(dets, thresh, 1, sigma, min_score, labels),
+    'soft_gaussian': lambda dets, thresh, sigma, min_score, labels:
+        cpu_soft_nms(dets, thresh, 2, sigma, min_score, labels),
+    'weighted': lambda dets, thresh, sigma, min_score, labels:
+        cpu_weighted_nms(dets, thresh, labels),
+}
+
+_NMS_BACKENDS = {
+    'python': lambda dets, thresh: py_cpu_nms(dets, thresh),
+    'cpu': lambda dets, thresh: cpu_nms(dets, thresh),
+    'cpu_parallel': lambda dets, thresh:
+        cpu_nms_parallel(dets, thresh, cfg.CPU_THREADS),
+    'gpu': lambda dets, thresh: gpu_nms(dets, thresh, device_id=cfg.GPU_ID),
+}
+
+class NMSDispatcher(object):
+    """Picks the fastest NMS implementation for a number of boxes.
+
+    The implementations are timed once on synthetic detections of each of
+    the calibration sizes; a call then goes to the fastest one at the
+    calibration size nearest (in log scale) to its number of boxes. The
+    timings are cached per host, number of CPUs and CPU_THREADS in a JSON
+    file, so calibration runs once per machine. The dispatcher also counts
+    the calls, boxes and time of every implementation.
+
+    Calibration takes seconds, so callers that time their NMS calls should
+    call prepare() (see prepare_nms) before they start timing.
+    """
+
+    SIZES = (16, 64, 256, 1024, 4096, 16384)
+    # an implementation slower than this (in seconds) is timed once, and not
+    # at larger sizes
+    MAX_CALIBRATION_TIME = 0.25
+
+    def __init__(self, cache_file=None):
+        self._cache_file = cache_file
+        self._timings = None
+        self._timings_key = None
+        self._choices = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache_file(self):
+        if self._cache_file:
+            return self._cache_file
+        if cfg.NMS_DISPATCH_CACHE:
+            return cfg.NMS_DISPATCH_CACHE
+        return os.path.join(cfg.DATA_DIR, 'cache', 'nms_dispatch.json')
+
+    def _key(self):
+        backends = ','.join(self._backends())
+        return '{}:{}cpus:{}threads:{}'.format(
+            socket.gethostname(), multiprocessing.cpu_count(),
+            cfg.CPU_THREADS, backends)
+
+    def _backends(self):
+        backends = ['python', 'cpu', 'cpu_parallel']
+        if cfg.USE_GPU_NMS:
+            backends.append('gpu')
+        return backends
+
+    @staticmethod
+    def _synthetic_dets(num_boxes):
+        """Clustered boxes sorted by score, like RPN proposals."""
+        rng = np.random.RandomState(cfg.RNG_SEED)
+        centers = rng.rand(num_boxes // 20 + 1, 2) * 1000
+        xy = centers[rng.randint(0, len(centers), num_boxes)] + \
+            rng.randn(num_boxes, 2) * 16
+        wh = rng.rand(num_boxes, 2) * 200 + 16
+        scores = np.sort(rng.rand(num_boxes))[::-1]
+        return np.hstack((xy, xy + wh, scores[:, np.newaxis])) \
+            .astype(np.float32)
+
+    def calibrate(self, thresh=0.7, iters=3):
+        """Time every implementation at each calibration size and cache it."""
+        backends = self._backends()
+        timings = dict((name, []) for name in backends)
+        for num_boxes in self.SIZES:
+            dets = self._synthetic_dets(num_boxes)
+            for name in backends:
+                if timings[name] and \
+                        timings[name][-1] > self.MAX_CALIBRATION_TIME:
+                    timings[name].append(float('inf'))
+                    continue
+                func = _NMS_BACKENDS[name]
+                # warm up (e.g. CUDA initialization); a slow first call is
+                # a good enough estimate
+                start = time.time()
+                func(dets, thresh)
+                best = time.time() - start
+                if best > self.MAX_CALIBRATION_TIME:
+                    timings[name].append(best)
+                    continue
+                for _ in xrange(iters):
+                    start = time.time()
+                    func(dets, thresh)
+                    best = min(best, time.time() - start)
+                timings[name].append(best)
+        self._set_timings(timings)
+        self._save(timings)
+        return timings
+
+    def _set_timings(self, timings):
+        with self._lock:
+            self._timings = timings
+            self._timings_key = self._key()
+            self._choices = {}
+
+    def prepare(self):
+        """Load the cached timings of this machine and config, or calibrate
+        them if there are none."""
+        if self._timings is None or self._timings_key != self._key():
+            timings = self._load()
+            if timings is None:
+                self.calibrate()
+            else:
+                self._set_timings(timings)
+        return self._timings
+
+    @property
+    def timings(self):
+        """Calibrated seconds per call of each implementation and size."""
+        return self.prepare()
+
+    def _load(self):
+        if not os.path.exists(self.cache_file):
+            return None
+        with open(self.cache_file) as f:
+            entries = json.load(f)
+        entry = entries.get(self._key())
+        if entry is None or entry['sizes'] != list(self.SIZES):
+            return None
+        # json stores the pruned timings as null
+        return dict((str(name), [float('inf') if t is None else t for t in times])
+                    for name, times in entry['timings'].iteritems())
+
+    def _save(self, timings):
+        entries = {}
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        else:
+            cache_dir = os.path.dirname(self.cache_file)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+        entries[self._key()] = {
+            'sizes': list(self.SIZES),
+            'timings': dict((name, [None if np.isinf(t) else t for t in times])
+                            for name, times in timings.iteritems())}
+        # write and rename, so that concurrent readers never see a partial file
+        tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        os.rename(tmp_file, self.cache_file)
+
+    def backend_for(self, num_boxes, allow_gpu=True):
+        """Return the name of the fastest implementation for num_boxes."""
+        timings = self.timings
+        i = bisect.bisect_left(self.SIZES, num_boxes)
+        if i == len(self.SIZES) or (i > 0 and
+                num_boxes * num_boxes < self.SIZES[i - 1] * self.SIZES[i]):
+            i -= 1
+        choice = self._choices.get((i, allow_gpu))
+        if choice is None:
+            candidates = [name for name in timings
+                          if allow_gpu or name != 'gpu']
+            choice = min(candidates, key=lambda name: timings[name][i])
+            self._choices[(i, allow_gpu)] = choice
+        return choice
+
+    def record(self, backend, num_boxes, seconds):
+        with self._lock:
+            stats = self._stats.setdefault(
+                backend, {'calls': 0, 'boxes': 0, 'time': 0.})
+            stats['calls'] += 1
+            stats['boxes'] += num_boxes
+            stats['time'] += seconds
+
+    def stats(self):
+        """Calls, boxes and total seconds of each implementation."""
+        with self._lock:
+            return dict((name, dict(stats))
+                        for name, stats in self._stats.iteritems())
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+nms_dispatcher = NMSDispatcher()
+
+def prepare_nms():
+    """Calibrate the 'auto' NMS backend (if it is cfg.NMS_BACKEND) now,
+    rather than inside the first, timed, NMS call."""
+    if cfg.NMS_BACKEND == 'auto':
+        nms_dispatcher.prepare()
+
+def nms(dets, thresh, force_cpu=False, backend=None, labels=None):
+    """Dispatch to one of the CPU or GPU NMS implementations.
+
+    backend is one of 'python', 'cpu', 'cpu_parallel' and 'gpu', 'auto' to
+    pick the fastest for the number of boxes (see NMSDispatcher), 'default'
+    to pick from cfg.USE_GPU_NMS and cfg.USE_PARALLEL_CPU_NMS, or None for
+    cfg.NMS_BACKEND. force_cpu rules out GPU NMS.
+
+    With labels (one per box, e.g. the class), a box only suppresses boxes
+    with the same label. Only cpu_nms supports labels, so it is used
+    whatever the backend (counted as 'cpu_labels' in the stats).
+    """
 
     if dets.shape[0] == 0:
         return []
-    if cfg.USE_GPU_NMS and not force_cpu:
-        return gpu_nms(dets, thresh, device_id=cfg.GPU_ID)
-    else:
-        return cpu_nms(dets, thresh)
+    if labels is not None:
+        start = time.time()
+        keep = cpu_nms(dets, thresh, labels)
+        nms_dispatcher.record('cpu_labels', dets.shape[0],
+                              time.time() - start)
+        return keep
+    if backend is None:
+        backend = cfg.NMS_BACKEND
+    if backend == 'auto':
+        backend = nms_dispatcher.backend_for(dets.shape[0],
+                                             allow_gpu=not force_cpu)
+    elif backend == 'default':
+        if cfg.USE_GPU_NMS and not force_cpu:
+            backend = 'gpu'
+        elif cfg.USE_PARALLEL_CPU_NMS:
+            backend = 'cpu_parallel'
+        else:
+            backend = 'cpu'
+    elif backend == 'gpu' and force_cpu:
+        backend = 'cpu'
+    if backend not in _NMS_BACKENDS:
+        raise ValueError('Unknown NMS backend: {}'.format(backend))
+    start = time.time()
+    keep = _NMS_BACKENDS[backend](dets, thresh)
+    nms_dispatcher.record(backend, dets.shape[0], time.time() - start)
+    return keep
+
+def nms_dets(dets, thresh, method='greedy', sigma=0.5, min_score=0.001,
+             force_cpu=False, labels=None):
+    """Apply greedy, soft ('soft_linear', 'soft_gaussian') or weighted NMS.
+
+    Soft-NMS decays the scores of overlapping detections (with the gaussian
+    parameter sigma) and drops those that fall below min_score; weighted NMS
+    replaces each kept box by the score weighted average of the boxes it
+    suppresses. With labels, detections only interact with detections with
+    the same label.
+
+    Returns:
+        keep (ndarray): indices of the kept detections
+        dets (ndarray): the kept (rescored or refined) detections
+    """
+    if method == 'greedy':
+        keep = nms(dets, thresh, force_cpu=force_cpu, labels=labels)
+        return keep, dets[keep, :]
+    if method not in _CPU_NMS_METHODS:
+        raise ValueError('Unknown NMS method: {}'.format(method))
+    if dets.shape[0] == 0:
+        return np.zeros((0,), dtype=np.int), dets
+    return _CPU_NMS_METHODS[method](dets.astype(np.float32, copy=False),
+                                    thresh, sigma, min_score, labels)
+
+def get_nms_func(config=None):
+    """Return the detection NMS function selected by TEST.NMS_METHOD.
+
+    The function is called as nms_func(dets, thresh, labels=None). Greedy
+    NMS returns the kept indices, the other methods return (keep, dets) as
+    nms_dets.
+    """
+    if config is None:
+        config = cfg
+    method = config.TEST.NMS_METHOD
+    if method == 'greedy':
+        return lambda dets, thresh, labels=None: nms(dets, thresh,
+                                                     labels=labels)
+    if method not in _CPU_NMS_METHODS:
+        raise ValueError('Unknown NMS method: {}'.format(method))
+    sigma = config.TEST.SOFT_NMS_SIGMA
+    min_score = config.TEST.SOFT_NMS_MIN_SCORE
+    return lambda dets, thresh, labels=None: nms_dets(
+        dets, thresh, method, sigma, min_score, labels=labels)
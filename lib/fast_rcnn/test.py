@@ -14,52 +14,97 @@ from utils.timer import Timer
 import numpy as np
 import cv2
 import caffe
-from fast_rcnn.nms_wrapper import nms
-import cPickle
-from utils.blob import im_list_to_blob
+from fast_rcnn.nms_wrapper import nms, get_nms_func, nms_dispatcher, \
+    prepare_nms
+from nms.batched_nms import batched_nms
+from fast_rcnn.detection_store import DETECTIONS_DIR, RAW_OUTPUTS_DIR, \
+    DetectionStore, DetectionWriter, RawOutputWriter
+from utils.blob import BlobBuffer, ims_to_blob, resize_im_for_blob
 import os
+import time
+import hashlib
+import multiprocessing
+import threading
+import Queue
 from utils.cython_bbox import bbox_overlaps
 
+# Per-thread state (reusable input blob buffers)
+_thread_state = threading.local()
+
+# Number of net input reshapes done and skipped because the shape was unchanged
+_input_reshapes = {'reshapes': 0, 'skipped': 0}
+
+# Images and RoIs of the split forward passes, and how many skipped the head
+_split_forward = {'images': 0, 'head_skipped': 0, 'rois': 0, 'rois_kept': 0}
 
-def _get_image_blob(im):
-    """Converts an image into a network input.
+
+def _get_resized_ims(im, config):
+    """Rescale an image once per test scale.
 
     Arguments:
         im (ndarray): a color image in BGR order
+        config (dict): detector config (see fast_rcnn.config)
 
     Returns:
-        blob (ndarray): a data blob holding an image pyramid
+        resized_ims (list): the resized images (means not subtracted)
         im_scale_factors (list): list of image scales (relative to im) used
             in the image pyramid
     """
-    im_orig = im.astype(np.float32, copy=True)
-    im_orig -= cfg.PIXEL_MEANS
+    resized_ims = []
+    im_scale_factors = []
 
-    im_shape = im_orig.shape
-    im_size_min = np.min(im_shape[0:2])
-    im_size_max = np.max(im_shape[0:2])
+    for target_size in config.TEST.SCALES:
+        im_resized, im_scale = resize_im_for_blob(im, target_size,
+                                                  config.TEST.MAX_SIZE,
+                                                  config.TEST.SCALE_MULTIPLE_OF)
+        im_scale_factors.append(im_scale)
+        resized_ims.append(im_resized)
 
-    processed_ims = []
-    im_scale_factors = []
+    return resized_ims, im_scale_factors
 
-    for target_size in cfg.TEST.SCALES:
-        im_scale = float(target_size) / float(im_size_min)
-        # Prevent the biggest axis from being more than MAX_SIZE
-        if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
-            im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
+def _get_blob_buffer():
+    """Return the input blob buffer reused by the calling thread."""
+    if not hasattr(_thread_state, 'blob_buffer'):
+        _thread_state.blob_buffer = BlobBuffer()
+    return _thread_state.blob_buffer
 
-        # Make width and height be multiples of a specified number
-        im_scale_x = np.floor(im.shape[1] * im_scale / cfg.TEST.SCALE_MULTIPLE_OF) * cfg.TEST.SCALE_MULTIPLE_OF / im.shape[1]
-        im_scale_y = np.floor(im.shape[0] * im_scale / cfg.TEST.SCALE_MULTIPLE_OF) * cfg.TEST.SCALE_MULTIPLE_OF / im.shape[0]
-        im = cv2.resize(im_orig, None, None, fx=im_scale_x, fy=im_scale_y,
-                        interpolation=cv2.INTER_LINEAR)
-        im_scale_factors.append(np.array([im_scale_x, im_scale_y, im_scale_x, im_scale_y]))
-        processed_ims.append(im)
+def _get_image_blob(im, config, out=None):
+    """Converts an image into a network input.
+
+    Arguments:
+        im (ndarray): a color image in BGR order
+        config (dict): detector config (see fast_rcnn.config)
+        out (BlobBuffer): optional buffer to build the blob in
+
+    Returns:
+        blob (ndarray): a data blob holding an image pyramid
+        im_scale_factors (list): list of image scales (relative to im) used
+            in the image pyramid
+        im_shapes (list): (height, width) of each image in the blob
+    """
+    resized_ims, im_scale_factors = _get_resized_ims(im, config)
+    im_shapes = [resized.shape[0:2] for resized in resized_ims]
 
     # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    blob = ims_to_blob(resized_ims, config.PIXEL_MEANS, out=out,
+                       min_shape=_get_input_bucket(im_shapes, config))
+
+    return blob, np.array(im_scale_factors), im_shapes
 
-    return blob, np.array(im_scale_factors)
+def _get_input_bucket(im_shapes, config):
+    """Return the smallest of TEST.INPUT_BUCKETS that holds all images.
+
+    Padding the data blob to a few canonical shapes lets consecutive images
+    share the input shape, so the net is not reshaped for every image.
+    Returns None if no bucket is large enough.
+    """
+    max_h = max(shape[0] for shape in im_shapes)
+    max_w = max(shape[1] for shape in im_shapes)
+    buckets = [b for b in config.TEST.INPUT_BUCKETS
+               if b[0] >= max_h and b[1] >= max_w]
+    if len(buckets) == 0:
+        return None
+    return min(buckets, key=lambda b: b[0] * b[1])
 
 def _get_rois_blob(im_rois, im_scale_factors):
     """Converts RoIs into network inputs.
@@ -103,109 +148,332 @@ def _project_im_rois(im_rois, scales):
 
     return rois, levels
 
-def _get_blobs(im, rois):
+def _get_blobs(im, rois, config, out=None):
     """Convert an image and RoIs within that image into network inputs."""
     blobs = {'data' : None, 'rois' : None}
-    blobs['data'], im_scale_factors = _get_image_blob(im)
-    if not cfg.TEST.HAS_RPN:
+    blobs['data'], im_scale_factors, im_shapes = _get_image_blob(im, config, out=out)
+    if not config.TEST.HAS_RPN:
         blobs['rois'] = _get_rois_blob(rois, im_scale_factors)
-    return blobs, im_scale_factors
+    return blobs, im_scale_factors, im_shapes
 
-def im_detect(net, im, _t=None, boxes=None):
-    """Detect object classes in an image given object proposals.
+def _get_im_detect_inputs(im, config, boxes=None, out=None):
+    """Prepare the network inputs of im_detect without touching the net.
 
-    Arguments:
-        net (caffe.Net): Fast R-CNN network to use
-        im (ndarray): color image to test (in BGR order)
-        boxes (ndarray): R x 4 array of object proposals or None (for RPN)
+    The data blob is built in out (a BlobBuffer) if given, in which case it
+    is only valid until the buffer is reused.
 
     Returns:
-        scores (ndarray): R x K array of object class scores (K includes
-            background as object category 0)
-        boxes (ndarray): R x (4*K) array of predicted bounding boxes
+        inputs (dict): the network input blobs and what is needed to map the
+            network outputs back to the image
     """
-    if _t:
-        _t['im_preproc'].tic()
-    blobs, im_scales = _get_blobs(im, boxes)
+    blobs, im_scales, im_shapes = _get_blobs(im, boxes, config, out=out)
 
     # When mapping from image ROIs to feature map ROIs, there's some aliasing
     # (some distinct image ROIs get mapped to the same feature ROI).
     # Here, we identify duplicate feature ROIs, so we only compute features
     # on the unique subset.
-    if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
+    inv_index = None
+    if config.DEDUP_BOXES > 0 and not config.TEST.HAS_RPN:
         v = np.array([1, 1e3, 1e6, 1e9, 1e12])
-        hashes = np.round(blobs['rois'] * cfg.DEDUP_BOXES).dot(v)
+        hashes = np.round(blobs['rois'] * config.DEDUP_BOXES).dot(v)
         _, index, inv_index = np.unique(hashes, return_index=True,
                                         return_inverse=True)
         blobs['rois'] = blobs['rois'][index, :]
         boxes = boxes[index, :]
 
-    if cfg.TEST.HAS_RPN:
-        im_blob = blobs['data']
+    if config.TEST.HAS_RPN:
+        # the size of the image itself, which may be smaller than the data
+        # blob if it was padded to an input bucket
         blobs['im_info'] = np.array(
-            [np.hstack((im_blob.shape[2], im_blob.shape[3], im_scales[0]))],
+            [np.hstack((im_shapes[0][0], im_shapes[0][1], im_scales[0]))],
             dtype=np.float32)
 
-    # reshape network inputs
-    net.blobs['data'].reshape(*(blobs['data'].shape))
-    if cfg.TEST.HAS_RPN:
-        net.blobs['im_info'].reshape(*(blobs['im_info'].shape))
+    return {'blobs': blobs, 'im_scales': im_scales, 'im_shape': im.shape,
+            'boxes': boxes, 'inv_index': inv_index}
+
+def _set_net_input(net, name, blob):
+    """Copy blob into a net input, reshaping the input only if its shape
+    changed."""
+    if net.blobs[name].data.shape != blob.shape:
+        net.blobs[name].reshape(*(blob.shape))
+        _input_reshapes['reshapes'] += 1
+    else:
+        _input_reshapes['skipped'] += 1
+    net.blobs[name].data[...] = blob
+
+def _set_layer_cfg(net, config):
+    """Hand config to the Python layers of net that read it at forward time
+    (such as the proposal layer)."""
+    layers = getattr(net, '_cfg_layers', None)
+    if layers is None:
+        layers = [layer for layer in net.layers if hasattr(layer, 'set_cfg')]
+        net._cfg_layers = layers
+    for layer in layers:
+        layer.set_cfg(config)
+
+def get_input_reshape_stats():
+    """Return how many net input reshapes were done and skipped so far."""
+    return dict(_input_reshapes)
+
+def get_split_forward_stats():
+    """Return the numbers of images and RoIs of the split forward passes so
+    far, of images that skipped the head and of RoIs it was run on."""
+    return dict(_split_forward)
+
+def _get_split_layers(net):
+    """Return the name of the proposal layer (the layer with the rois top),
+    its scores top and the name of the first layer of the head."""
+    split = getattr(net, '_split_layers', None)
+    if split is None:
+        names = list(net._layer_names)
+        for i, name in enumerate(names):
+            tops = net.top_names[name]
+            if 'rois' in tops:
+                break
+        else:
+            raise ValueError('The net has no rois blob to split at')
+        assert len(tops) > 1, \
+            'Split forward needs the scores output of the proposal layer'
+        split = (name, tops[1], names[i + 1])
+        net._split_layers = split
+    return split
+
+def _forward_split(net, config):
+    """Run the trunk and RPN, filter the RoIs by objectness, and run the
+    head on the remaining ones unless no RoI is confident enough.
+
+    Returns the output blobs of the head (None if it was skipped) and the
+    RoIs they are of.
+    """
+    proposal_layer, scores_blob, head_start = _get_split_layers(net)
+    net.forward(end=proposal_layer)
+    rois = net.blobs['rois'].data
+    objectness = net.blobs[scores_blob].data.ravel()
+    _split_forward['images'] += 1
+    _split_forward['rois'] += len(rois)
+    if len(rois) == 0 or objectness.max() < config.TEST.SPLIT_EXIT_SCORE:
+        _split_forward['head_skipped'] += 1
+        return None, rois[:0].copy()
+
+    num_kept = max(np.sum(objectness >= config.TEST.SPLIT_MIN_SCORE),
+                   min(config.TEST.SPLIT_MIN_ROIS, len(rois)))
+    if num_kept < len(rois):
+        # the num_kept highest scoring RoIs, in their original order
+        keep = np.sort(np.argsort(-objectness, kind='mergesort')[:num_kept])
+        rois = rois[keep, :]
+        net.blobs['rois'].reshape(*(rois.shape))
+        net.blobs['rois'].data[...] = rois
     else:
-        net.blobs['rois'].reshape(*(blobs['rois'].shape))
+        rois = rois.copy()
+    _split_forward['rois_kept'] += len(rois)
+    # the layers of the head reshape to the RoIs kept as they go
+    return net.forward(start=head_start), rois
 
-    # do forward
-    net.blobs['data'].data[...] = blobs['data']
+def _im_detect_forward(net, blobs, config):
+    """Run the net on prepared input blobs.
+
+    With TEST.SPLIT_FORWARD the RPN RoIs are filtered before the head runs,
+    and images without confident RoIs get no RoIs at all.
+
+    Returns copies of the output blobs needed by _get_im_detect_outputs, so
+    the net can be reused before the outputs are post-processed.
+    """
+    _set_layer_cfg(net, config)
+
+    # reshape network inputs (if needed) and copy the input blobs in
+    _set_net_input(net, 'data', blobs['data'])
     #forward_kwargs = {'data': blobs['data'].astype(np.float32, copy=False)}
-    if cfg.TEST.HAS_RPN:
-        net.blobs['im_info'].data[...] = blobs['im_info']
+    if config.TEST.HAS_RPN:
+        _set_net_input(net, 'im_info', blobs['im_info'])
         #forward_kwargs['im_info'] = blobs['im_info'].astype(np.float32, copy=False)
     else:
-        net.blobs['rois'].data[...] = blobs['rois']
+        _set_net_input(net, 'rois', blobs['rois'])
         #forward_kwargs['rois'] = blobs['rois'].astype(np.float32, copy=False)
-    if _t:
-        _t['im_preproc'].toc()
 
-    if _t:
-        _t['im_net'].tic()
-    blobs_out = net.forward()
-    if _t:
-        _t['im_net'].toc()
+    if config.TEST.HAS_RPN and config.TEST.SPLIT_FORWARD:
+        blobs_out, rois = _forward_split(net, config)
+        if blobs_out is None:
+            # no detections, with the shapes of the outputs of the head
+            outputs = {'rois': rois}
+            score_blob = 'cls_score' if config.TEST.SVM else 'cls_prob'
+            outputs['scores'] = np.zeros(
+                (0,) + net.blobs[score_blob].data.shape[1:], dtype=np.float32)
+            if config.TEST.BBOX_REG:
+                outputs['bbox_pred'] = np.zeros(
+                    (0,) + net.blobs['bbox_pred'].data.shape[1:],
+                    dtype=np.float32)
+            return outputs
+    else:
+        blobs_out = net.forward()
+        rois = net.blobs['rois'].data.copy() if config.TEST.HAS_RPN else None
     #blobs_out = net.forward(**forward_kwargs)
 
-    if _t:
-        _t['im_postproc'].tic()
-    if cfg.TEST.HAS_RPN:
-        assert len(im_scales) == 1, "Only single-image batch implemented"
-        rois = net.blobs['rois'].data.copy()
-        # unscale back to raw image space
-        boxes = rois[:, 1:5] / im_scales[0]
-
-    if cfg.TEST.SVM:
+    outputs = {}
+    if config.TEST.HAS_RPN:
+        outputs['rois'] = rois
+    if config.TEST.SVM:
         # use the raw scores before softmax under the assumption they
         # were trained as linear SVMs
-        scores = net.blobs['cls_score'].data
+        outputs['scores'] = net.blobs['cls_score'].data.copy()
     else:
         # use softmax estimated probabilities
-        scores = blobs_out['cls_prob']
+        outputs['scores'] = blobs_out['cls_prob'].copy()
+    if config.TEST.BBOX_REG:
+        outputs['bbox_pred'] = blobs_out['bbox_pred'].copy()
+    return outputs
+
+def _get_im_detect_outputs(inputs, outputs, config):
+    """Map the network outputs of an image back to scores and boxes."""
+    im_scales = inputs['im_scales']
+    boxes = inputs['boxes']
+    inv_index = inputs['inv_index']
+
+    if config.TEST.HAS_RPN:
+        assert len(im_scales) == 1, "Only single-image batch implemented"
+        rois = outputs['rois']
+        # unscale back to raw image space
+        boxes = rois[:, 1:5] / im_scales[0]
+
+    scores = outputs['scores']
 
-    if cfg.TEST.BBOX_REG:
+    if config.TEST.BBOX_REG:
         # Apply bounding-box regression deltas
-        box_deltas = blobs_out['bbox_pred']
+        box_deltas = outputs['bbox_pred']
         pred_boxes = bbox_transform_inv(boxes, box_deltas)
-        pred_boxes = clip_boxes(pred_boxes, im.shape)
+        pred_boxes = clip_boxes(pred_boxes, inputs['im_shape'])
     else:
         # Simply repeat the boxes, once for each class
         pred_boxes = np.tile(boxes, (1, scores.shape[1]))
 
-    if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
+    if config.DEDUP_BOXES > 0 and not config.TEST.HAS_RPN:
         # Map scores and predictions back to the original set of boxes
         scores = scores[inv_index, :]
         pred_boxes = pred_boxes[inv_index, :]
+
+    return scores, pred_boxes
+
+def im_detect(net, im, _t=None, boxes=None, config=None):
+    """Detect object classes in an image given object proposals.
+
+    Arguments:
+        net (caffe.Net): Fast R-CNN network to use
+        im (ndarray): color image to test (in BGR order)
+        boxes (ndarray): R x 4 array of object proposals or None (for RPN)
+        config (dict): detector config, e.g. from freeze_cfg() (default: the
+            global cfg)
+
+    Returns:
+        scores (ndarray): R x K array of object class scores (K includes
+            background as object category 0)
+        boxes (ndarray): R x (4*K) array of predicted bounding boxes
+    """
+    if config is None:
+        config = cfg
+
+    if _t:
+        _t['im_preproc'].tic()
+    inputs = _get_im_detect_inputs(im, config, boxes, out=_get_blob_buffer())
+    if _t:
+        _t['im_preproc'].toc()
+
+    if _t:
+        _t['im_net'].tic()
+    outputs = _im_detect_forward(net, inputs['blobs'], config)
+    if _t:
+        _t['im_net'].toc()
+
+    if _t:
+        _t['im_postproc'].tic()
+    scores, pred_boxes = _get_im_detect_outputs(inputs, outputs, config)
     if _t:
         _t['im_postproc'].toc()
 
     return scores, pred_boxes
 
+def im_detect_batch(net, ims, _t=None, config=None):
+    """Detect object classes in a batch of images with a single forward pass.
+
+    All images are packed into one zero-padded data blob and the RPN emits
+    proposals for every image, tagged with their batch index. Only a single
+    test scale is supported.
+
+    Arguments:
+        net (caffe.Net): Faster R-CNN network to use (with RPN)
+        ims (list): color images to test (in BGR order)
+        config (dict): detector config (default: the global cfg)
+
+    Returns:
+        scores (list): per-image R_i x K arrays of object class scores (K
+            includes background as object category 0)
+        boxes (list): per-image R_i x (4*K) arrays of predicted bounding boxes
+    """
+    if config is None:
+        config = cfg
+
+    assert config.TEST.HAS_RPN, 'Batched detection requires an RPN'
+    assert len(config.TEST.SCALES) == 1, \
+        'Batched detection supports a single test scale'
+
+    if _t:
+        _t['im_preproc'].tic()
+    processed_ims = []
+    im_scales = []
+    for im in ims:
+        ims_, im_scale_factors = _get_resized_ims(im, config)
+        processed_ims.append(ims_[0])
+        im_scales.append(im_scale_factors[0])
+    data_blob = ims_to_blob(processed_ims, config.PIXEL_MEANS,
+                            out=_get_blob_buffer(),
+                            min_shape=_get_input_bucket(
+                                [p.shape[0:2] for p in processed_ims], config))
+    # each image keeps its own (unpadded) size so that proposals are clipped
+    # to the valid region of its feature map
+    im_info_blob = np.array(
+        [np.hstack((p.shape[0], p.shape[1], s))
+         for p, s in zip(processed_ims, im_scales)], dtype=np.float32)
+
+    _set_layer_cfg(net, config)
+    _set_net_input(net, 'data', data_blob)
+    _set_net_input(net, 'im_info', im_info_blob)
+    if _t:
+        _t['im_preproc'].toc()
+
+    if _t:
+        _t['im_net'].tic()
+    blobs_out = net.forward()
+    if _t:
+        _t['im_net'].toc()
+
+    if _t:
+        _t['im_postproc'].tic()
+    rois = net.blobs['rois'].data.copy()
+    if config.TEST.SVM:
+        all_scores = net.blobs['cls_score'].data
+    else:
+        all_scores = blobs_out['cls_prob']
+    if config.TEST.BBOX_REG:
+        all_deltas = blobs_out['bbox_pred']
+
+    batch_inds = rois[:, 0].astype(np.int)
+    scores_list = []
+    boxes_list = []
+    for i, im in enumerate(ims):
+        inds = np.where(batch_inds == i)[0]
+        # unscale back to raw image space
+        boxes = rois[inds, 1:5] / im_scales[i]
+        scores = all_scores[inds]
+        if config.TEST.BBOX_REG:
+            pred_boxes = bbox_transform_inv(boxes, all_deltas[inds])
+            pred_boxes = clip_boxes(pred_boxes, im.shape)
+        else:
+            pred_boxes = np.tile(boxes, (1, scores.shape[1]))
+        scores_list.append(scores)
+        boxes_list.append(pred_boxes)
+    if _t:
+        _t['im_postproc'].toc()
+
+    return scores_list, boxes_list
+
 def vis_detections(im, class_name, dets, thresh=0.3):
     """Visual debugging of detections."""
     import matplotlib.pyplot as plt
@@ -228,7 +496,12 @@ def vis_detections(im, class_name, dets, thresh=0.3):
 def apply_nms(all_boxes, thresh):
     """Apply non-maximum suppression to all predicted boxes output by the
     test_net method.
+
+    The detections of a DetectionStore are suppressed image by image into a
+    new store next to it, which is returned.
     """
+    if isinstance(all_boxes, DetectionStore):
+        return _apply_nms_to_store(all_boxes, thresh)
     num_classes = len(all_boxes)
     num_images = len(all_boxes[0])
     nms_boxes = [[[] for _ in xrange(num_images)]
@@ -236,125 +509,495 @@ def apply_nms(all_boxes, thresh):
     for cls_ind in xrange(num_classes):
         for im_ind in xrange(num_images):
             dets = all_boxes[cls_ind][im_ind]
-            if dets == []:
+            if len(dets) == 0:
                 continue
             # CPU NMS is much faster than GPU NMS when the number of boxes
             # is relative small (e.g., < 10k)
-            # TODO(rbg): autotune NMS dispatch
-            keep = nms(dets, thresh, force_cpu=True)
+            keep = nms(dets, thresh, force_cpu=not cfg.APPLY_NMS_USE_GPU)
             if len(keep) == 0:
                 continue
             nms_boxes[cls_ind][im_ind] = dets[keep, :].copy()
     return nms_boxes
 
-def bbox_vote(dets_NMS, dets_all, thresh=0.5):
-    dets_voted = np.zeros_like(dets_NMS)   # Empty matrix with the same shape and type
-
-    _overlaps = bbox_overlaps(
-			np.ascontiguousarray(dets_NMS[:, 0:4], dtype=np.float),
-			np.ascontiguousarray(dets_all[:, 0:4], dtype=np.float))
-
-    # for each survived box
-    for i, det in enumerate(dets_NMS):
-        dets_overlapped = dets_all[np.where(_overlaps[i, :] >= thresh)[0]]
-        assert(len(dets_overlapped) > 0)
+def _apply_nms_to_store(store, thresh):
+    writer = DetectionWriter(store.path + '_nms', store.num_classes,
+                             store.num_images)
+    for cls_ind, cls_boxes in enumerate(store):
+        for im_ind, dets in enumerate(cls_boxes):
+            if len(dets) == 0:
+                continue
+            keep = nms(dets, thresh, force_cpu=not cfg.APPLY_NMS_USE_GPU)
+            writer.add(cls_ind, im_ind, dets[keep, :])
+    return writer.close()
+
+def _overlapping_pairs(boxes, query_boxes, thresh):
+    """Find all (i, j) with IoU(boxes[i], query_boxes[j]) >= thresh.
+
+    Equivalent to np.where(bbox_overlaps(boxes, query_boxes) >= thresh), but
+    only the pairs whose x extents intersect are compared: query boxes are
+    sorted by x1 and each box is only matched against the window of query
+    boxes that start at most max_width to its left. batched_nms votes the
+    detections of all classes at once, with the classes offset apart, so
+    the overlap matrix is very sparse.
+    """
+    order = np.argsort(query_boxes[:, 0], kind='mergesort')
+    sorted_x1 = query_boxes[order, 0]
+    max_width = (query_boxes[:, 2] - query_boxes[:, 0]).max()
+    # boxes span x1 to x2 + 1; the windows are padded by another pixel so
+    # that they are never too narrow, the exact IoU is checked below
+    lo = np.searchsorted(sorted_x1, boxes[:, 0] - max_width - 2, side='left')
+    hi = np.searchsorted(sorted_x1, boxes[:, 2] + 2, side='right')
+    counts = np.maximum(hi - lo, 0)
+
+    # expand the windows into candidate pairs
+    inds = np.repeat(np.arange(boxes.shape[0]), counts)
+    starts = np.cumsum(counts) - counts
+    qinds = order[lo[inds] + np.arange(inds.shape[0]) - starts[inds]]
+
+    # same arithmetic as utils.cython_bbox.bbox_overlaps
+    b = boxes[inds]
+    q = query_boxes[qinds]
+    iw = np.minimum(b[:, 2], q[:, 2]) - np.maximum(b[:, 0], q[:, 0]) + 1
+    ih = np.minimum(b[:, 3], q[:, 3]) - np.maximum(b[:, 1], q[:, 1]) + 1
+    valid = (iw > 0) & (ih > 0)
+    inds, qinds, iw, ih, b, q = \
+        inds[valid], qinds[valid], iw[valid], ih[valid], b[valid], q[valid]
+    query_areas = (q[:, 2] - q[:, 0] + 1) * (q[:, 3] - q[:, 1] + 1)
+    ua = (b[:, 2] - b[:, 0] + 1) * (b[:, 3] - b[:, 1] + 1) + \
+        query_areas - iw * ih
+    keep = iw * ih / ua >= thresh
+    return inds[keep], qinds[keep]
+
+def bbox_vote(dets_NMS, dets_all, thresh=0.5, config=None):
+    """Refine the boxes that survived NMS by voting.
+
+    Every box in dets_NMS is replaced by the score weighted average of the
+    boxes in dets_all that overlap it by at least thresh. If
+    TEST.BBOX_VOTE_N_WEIGHTED_SCORE > 1 its score also becomes the average of
+    the top N overlapping scores (missing ones count as
+    TEST.BBOX_VOTE_WEIGHT_EMPTY times the average), but never increases.
+
+    All boxes are voted at once from the list of overlapping pairs.
+    """
+    if config is None:
+        config = cfg
 
-        boxes = dets_overlapped[:, 0:4]
-        scores = dets_overlapped[:, 4]
+    num_dets = dets_NMS.shape[0]
+    dets_voted = np.zeros_like(dets_NMS)   # Empty matrix with the same shape and type
+    if num_dets == 0:
+        return dets_voted
+
+    inds, voters = _overlapping_pairs(
+        np.ascontiguousarray(dets_NMS[:, 0:4], dtype=np.float),
+        np.ascontiguousarray(dets_all[:, 0:4], dtype=np.float), thresh)
+    n_detected = np.bincount(inds, minlength=num_dets)
+    assert (n_detected > 0).all()
+
+    # Weighted bounding boxes
+    scores = dets_all[voters, 4].astype(np.float, copy=False)
+    weight_sums = np.bincount(inds, weights=scores, minlength=num_dets)
+    for c in xrange(4):
+        dets_voted[:, c] = np.bincount(inds, weights=scores * dets_all[voters, c],
+                                       minlength=num_dets) / weight_sums
+    dets_voted[:, 4] = dets_NMS[:, 4]      # Keep the original score
+
+    # Weighted scores (if enabled)
+    n_agreement = config.TEST.BBOX_VOTE_N_WEIGHTED_SCORE
+    if n_agreement > 1:
+        w_empty = config.TEST.BBOX_VOTE_WEIGHT_EMPTY
+
+        # average of the top n_agreement scores where enough boxes voted:
+        # rank the votes of each box by score
+        order = np.lexsort((-scores, inds))
+        ranks = np.arange(order.shape[0]) - \
+            (np.cumsum(n_detected) - n_detected)[inds[order]]
+        top = order[ranks < n_agreement]
+        agreed = np.bincount(inds[top], weights=scores[top],
+                             minlength=num_dets) / n_agreement
+
+        # otherwise penalize the missing votes
+        penalized = weight_sums / n_detected * \
+            (n_detected + (n_agreement - n_detected) * w_empty) / n_agreement
+
+        new_scores = np.where(n_detected >= n_agreement, agreed, penalized)
+        dets_voted[:, 4] = np.minimum(new_scores, dets_voted[:, 4])
 
-        out_box = np.dot(scores, boxes)
+    return dets_voted
 
-        dets_voted[i][0:4] = out_box / sum(scores)        # Weighted bounding boxes
-        dets_voted[i][4] = det[4]                         # Keep the original score
+def get_vote_func(config=None):
+    """Return the box voting function batched_nms should use with config.
 
-        # Weighted scores (if enabled)
-        if cfg.TEST.BBOX_VOTE_N_WEIGHTED_SCORE > 1:
-            n_agreement = cfg.TEST.BBOX_VOTE_N_WEIGHTED_SCORE
-            w_empty = cfg.TEST.BBOX_VOTE_WEIGHT_EMPTY
+    Weighted NMS already fuses the boxes, so it is never combined with box
+    voting.
+    """
+    if config is None:
+        config = cfg
+    if not config.TEST.BBOX_VOTE or config.TEST.NMS_METHOD == 'weighted':
+        return None
+    return lambda dets_NMS, dets_all: bbox_vote(dets_NMS, dets_all,
+                                                config=config)
 
-            n_detected = len(scores)
+def postprocess_detections(scores, boxes, num_classes, max_per_image=100,
+                           thresh=0.01, config=None):
+    """Turn raw im_detect outputs into per-class detections for one image.
 
-            if n_detected >= n_agreement:
-                top_scores = -np.sort(-scores)[:n_agreement]
-                new_score = np.average(top_scores)
-            else:
-                new_score = np.average(scores) * (n_detected * 1.0 + (n_agreement - n_detected) * w_empty) / n_agreement
+    Applies the NMS and box voting of config (cfg by default), drops the
+    detections scoring below thresh and keeps at most max_per_image.
 
-            dets_voted[i][4] = min(new_score, dets_voted[i][4])
+    Returns:
+        cls_dets (list): cls_dets[cls] = N x 5 array of detections in
+            (x1, y1, x2, y2, score); the background entry is left as []
+    """
+    if config is None:
+        config = cfg
+    dets, labels = batched_nms(scores, boxes, thresh, config.TEST.NMS,
+                               max_per_image, nms_func=get_nms_func(config),
+                               vote_func=get_vote_func(config))
+    # skip j = 0, because it's the background class
+    return [[]] + [dets[labels == j, :] for j in xrange(1, num_classes)]
+
+def _get_box_proposals(roidb, i):
+    """Return the non-ground-truth proposals of image i (None for RPN)."""
+    if cfg.TEST.HAS_RPN:
+        return None
+    # The roidb may contain ground-truth rois (for example, if the roidb
+    # comes from the training or val split). We only want to evaluate
+    # detection on the *non*-ground-truth rois. We select those the rois
+    # that have the gt_classes field set to 0, which means there's no
+    # ground truth.
+    return roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
+
+def _get_running_evaluator(imdb):
+    """Return the evaluator of the running mAP, if TEST.EVAL_INTERVAL."""
+    if cfg.TEST.EVAL_INTERVAL <= 0:
+        return None
+    evaluator = imdb.get_evaluator()
+    if evaluator is None:
+        print 'No in-memory evaluation for {}'.format(imdb.name)
+    return evaluator
+
+def _update_running_eval(evaluator, cls_dets, i):
+    """Add the detections of image i and report the mAP so far."""
+    if evaluator is None:
+        return
+    evaluator.add_image(i, cls_dets)
+    if evaluator.num_images % cfg.TEST.EVAL_INTERVAL == 0:
+        print 'mAP over {:d} images: {:.4f}'.format(evaluator.num_images,
+                                                    evaluator.mean_ap())
+
+def _file_digest(filename):
+    """SHA-1 of the contents of a file."""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            h.update(block)
+    return h.hexdigest()
+
+def _test_run_key(prototxt, caffemodel, max_per_image, thresh):
+    """Key of the checkpoints of a test run: a run only resumes from the
+    checkpoint of one with the same prototxt, weights, TEST options and
+    detection parameters, whichever test_net function runs it. None (no
+    checkpoints) if the prototxt or caffemodel is not known."""
+    if prototxt is None or caffemodel is None:
+        print 'Not checkpointing: the prototxt and caffemodel of the net ' \
+              'are not known'
+        return None
+    # options that do not change the detections
+    ignored = ('EVAL_INTERVAL', 'CHECKPOINT_INTERVAL', 'CACHE_RAW_OUTPUTS')
+    options = sorted((k, v) for k, v in cfg.TEST.iteritems()
+                     if k not in ignored)
+    h = hashlib.sha1(_file_digest(prototxt))
+    h.update(_file_digest(caffemodel))
+    h.update(repr((options, cfg.PIXEL_MEANS.tolist(), max_per_image,
+                   thresh)))
+    return h.hexdigest()
+
+def _get_detection_writer(imdb, output_dir, key):
+    """Return the writer of the detection store of test_net, resuming
+    from the checkpoint of an interrupted run with the same key."""
+    return DetectionWriter(os.path.join(output_dir, DETECTIONS_DIR),
+                           imdb.num_classes, len(imdb.image_index), key=key,
+                           checkpoint_interval=cfg.TEST.CHECKPOINT_INTERVAL)
+
+def _get_raw_output_writer(imdb, output_dir, key):
+    """Return the writer of the raw outputs of test_net, or None unless
+    TEST.CACHE_RAW_OUTPUTS."""
+    if not cfg.TEST.CACHE_RAW_OUTPUTS:
+        return None
+    return RawOutputWriter(os.path.join(output_dir, RAW_OUTPUTS_DIR),
+                           imdb.num_classes, len(imdb.image_index), key=key,
+                           checkpoint_interval=cfg.TEST.CHECKPOINT_INTERVAL)
+
+def _images_to_test(writer, raw_writer):
+    """Indexes of the images not done by an interrupted run."""
+    done = writer.done
+    if raw_writer is not None:
+        done = done & raw_writer.done
+    return np.where(~done)[0]
+
+def _save_and_evaluate(writer, raw_writer, imdb, output_dir):
+    stats = get_split_forward_stats()
+    if stats['images'] > 0:
+        # only counted in this process, not in the test_net_parallel workers
+        print 'Split forward: head skipped on {:d}/{:d} images, run on ' \
+              '{:d}/{:d} RoIs'.format(stats['head_skipped'], stats['images'],
+                                      stats['rois_kept'], stats['rois'])
+    # also only counted in this process
+    for backend, stats in sorted(nms_dispatcher.stats().iteritems()):
+        print 'NMS {:s}: {:d} calls, {:d} boxes, {:.3f}s' \
+              .format(backend, stats['calls'], stats['boxes'], stats['time'])
+    if raw_writer is not None:
+        print 'Wrote raw outputs to {}'.format(raw_writer.close().path)
+    all_boxes = writer.close()
+    print 'Wrote detections to {}'.format(all_boxes.path)
 
-    return dets_voted
+    print 'Evaluating detections'
+    imdb.evaluate_detections(all_boxes, output_dir)
 
 def test_net(net, imdb, max_per_image=100, thresh=0.01, vis=False):
-    """Test a Fast R-CNN network on an image database."""
+    """Test a Fast R-CNN network on an image database.
+
+    An interrupted run resumes from its last checkpoint if net.prototxt and
+    net.caffemodel name the files of the net (as tools/test_net.py sets).
+    """
     num_images = len(imdb.image_index)
-    # all detections are collected into:
+    output_dir = get_output_dir(imdb, net)
+    # all detections are collected into a DetectionStore, which reads back
+    # like all_boxes:
     #    all_boxes[cls][image] = N x 5 array of detections in
     #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(imdb.num_classes)]
+    key = _test_run_key(getattr(net, 'prototxt', None),
+                        getattr(net, 'caffemodel', None), max_per_image, thresh)
+    writer = _get_detection_writer(imdb, output_dir, key)
+    raw_writer = _get_raw_output_writer(imdb, output_dir, key)
 
-    output_dir = get_output_dir(imdb, net)
+    prepare_nms()
 
     # timers
     _t = {'im_preproc': Timer(), 'im_net' : Timer(), 'im_postproc': Timer(), 'misc' : Timer()}
 
-    if not cfg.TEST.HAS_RPN:
-        roidb = imdb.roidb
+    roidb = None if cfg.TEST.HAS_RPN else imdb.roidb
+    evaluator = _get_running_evaluator(imdb)
 
-    for i in xrange(num_images):
+    for i in _images_to_test(writer, raw_writer):
         # filter out any ground truth boxes
-        if cfg.TEST.HAS_RPN:
-            box_proposals = None
-        else:
-            # The roidb may contain ground-truth rois (for example, if the roidb
-            # comes from the training or val split). We only want to evaluate
-            # detection on the *non*-ground-truth rois. We select those the rois
-            # that have the gt_classes field set to 0, which means there's no
-            # ground truth.
-            box_proposals = roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
+        box_proposals = _get_box_proposals(roidb, i)
 
         im = cv2.imread(imdb.image_path_at(i))
         scores, boxes = im_detect(net, im, _t, box_proposals)
 
         _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in xrange(1, imdb.num_classes):
-            inds = np.where(scores[:, j] > thresh)[0]
-            cls_scores = scores[inds, j]
-            cls_boxes = boxes[inds, j*4:(j+1)*4]
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            keep = nms(cls_dets, cfg.TEST.NMS)
-
-            dets_NMSed = cls_dets[keep, :]
-            if cfg.TEST.BBOX_VOTE:
-                cls_dets = bbox_vote(dets_NMSed, cls_dets)
-            else:
-                cls_dets = dets_NMSed
-
-            if vis:
-                vis_detections(im, imdb.classes[j], cls_dets)
-            all_boxes[j][i] = cls_dets
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in xrange(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
+        if raw_writer is not None:
+            raw_writer.add_image(i, scores, boxes)
+        cls_dets = postprocess_detections(scores, boxes, imdb.num_classes,
+                                          max_per_image, thresh, cfg)
+        if vis:
+            for j in xrange(1, imdb.num_classes):
+                vis_detections(im, imdb.classes[j], cls_dets[j])
+        writer.add_image(i, cls_dets)
         _t['misc'].toc()
+        _update_running_eval(evaluator, cls_dets, i)
 
-        print 'im_detect: {:d}/{:d}  net {:.3f}s  preproc {:.3f}s  postproc {:.3f}s  misc {:.3f}s' \
+        print 'im_detect: {:d}/{:d}  net {:.3f}s  preproc {:.3f}s  postproc {:.3f}s  misc {:.3f}s  reshapes {:d}' \
               .format(i + 1, num_images, _t['im_net'].average_time,
                       _t['im_preproc'].average_time, _t['im_postproc'].average_time,
-                      _t['misc'].average_time)
-
-    det_file = os.path.join(output_dir, 'detections.pkl')
-    with open(det_file, 'wb') as f:
-        cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
-
-    print 'Evaluating detections'
-    imdb.evaluate_detections(all_boxes, output_dir)
+                      _t['misc'].average_time, _input_reshapes['reshapes'])
+
+    _save_and_evaluate(writer, raw_writer, imdb, output_dir)
+
+def _merge_timers(timers):
+    """Combine the timers of several threads running the same stage."""
+    merged = Timer()
+    merged.total_time = sum(t.total_time for t in timers)
+    merged.calls = sum(t.calls for t in timers)
+    if merged.calls > 0:
+        merged.average_time = merged.total_time / merged.calls
+    return merged
+
+def test_net_pipelined(net, imdb, max_per_image=100, thresh=0.01,
+                       num_readers=2, queue_size=8):
+    """Test a Fast R-CNN network on an image database, overlapping the stages.
+
+    Reader threads decode and preprocess images into a bounded prefetch
+    queue, the calling thread runs the net, and a post-processing thread
+    maps the outputs back to detections. Per-stage timers (with image
+    decoding timed apart from preprocessing) are reported along
+    with the average occupancy of both queues: a starved prefetch queue
+    means the readers are the bottleneck, a full post-processing queue means
+    post-processing is.
+    """
+    output_dir = get_output_dir(imdb, net)
+    key = _test_run_key(getattr(net, 'prototxt', None),
+                        getattr(net, 'caffemodel', None), max_per_image, thresh)
+    writer = _get_detection_writer(imdb, output_dir, key)
+    raw_writer = _get_raw_output_writer(imdb, output_dir, key)
+    roidb = None if cfg.TEST.HAS_RPN else imdb.roidb
+    evaluator = _get_running_evaluator(imdb)
+    image_inds = _images_to_test(writer, raw_writer)
+    prepare_nms()
+
+    prefetch_queue = Queue.Queue(maxsize=queue_size)
+    postproc_queue = Queue.Queue(maxsize=queue_size)
+    # time to decode the images, and to turn them into input blobs
+    read_timers = [Timer() for _ in xrange(num_readers)]
+    reader_timers = [Timer() for _ in xrange(num_readers)]
+    _t = {'im_net': Timer(), 'im_postproc': Timer(), 'misc': Timer()}
+    errors = []
+
+    def reader(r):
+        try:
+            for i in image_inds[r::num_readers]:
+                read_timers[r].tic()
+                im = cv2.imread(imdb.image_path_at(i))
+                read_timers[r].toc()
+                reader_timers[r].tic()
+                inputs = _get_im_detect_inputs(im, cfg,
+                                               _get_box_proposals(roidb, i))
+                reader_timers[r].toc()
+                prefetch_queue.put((i, inputs))
+        except Exception as e:
+            errors.append(e)
+            prefetch_queue.put(None)
+
+    def postprocessor():
+        try:
+            while True:
+                item = postproc_queue.get()
+                if item is None:
+                    break
+                i, inputs, outputs = item
+                _t['im_postproc'].tic()
+                scores, boxes = _get_im_detect_outputs(inputs, outputs, cfg)
+                _t['im_postproc'].toc()
+                _t['misc'].tic()
+                if raw_writer is not None:
+                    raw_writer.add_image(i, scores, boxes)
+                cls_dets = postprocess_detections(
+                    scores, boxes, imdb.num_classes, max_per_image, thresh,
+                    cfg)
+                writer.add_image(i, cls_dets)
+                _t['misc'].toc()
+                _update_running_eval(evaluator, cls_dets, i)
+        except Exception as e:
+            errors.append(e)
+            # keep draining so the net stage never blocks on a full queue
+            while postproc_queue.get() is not None:
+                pass
+
+    threads = [threading.Thread(target=reader, args=(r,))
+               for r in xrange(num_readers)]
+    threads.append(threading.Thread(target=postprocessor))
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    prefetch_occupancy = 0
+    postproc_occupancy = 0
+    for n in xrange(len(image_inds)):
+        prefetch_occupancy += prefetch_queue.qsize()
+        postproc_occupancy += postproc_queue.qsize()
+        item = prefetch_queue.get()
+        if item is None:
+            break
+        i, inputs = item
+        _t['im_net'].tic()
+        outputs = _im_detect_forward(net, inputs['blobs'], cfg)
+        _t['im_net'].toc()
+        # the input blobs are not needed anymore
+        del inputs['blobs']
+        postproc_queue.put((i, inputs, outputs))
+
+        print ('im_detect: {:d}/{:d}  net {:.3f}s  read {:.3f}s  '
+               'preproc {:.3f}s  postproc {:.3f}s  misc {:.3f}s  '
+               'queues: prefetch {:.1f}/{:d}  postproc {:.1f}/{:d}  '
+               'reshapes {:d}') \
+              .format(n + 1, len(image_inds), _t['im_net'].average_time,
+                      _merge_timers(read_timers).average_time,
+                      _merge_timers(reader_timers).average_time,
+                      _t['im_postproc'].average_time, _t['misc'].average_time,
+                      prefetch_occupancy / float(n + 1), queue_size,
+                      postproc_occupancy / float(n + 1), queue_size,
+                      _input_reshapes['reshapes'])
+
+    postproc_queue.put(None)
+    threads[-1].join()
+    if errors:
+        raise errors[0]
+
+    _save_and_evaluate(writer, raw_writer, imdb, output_dir)
+
+# Per-process state of the test_net_parallel workers
+_worker = {}
+
+def _init_test_worker(prototxt, caffemodel):
+    caffe.set_mode_cpu()
+    cfg.USE_GPU_NMS = False
+    _worker['net'] = caffe.Net(prototxt, caffemodel, caffe.TEST)
+    _worker['timers'] = {'im_preproc': Timer(), 'im_net' : Timer(),
+                         'im_postproc': Timer(), 'misc' : Timer()}
+
+def _test_worker(task):
+    i, image_path, box_proposals, num_classes, max_per_image, thresh = task
+    _t = _worker['timers']
+    im = cv2.imread(image_path)
+    scores, boxes = im_detect(_worker['net'], im, _t, box_proposals)
+    _t['misc'].tic()
+    cls_dets = postprocess_detections(scores, boxes, num_classes,
+                                      max_per_image, thresh, cfg)
+    _t['misc'].toc()
+    if not cfg.TEST.CACHE_RAW_OUTPUTS:
+        scores = boxes = None
+    return i, cls_dets, scores, boxes, _t['im_net'].average_time
+
+def test_net_parallel(prototxt, caffemodel, net_name, imdb, num_workers,
+                      max_per_image=100, thresh=0.01):
+    """Test a Fast R-CNN network on an image database with several CPU
+    worker processes, each holding its own caffe.Net.
+
+    Detections arrive out of order, but the store sorts them by image
+    index, so the saved detections are identical to the ones produced by
+    test_net.
+    """
+    output_dir = os.path.join(get_output_dir(imdb), net_name)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    key = _test_run_key(prototxt, caffemodel, max_per_image, thresh)
+    writer = _get_detection_writer(imdb, output_dir, key)
+    raw_writer = _get_raw_output_writer(imdb, output_dir, key)
+
+    roidb = None if cfg.TEST.HAS_RPN else imdb.roidb
+    evaluator = _get_running_evaluator(imdb)
+    image_inds = _images_to_test(writer, raw_writer)
+    tasks = ((i, imdb.image_path_at(i), _get_box_proposals(roidb, i),
+              imdb.num_classes, max_per_image, thresh)
+             for i in image_inds)
+
+    # The workers run CPU NMS: calibrate it before they are forked
+    use_gpu_nms, cfg.USE_GPU_NMS = cfg.USE_GPU_NMS, False
+    prepare_nms()
+    cfg.USE_GPU_NMS = use_gpu_nms
+
+    # Workers are forked, so they inherit the current cfg
+    pool = multiprocessing.Pool(num_workers, _init_test_worker,
+                                (prototxt, caffemodel))
+    start_time = time.time()
+    try:
+        results = pool.imap_unordered(_test_worker, tasks, chunksize=4)
+        for n, (i, cls_dets, scores, boxes, net_time) in enumerate(results):
+            if raw_writer is not None:
+                raw_writer.add_image(i, scores, boxes)
+            writer.add_image(i, cls_dets)
+            print 'im_detect: {:d}/{:d}  {:.3f}s/im  (worker net {:.3f}s)' \
+                  .format(n + 1, len(image_inds),
+                          (time.time() - start_time) / (n + 1), net_time)
+            _update_running_eval(evaluator, cls_dets, i)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    print 'Tested {:d} images with {:d} workers in {:.1f}s' \
+          .format(len(image_inds), num_workers, time.time() - start_time)
+
+    _save_and_evaluate(writer, raw_writer, imdb, output_dir)
@@ -9,7 +9,9 @@
 
 import caffe
 from fast_rcnn.config import cfg
+from fast_rcnn.nms_wrapper import prepare_nms
 import roi_data_layer.roidb as rdl_roidb
+from datasets.columnar_roidb import ColumnarRoidb
 from utils.timer import Timer
 import numpy as np
 import os
@@ -51,6 +53,7 @@ class SolverWrapper(object):
             pb2.text_format.Merge(f.read(), self.solver_param)
 
         self.solver.net.layers[0].set_roidb(roidb)
+        prepare_nms()
 
     def snapshot(self):
         """Take a snapshot of the network after unnormalizing the learned
@@ -113,11 +116,14 @@ class SolverWrapper(object):
 
 def get_training_roidb(imdb):
     """Returns a roidb (Region of Interest database) for use in training."""
-    if cfg.TRAIN.USE_FLIPPED:
-        print 'Appending horizontally-flipped training examples...'
-        imdb.append_flipped_images()
+    if cfg.TRAIN.COLUMNAR_ROIDB:
+        print 'Compacting the roidb...'
+        imdb.compact_roidb()
         print 'done'
 
+    # With cfg.TRAIN.USE_FLIPPED, the data layer flips the entries itself
+    # (roi_data_layer.layer), so no flipped copies are appended here
+
     print 'Preparing training data...'
     rdl_roidb.prepare_roidb(imdb)
     print 'done'
@@ -142,12 +148,25 @@ def filter_roidb(roidb):
         return valid
 
     num = len(roidb)
-    filtered_roidb = [entry for entry in roidb if is_valid(entry)]
+    if isinstance(roidb, ColumnarRoidb):
+        filtered_roidb = roidb.select(np.where(_valid_entries(roidb))[0])
+    else:
+        filtered_roidb = [entry for entry in roidb if is_valid(entry)]
     num_after = len(filtered_roidb)
     print 'Filtered {} roidb entries: {} -> {}'.format(num - num_after,
                                                        num, num_after)
     return filtered_roidb
 
+def _valid_entries(roidb):
+    """is_valid of filter_roidb for every entry of a ColumnarRoidb."""
+    overlaps = roidb.columns['max_overlaps']
+    usable = (overlaps >= cfg.TRAIN.FG_THRESH) | \
+             ((overlaps < cfg.TRAIN.BG_THRESH_HI) &
+              (overlaps >= cfg.TRAIN.BG_THRESH_LO))
+    num_usable = np.bincount(roidb.box_image_inds(), usable,
+                             minlength=roidb.num_stored_images)
+    return num_usable[roidb.image_inds] > 0
+
 def train_net(solver_prototxt, roidb, output_dir,
               pretrained_model=None, max_iters=40000):
     """Train a Fast R-CNN network."""
@@ -0,0 +1,74 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+from nms.cpu_nms import cpu_nms
+
+def batched_nms(scores, boxes, score_thresh, nms_thresh, max_per_image=0,
+                nms_func=cpu_nms, vote_func=None):
+    """Class-aware NMS over all classes of an image.
+
+    The candidates of all classes go through a single nms_func call that is
+    given their classes as labels, so that boxes only suppress boxes of
+    their own class, and max_per_image is enforced over all classes at once.
+
+    Arguments:
+        scores (ndarray): R x K array of class scores (class 0 is background)
+        boxes (ndarray): R x (4*K) array of class specific boxes
+        score_thresh (float): drop candidates scoring below this threshold
+        nms_thresh (float): IoU threshold used for suppression
+        max_per_image (int): keep at most this many detections over all
+            classes (0 disables the limit)
+        nms_func (callable): nms_func(dets, thresh, labels) -> kept
+            indices, or (kept indices, kept dets) for NMS methods that
+            rescore or refine the detections (see
+            fast_rcnn.nms_wrapper.nms_dets)
+        vote_func (callable): optional vote_func(dets_NMS, dets_all) box
+            voting applied to the surviving detections, with the classes
+            offset apart
+
+    Returns:
+        dets (ndarray): N x 5 array of detections (x1, y1, x2, y2, score)
+        labels (ndarray): N class indices, one per detection
+    """
+    # skip j = 0, because it's the background class
+    inds, labels = np.where(scores[:, 1:] > score_thresh)
+    labels += 1
+    cls_scores = scores[inds, labels]
+    # the number of classes cannot be inferred (-1) for an image without RoIs
+    num_classes = boxes.shape[1] // 4
+    cls_boxes = boxes.reshape((boxes.shape[0], num_classes, 4))[inds, labels]
+
+    if len(inds) == 0:
+        return np.zeros((0, 5), dtype=np.float32), labels
+
+    dets_all = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
+        .astype(np.float32, copy=False)
+    keep = nms_func(dets_all, nms_thresh, labels)
+    if isinstance(keep, tuple):
+        keep, dets = keep
+    else:
+        dets = dets_all[keep, :]
+    dets = dets.astype(np.float)
+    all_labels, labels = labels, labels[keep]
+
+    if vote_func is not None and len(dets) > 0:
+        # Shift the classes apart so that they only vote within a class. The
+        # float32 coordinates are shifted exactly in float64.
+        offsets = np.arange(num_classes) * (cls_boxes.max() + 1.0)
+        dets[:, 0:4] += offsets[labels, np.newaxis]
+        dets_all = dets_all.astype(np.float)
+        dets_all[:, 0:4] += offsets[all_labels, np.newaxis]
+        dets = vote_func(dets, dets_all)
+        dets[:, 0:4] -= offsets[labels, np.newaxis]
+
+    # Limit to max_per_image detections *over all classes*
+    if max_per_image > 0 and len(dets) > max_per_image:
+        image_thresh = np.sort(dets[:, -1])[-max_per_image]
+        keep = np.where(dets[:, -1] >= image_thresh)[0]
+        dets = dets[keep, :]
+        labels = labels[keep]
+
+    return dets.astype(np.float32, copy=False), labels
@@ -5,16 +5,45 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
+cimport cython
 import numpy as np
 cimport numpy as np
+from cython.parallel cimport prange
+from libc.math cimport exp
+from libc.stdint cimport uint64_t
 
-cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
+cdef inline np.float32_t max(np.float32_t a, np.float32_t b) nogil:
     return a if a >= b else b
 
-cdef inline np.float32_t min(np.float32_t a, np.float32_t b):
+cdef inline np.float32_t min(np.float32_t a, np.float32_t b) nogil:
     return a if a <= b else b
 
-def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
+def _nms_order(scores, labels):
+    """Visiting order of greedy NMS: by decreasing score or, with labels, by
+    label and then by decreasing score. ends[k] is the end of the label of
+    the box at position k of the order (the number of boxes without
+    labels), so that it is only compared with the boxes of its label."""
+    ndets = scores.shape[0]
+    if labels is None:
+        order = scores.argsort()[::-1]
+        ends = np.empty((ndets,), dtype=np.int)
+        ends.fill(ndets)
+    else:
+        labels = np.asarray(labels)
+        assert labels.shape == (ndets,), 'One label per box is needed'
+        order = np.lexsort((-scores, labels))
+        sorted_labels = labels[order]
+        ends = np.searchsorted(sorted_labels, sorted_labels, side='right')
+    return order.astype(np.int, copy=False), ends.astype(np.int, copy=False)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, double thresh,
+            labels=None):
+    """Greedy NMS. With labels (one per box, e.g. the class), a box only
+    suppresses boxes with the same label, as if every label went through
+    cpu_nms separately; the kept indices are then grouped by increasing
+    label."""
     cdef np.ndarray[np.float32_t, ndim=1] x1 = dets[:, 0]
     cdef np.ndarray[np.float32_t, ndim=1] y1 = dets[:, 1]
     cdef np.ndarray[np.float32_t, ndim=1] x2 = dets[:, 2]
@@ -22,7 +51,9 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
     cdef np.ndarray[np.float32_t, ndim=1] scores = dets[:, 4]
 
     cdef np.ndarray[np.float32_t, ndim=1] areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    cdef np.ndarray[np.int_t, ndim=1] order = scores.argsort()[::-1]
+    cdef np.ndarray[np.int_t, ndim=1] order
+    cdef np.ndarray[np.int_t, ndim=1] ends
+    order, ends = _nms_order(scores, labels)
 
     cdef int ndets = dets.shape[0]
     cdef np.ndarray[np.int_t, ndim=1] suppressed = \
@@ -50,7 +81,7 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
         ix2 = x2[i]
         iy2 = y2[i]
         iarea = areas[i]
-        for _j in range(_i + 1, ndets):
+        for _j in range(_i + 1, ends[_i]):
             j = order[_j]
             if suppressed[j] == 1:
                 continue
@@ -66,3 +97,252 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
                 suppressed[j] = 1
 
     return keep
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _suppression_mask_row(np.float32_t[:, ::1] boxes,
+                                       np.float32_t[::1] areas,
+                                       int i, np.float32_t thresh,
+                                       uint64_t[:, ::1] mask) nogil:
+    """Set bit j of mask row i for every lower scoring box j that box i
+    suppresses."""
+    cdef int j
+    cdef np.float32_t xx1, yy1, xx2, yy2
+    cdef np.float32_t w, h
+    cdef np.float32_t inter, ovr
+    for j in range(i + 1, boxes.shape[0]):
+        xx1 = max(boxes[i, 0], boxes[j, 0])
+        yy1 = max(boxes[i, 1], boxes[j, 1])
+        xx2 = min(boxes[i, 2], boxes[j, 2])
+        yy2 = min(boxes[i, 3], boxes[j, 3])
+        w = max(0.0, xx2 - xx1 + 1)
+        h = max(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[j] - inter)
+        if ovr >= thresh:
+            mask[i, j >> 6] |= (<uint64_t>1) << (j & 63)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_nms_parallel(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh,
+                     int num_threads=0):
+    """Multi-threaded greedy NMS, returning the same boxes as cpu_nms.
+
+    As in the CUDA kernel, the overlaps of all pairs of boxes are computed
+    in parallel (OpenMP threads over the rows, num_threads <= 0 uses the
+    OpenMP default) into a bitmask of which boxes each box suppresses, and
+    a serial sweep over the bitmask then picks the kept boxes.
+    """
+    cdef np.ndarray[np.int_t, ndim=1] order = \
+            np.ascontiguousarray(dets[:, 4].argsort()[::-1])
+    cdef np.float32_t[:, ::1] boxes = np.ascontiguousarray(dets[order, 0:4])
+    cdef np.float32_t[::1] areas = np.ascontiguousarray(
+            (dets[order, 2] - dets[order, 0] + 1) *
+            (dets[order, 3] - dets[order, 1] + 1))
+
+    cdef int ndets = dets.shape[0]
+    cdef int col_blocks = (ndets + 63) // 64
+    cdef uint64_t[:, ::1] mask = np.zeros((ndets, col_blocks), dtype=np.uint64)
+    cdef uint64_t[::1] removed = np.zeros((col_blocks,), dtype=np.uint64)
+    cdef np.ndarray[np.int_t, ndim=1] keep = np.zeros((ndets,), dtype=np.int)
+    cdef np.float32_t thresh_ = thresh
+    cdef int i, block, num_keep = 0
+
+    if num_threads > 0:
+        for i in prange(ndets, nogil=True, num_threads=num_threads,
+                        schedule='dynamic', chunksize=16):
+            _suppression_mask_row(boxes, areas, i, thresh_, mask)
+    else:
+        for i in prange(ndets, nogil=True, schedule='dynamic', chunksize=16):
+            _suppression_mask_row(boxes, areas, i, thresh_, mask)
+
+    for i in range(ndets):
+        if (removed[i >> 6] >> (i & 63)) & 1:
+            continue
+        keep[num_keep] = order[i]
+        num_keep += 1
+        for block in range(i >> 6, col_blocks):
+            removed[block] |= mask[i, block]
+
+    return list(keep[:num_keep])
+
+def cpu_soft_nms(np.ndarray[np.float32_t, ndim=2] dets, double thresh,
+                 unsigned int method=1, double sigma=0.5,
+                 double min_score=0.001, labels=None):
+    """Soft-NMS: decay the scores of overlapping boxes instead of removing
+    them (Bodla et al., "Improving Object Detection With One Line of Code").
+
+    method 1 (linear) scales a score by (1 - IoU) if IoU >= thresh; method 2
+    (gaussian) by exp(-IoU^2 / sigma). Boxes whose score falls below
+    min_score are dropped. With labels (one per box), a box only decays the
+    scores of boxes with the same label, as if every label went through
+    cpu_soft_nms separately.
+
+    Returns:
+        keep (ndarray): indices of the surviving boxes, in selection order
+            (grouped by increasing label)
+        dets (ndarray): the surviving boxes with their decayed scores
+    """
+    cdef int ndets = dets.shape[0]
+    cdef np.ndarray[np.float32_t, ndim=2] boxes = dets[:, 0:4].copy()
+    cdef np.ndarray[np.float32_t, ndim=1] scores = dets[:, 4].copy()
+    cdef np.ndarray[np.float32_t, ndim=1] areas = \
+            (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    # the boxes of each label are order[start:group_ends[g]], the remaining
+    # candidates of the current one are order[pos:last]
+    cdef np.ndarray[np.int_t, ndim=1] order
+    cdef np.ndarray[np.int_t, ndim=1] group_ends
+    if labels is None:
+        order = np.arange(ndets)
+        group_ends = np.array([ndets], dtype=np.int)
+    else:
+        order = np.argsort(labels, kind='mergesort').astype(np.int)
+        sorted_labels = np.asarray(labels)[order]
+        group_ends = np.unique(np.searchsorted(
+            sorted_labels, sorted_labels, side='right')).astype(np.int)
+
+    cdef int pos, k, i, j, best, last, g, start = 0, nkeep = 0
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t xx1, yy1, xx2, yy2
+    cdef np.float32_t w, h
+    cdef np.float32_t inter, ovr, weight
+
+    for g in range(group_ends.shape[0]):
+        last = group_ends[g]
+        pos = start
+        while pos < last:
+            # select the highest scoring remaining box
+            best = pos
+            for k in range(pos + 1, last):
+                if scores[order[k]] > scores[order[best]]:
+                    best = k
+            order[pos], order[best] = order[best], order[pos]
+            i = order[pos]
+            ix1 = boxes[i, 0]
+            iy1 = boxes[i, 1]
+            ix2 = boxes[i, 2]
+            iy2 = boxes[i, 3]
+            iarea = areas[i]
+            pos += 1
+
+            # decay the scores of the others
+            k = pos
+            while k < last:
+                j = order[k]
+                xx1 = max(ix1, boxes[j, 0])
+                yy1 = max(iy1, boxes[j, 1])
+                xx2 = min(ix2, boxes[j, 2])
+                yy2 = min(iy2, boxes[j, 3])
+                w = max(0.0, xx2 - xx1 + 1)
+                h = max(0.0, yy2 - yy1 + 1)
+                inter = w * h
+                if inter > 0:
+                    ovr = inter / (iarea + areas[j] - inter)
+                    if method == 1:
+                        weight = 1 - ovr if ovr >= thresh else 1
+                    else:
+                        weight = exp(-(ovr * ovr) / sigma)
+                    scores[j] *= weight
+                # drop boxes with a low score by swapping in the last one
+                if scores[j] < min_score:
+                    last -= 1
+                    order[k], order[last] = order[last], order[k]
+                else:
+                    k += 1
+        # move the survivors after those of the previous labels
+        for k in range(start, last):
+            order[nkeep] = order[k]
+            nkeep += 1
+        start = group_ends[g]
+
+    keep = order[:nkeep]
+    out = dets[keep, :]
+    out[:, 4] = scores[keep]
+    return keep, out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_weighted_nms(np.ndarray[np.float32_t, ndim=2] dets, double thresh,
+                     labels=None):
+    """Greedy NMS that replaces each kept box by the score weighted average
+    of itself and the boxes it suppresses, keeping its score.
+
+    This fuses boxes like NMS followed by box voting, but the votes come from
+    the overlaps NMS computes anyway. labels restricts the suppression to
+    boxes with the same label, as in cpu_nms.
+
+    Returns:
+        keep (ndarray): indices of the kept boxes
+        dets (ndarray): the kept detections with their weighted boxes
+    """
+    cdef np.ndarray[np.float32_t, ndim=1] x1 = dets[:, 0]
+    cdef np.ndarray[np.float32_t, ndim=1] y1 = dets[:, 1]
+    cdef np.ndarray[np.float32_t, ndim=1] x2 = dets[:, 2]
+    cdef np.ndarray[np.float32_t, ndim=1] y2 = dets[:, 3]
+    cdef np.ndarray[np.float32_t, ndim=1] scores = dets[:, 4]
+
+    cdef np.ndarray[np.float32_t, ndim=1] areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    cdef np.ndarray[np.int_t, ndim=1] order
+    cdef np.ndarray[np.int_t, ndim=1] ends
+    order, ends = _nms_order(scores, labels)
+
+    cdef int ndets = dets.shape[0]
+    cdef np.ndarray[np.int_t, ndim=1] suppressed = \
+            np.zeros((ndets), dtype=np.int)
+    cdef np.ndarray[np.float32_t, ndim=2] out = \
+            np.zeros((ndets, 5), dtype=np.float32)
+
+    cdef int _i, _j
+    cdef int i, j, nkeep = 0
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t xx1, yy1, xx2, yy2
+    cdef np.float32_t w, h
+    cdef np.float32_t inter, ovr
+    # accumulate in double precision
+    cdef double s, acc_x1, acc_y1, acc_x2, acc_y2, acc_s
+
+    keep = []
+    for _i in range(ndets):
+        i = order[_i]
+        if suppressed[i] == 1:
+            continue
+        keep.append(i)
+        ix1 = x1[i]
+        iy1 = y1[i]
+        ix2 = x2[i]
+        iy2 = y2[i]
+        iarea = areas[i]
+        s = scores[i]
+        acc_x1 = s * ix1
+        acc_y1 = s * iy1
+        acc_x2 = s * ix2
+        acc_y2 = s * iy2
+        acc_s = s
+        for _j in range(_i + 1, ends[_i]):
+            j = order[_j]
+            if suppressed[j] == 1:
+                continue
+            xx1 = max(ix1, x1[j])
+            yy1 = max(iy1, y1[j])
+            xx2 = min(ix2, x2[j])
+            yy2 = min(iy2, y2[j])
+            w = max(0.0, xx2 - xx1 + 1)
+            h = max(0.0, yy2 - yy1 + 1)
+            inter = w * h
+            ovr = inter / (iarea + areas[j] - inter)
+            if ovr >= thresh:
+                suppressed[j] = 1
+                s = scores[j]
+                acc_x1 += s * x1[j]
+                acc_y1 += s * y1[j]
+                acc_x2 += s * x2[j]
+                acc_y2 += s * y2[j]
+                acc_s += s
+        out[nkeep, 0] = acc_x1 / acc_s
+        out[nkeep, 1] = acc_y1 / acc_s
+        out[nkeep, 2] = acc_x2 / acc_s
+        out[nkeep, 3] = acc_y2 / acc_s
+        out[nkeep, 4] = scores[i]
+        nkeep += 1
+
+    return np.array(keep, dtype=np.int), out[:nkeep]
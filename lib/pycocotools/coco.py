@@ -57,6 +57,22 @@ import copy
 import itertools
 import mask
 import os
+import gc
+import functools
+
+def _withoutGC(func):
+    # building millions of small objects repeatedly triggers the cyclic garbage
+    # collector, which does not find anything to collect in them
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if enabled:
+                gc.enable()
+    return wrapper
 
 class COCO:
     def __init__(self, annotation_file=None):
@@ -81,34 +97,36 @@ class COCO:
             self.dataset = dataset
             self.createIndex()
 
+    @_withoutGC
     def createIndex(self):
         # create index
+        # annotations are indexed by arrays of ids sorted by image (category),
+        # with the offsets of the annotations of each image (category)
         print 'creating index...'
         anns = {}
-        imgToAnns = {}
-        catToImgs = {}
+        imgToAnns = _GroupIndex([], [0], [])
+        catToImgs = _GroupIndex([], [0], [])
         cats = {}
         imgs = {}
+        annotations = self.dataset.get('annotations', [])
+        self._annIds    = np.array([ann['id'] for ann in annotations], dtype=np.int64)
+        self._annImgIds = np.array([ann['image_id'] for ann in annotations], dtype=np.int64)
+        self._annCatIds = np.array([ann.get('category_id', 0) for ann in annotations], dtype=np.int64)
+        self._annAreas  = np.array([ann.get('area', 0) for ann in annotations], dtype=np.float)
+        self._annCrowd  = np.array([ann.get('iscrowd', 0) for ann in annotations], dtype=np.int64)
         if 'annotations' in self.dataset:
-            imgToAnns = {ann['image_id']: [] for ann in self.dataset['annotations']}
-            anns =      {ann['id']:       [] for ann in self.dataset['annotations']}
-            for ann in self.dataset['annotations']:
-                imgToAnns[ann['image_id']] += [ann]
-                anns[ann['id']] = ann
+            order = np.argsort(self._annImgIds, kind='mergesort')
+            imgToAnns = _GroupIndex.fromKeys(self._annImgIds[order], order, annotations)
+            anns = dict(zip(self._annIds.tolist(), annotations))
 
         if 'images' in self.dataset:
-            imgs      = {im['id']: {} for im in self.dataset['images']}
-            for img in self.dataset['images']:
-                imgs[img['id']] = img
+            imgs = dict((img['id'], img) for img in self.dataset['images'])
 
         if 'categories' in self.dataset:
-            cats = {cat['id']: [] for cat in self.dataset['categories']}
-            for cat in self.dataset['categories']:
-                cats[cat['id']] = cat
-            catToImgs = {cat['id']: [] for cat in self.dataset['categories']}
-            if 'annotations' in self.dataset:
-                for ann in self.dataset['annotations']:
-                    catToImgs[ann['category_id']] += [ann['image_id']]
+            cats = dict((cat['id'], cat) for cat in self.dataset['categories'])
+            order = np.argsort(self._annCatIds, kind='mergesort')
+            catToImgs = _GroupIndex.fromKeys(self._annCatIds[order], self._annImgIds[order],
+                                             keys=sorted(cats))
 
         print 'index created!'
 
@@ -139,22 +157,18 @@ class COCO:
         imgIds = imgIds if type(imgIds) == list else [imgIds]
         catIds = catIds if type(catIds) == list else [catIds]
 
-        if len(imgIds) == len(catIds) == len(areaRng) == 0:
-            anns = self.dataset['annotations']
+        if not len(imgIds) == 0:
+            inds = self.imgToAnns.valueInds(imgIds)
         else:
-            if not len(imgIds) == 0:
-                # this can be changed by defaultdict
-                lists = [self.imgToAnns[imgId] for imgId in imgIds if imgId in self.imgToAnns]
-                anns = list(itertools.chain.from_iterable(lists))
-            else:
-                anns = self.dataset['annotations']
-            anns = anns if len(catIds)  == 0 else [ann for ann in anns if ann['category_id'] in catIds]
-            anns = anns if len(areaRng) == 0 else [ann for ann in anns if ann['area'] > areaRng[0] and ann['area'] < areaRng[1]]
+            inds = np.arange(len(self._annIds))
+        if not len(catIds) == 0:
+            inds = inds[np.in1d(self._annCatIds[inds], catIds)]
+        if not len(areaRng) == 0:
+            areas = self._annAreas[inds]
+            inds = inds[(areas > areaRng[0]) & (areas < areaRng[1])]
         if not iscrowd == None:
-            ids = [ann['id'] for ann in anns if ann['iscrowd'] == iscrowd]
-        else:
-            ids = [ann['id'] for ann in anns]
-        return ids
+            inds = inds[self._annCrowd[inds] == iscrowd]
+        return self._annIds[inds].tolist()
 
     def getCatIds(self, catNms=[], supNms=[], catIds=[]):
         """
@@ -282,6 +296,8 @@ class COCO:
         """
         Load result file and return a result api object.
         :param   resFile (str)     : file name of result file
+                         (list)    : result objects
+                         (ndarray) : Nx7 array of detections (see loadNumpyAnnotations)
         :return: res (obj)         : result api object
         """
         res = COCO()
@@ -291,12 +307,18 @@ class COCO:
 
         print 'Loading and preparing results...     '
         tic = time.time()
-        anns    = json.load(open(resFile))
-        assert type(anns) == list, 'results in not an array of objects'
-        annsImgIds = [ann['image_id'] for ann in anns]
-        assert set(annsImgIds) == (set(annsImgIds) & set(self.getImgIds())), \
+        if type(resFile) == np.ndarray:
+            anns = self.loadNumpyAnnotations(resFile)
+            annsImgIds = resFile[:, 0].astype(np.int64)
+        else:
+            anns = json.load(open(resFile)) if isinstance(resFile, basestring) else resFile
+            assert type(anns) == list, 'results in not an array of objects'
+            annsImgIds = np.array([ann['image_id'] for ann in anns], dtype=np.int64)
+        assert np.all(np.in1d(annsImgIds, self.getImgIds())), \
                'Results do not correspond to current coco set'
-        if 'caption' in anns[0]:
+        if type(resFile) == np.ndarray:
+            res.dataset['categories'] = copy.deepcopy(self.dataset['categories'])
+        elif 'caption' in anns[0]:
             imgIds = set([img['id'] for img in res.dataset['images']]) & set([ann['image_id'] for ann in anns])
             res.dataset['images'] = [img for img in res.dataset['images'] if img['id'] in imgIds]
             for id, ann in enumerate(anns):
@@ -326,6 +348,28 @@ class COCO:
         res.createIndex()
         return res
 
+    @_withoutGC
+    def loadNumpyAnnotations(self, data):
+        """
+        Convert detection results from a numpy array [Nx7] where each row contains
+        {imageID,x1,y1,w,h,score,class} to result objects (without segmentation,
+        so only for bbox evaluation)
+        :param  data (numpy.ndarray)
+        :return: annotations (python nested list)
+        """
+        print 'Converting ndarray to lists...'
+        assert(type(data) == np.ndarray)
+        assert(data.ndim == 2 and data.shape[1] == 7)
+        imgIds = data[:, 0].astype(np.int64).tolist()
+        bboxes = data[:, 1:5].tolist()
+        areas = (data[:, 3] * data[:, 4]).tolist()
+        scores = data[:, 5].tolist()
+        catIds = data[:, 6].astype(np.int64).tolist()
+        return [{'image_id': imgId, 'category_id': catId, 'bbox': bbox,
+                 'score': score, 'area': area, 'id': id+1, 'iscrowd': 0}
+                for id, (imgId, bbox, score, area, catId)
+                in enumerate(itertools.izip(imgIds, bboxes, scores, areas, catIds))]
+
     def download( self, tarDir = None, imgIds = [] ):
         '''
         Download COCO images from mscoco.org server.
@@ -349,3 +393,74 @@ class COCO:
             if not os.path.exists(fname):
                 urllib.urlretrieve(img['coco_url'], fname)
             print 'downloaded %d/%d images (t=%.1fs)'%(i, N, time.time()- tic)
+
+class _GroupIndex(object):
+    """
+    Read-only dict like index from sorted keys to the groups of values between
+    consecutive offsets (e.g. from image ids to their annotations).
+    """
+    def __init__(self, keys, offsets, values, lookup=None):
+        self._keys = np.asarray(keys, dtype=np.int64)
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+        self._values = np.asarray(values)
+        self._lookup = lookup
+
+    @classmethod
+    def fromKeys(cls, sortedKeys, values, lookup=None, keys=None):
+        """
+        Group values by their sorted keys (by default the keys that occur)
+        """
+        if keys is None:
+            keys = np.unique(sortedKeys)
+        keys = np.asarray(keys, dtype=np.int64)
+        offsets = np.searchsorted(sortedKeys, np.append(keys, np.iinfo(np.int64).max))
+        offsets[-1] = len(sortedKeys)
+        return cls(keys, offsets, values, lookup)
+
+    def _find(self, keys):
+        pos = np.searchsorted(self._keys, keys)
+        pos = np.minimum(pos, len(self._keys) - 1)
+        found = self._keys[pos] == keys if len(self._keys) else np.zeros(len(pos), dtype=np.bool)
+        return pos, found
+
+    def valueInds(self, keys):
+        """
+        Indexes into values of the groups of keys, concatenated (unknown keys are skipped)
+        """
+        pos, found = self._find(np.asarray(keys, dtype=np.int64).reshape(-1))
+        pos = pos[found]
+        starts = self._offsets[pos]
+        lengths = self._offsets[pos + 1] - starts
+        # arange within every group, shifted to its start
+        inds = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self._values[inds]
+
+    def __getitem__(self, key):
+        pos, found = self._find(np.array([key], dtype=np.int64))
+        if not found[0]:
+            raise KeyError(key)
+        values = self._values[self._offsets[pos[0]]:self._offsets[pos[0] + 1]].tolist()
+        if self._lookup is not None:
+            return [self._lookup[v] for v in values]
+        return values
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return bool(self._find(np.array([key], dtype=np.int64))[1][0])
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys.tolist())
+
+    def keys(self):
+        return self._keys.tolist()
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
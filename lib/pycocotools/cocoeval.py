@@ -4,9 +4,19 @@ import numpy as np
 import datetime
 import time
 from collections import defaultdict
+import multiprocessing
 import mask
 import copy
 
+# Max number of elements of the [images x A x T x G] arrays matched at once
+_MATCH_BATCH_SIZE = 1 << 20
+
+# COCOeval of the evaluate() worker processes, inherited when they are forked
+_workerEval = None
+
+def _evaluateCategory(catId):
+    return _workerEval._evaluateCategory(catId)
+
 class COCOeval:
     # Interface for evaluating detection on the Microsoft COCO dataset.
     #
@@ -126,9 +136,10 @@ class COCOeval:
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
         self.eval     = {}                  # accumulated evaluation results
 
-    def evaluate(self):
+    def evaluate(self, numProcs=1):
         '''
         Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        :param numProcs: number of processes over which categories are spread
         :return: None
         '''
         tic = time.time()
@@ -141,25 +152,46 @@ class COCOeval:
         self.params=p
 
         self._prepare()
-        # loop through images, area range, max detection number
+        # loop through categories; images and area ranges are evaluated per category
         catIds = p.catIds if p.useCats else [-1]
 
-        computeIoU = self.computeIoU
-        self.ious = {(imgId, catId): computeIoU(imgId, catId) \
-                        for imgId in p.imgIds
-                        for catId in catIds}
-
-        evaluateImg = self.evaluateImg
-        maxDet = p.maxDets[-1]
-        self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
-                 for catId in catIds
-                 for areaRng in p.areaRng
-                 for imgId in p.imgIds
-             ]
+        if numProcs > 1 and len(catIds) > 1:
+            # forked workers inherit self, only the results are sent back
+            global _workerEval
+            _workerEval = self
+            pool = multiprocessing.Pool(numProcs)
+            try:
+                results = pool.map(_evaluateCategory, catIds)
+            finally:
+                pool.close()
+                pool.join()
+                _workerEval = None
+        else:
+            results = map(self._evaluateCategory, catIds)
+        self.ious = {}
+        self.evalImgs = []
+        for ious, evalImgs in results:
+            self.ious.update(ious)
+            self.evalImgs.extend(evalImgs)
         self._paramsEval = copy.deepcopy(self.params)
         toc = time.time()
         print 'DONE (t=%0.2fs).'%(toc-tic)
 
+    def _evaluateCategory(self, catId):
+        '''
+        Compute the ious and evaluate all images and area ranges of one category
+        :return: ious of the category, evalImgs ordered by area range and image
+        '''
+        p = self.params
+        maxDet = p.maxDets[-1]
+        self.ious = {(imgId, catId): self.computeIoU(imgId, catId)
+                        for imgId in p.imgIds}
+        evalImgs = self._evaluateImgs(p.imgIds, catId, p.areaRng, maxDet)
+        # evalImgs[a][i] for area range a and image i
+        evalImgs = [e for a in range(len(p.areaRng)) for e in zip(*evalImgs)[a]] \
+            if evalImgs else []
+        return self.ious, evalImgs
+
     def computeIoU(self, imgId, catId):
         p = self.params
         if p.useCats:
@@ -191,85 +223,139 @@ class COCOeval:
         perform evaluation for single category and image
         :return: dict (single image results)
         '''
+        return self._evaluateImgs([imgId], catId, [aRng], maxDet)[0][0]
+
+    def _evaluateImgs(self, imgIds, catId, aRngs, maxDet):
+        '''
+        perform evaluation for single category and several images, for all area
+        ranges and IoU thresholds at once
+        :return: list (per image) of list (per area range) of dict (single image results)
+        '''
         #
         p = self.params
-        if p.useCats:
-            gt = self._gts[imgId,catId]
-            dt = self._dts[imgId,catId]
-        else:
-            gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
-            dt = [_ for cId in p.catIds for _ in self._dts[imgId,cId]]
-        if len(gt) == 0 and len(dt) ==0:
-            return None
-
-        for g in gt:
-            if 'ignore' not in g:
-                g['ignore'] = 0
-            if g['iscrowd'] == 1 or g['ignore'] or (g['area']<aRng[0] or g['area']>aRng[1]):
-                g['_ignore'] = 1
+        aRngs = np.array(aRngs, dtype=np.float).reshape(-1, 2)
+        A = len(aRngs)
+        T = len(p.iouThrs)
+        evalImgs = [[None] * A for _ in imgIds]
+        imgs = []
+        for i, imgId in enumerate(imgIds):
+            if p.useCats:
+                gt = self._gts[imgId,catId]
+                dt = self._dts[imgId,catId]
             else:
-                g['_ignore'] = 0
+                gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
+                dt = [_ for cId in p.catIds for _ in self._dts[imgId,cId]]
+            if len(gt) == 0 and len(dt) ==0:
+                continue
 
-        # sort dt highest score first, sort gt ignore last
-        # gt = sorted(gt, key=lambda x: x['_ignore'])
-        gtind = [ind for (ind, g) in sorted(enumerate(gt), key=lambda (ind, g): g['_ignore']) ]
+            # sort dt highest score first
+            dt = sorted(dt, key=lambda x: -x['score'])[0:maxDet]
+            img = {
+                'index':    i,
+                'gtIds':    np.array([g['id'] for g in gt]),
+                'dtIds':    np.array([d['id'] for d in dt]),
+                'dtScores': [d['score'] for d in dt],
+                'iscrowd':  np.array([int(g['iscrowd']) for g in gt], dtype=np.bool),
+            }
+            gtArea = np.array([g['area'] for g in gt], dtype=np.float)
+            dtArea = np.array([d['area'] for d in dt], dtype=np.float)
+            # [AxG] ignore flag of each gt in each area range
+            gtIg = img['iscrowd'] | np.array([bool(g.get('ignore', 0)) for g in gt], dtype=np.bool)
+            img['gtIg'] = gtIg | (gtArea < aRngs[:, :1]) | (gtArea > aRngs[:, 1:])
+            # [AxD] whether each dt is outside of each area range
+            img['dtOut'] = (dtArea < aRngs[:, :1]) | (dtArea > aRngs[:, 1:])
+            # [AxTxG] and [AxTxD] matches of all area ranges and IoU thresholds,
+            # gts in their original order
+            img['gtm']  = np.zeros((A,T,len(gt)))
+            img['dtm']  = np.zeros((A,T,len(dt)))
+            img['dtIg'] = np.zeros((A,T,len(dt)), dtype=np.bool)
+            ious = self.ious[imgId, catId]
+            img['ious'] = ious[0:maxDet] if len(ious) > 0 else None
+            imgs.append(img)
 
-        gt = [gt[ind] for ind in gtind]
-        dt = sorted(dt, key=lambda x: -x['score'])[0:maxDet]
-        iscrowd = [int(o['iscrowd']) for o in gt]
-        # load computed ious
-        N_iou = len(self.ious[imgId, catId])
-        ious = self.ious[imgId, catId][0:maxDet, np.array(gtind)] if N_iou >0 else self.ious[imgId, catId]
+        # match the images with both gts and dts in batches of similar numbers of gts
+        toMatch = sorted([img for img in imgs if img['ious'] is not None and len(img['gtIds']) > 0],
+                         key=lambda img: len(img['gtIds']))
+        start = 0
+        while start < len(toMatch):
+            end = start + 1
+            while end < len(toMatch) and \
+                    (end + 1 - start) * len(toMatch[end]['gtIds']) * A * T <= _MATCH_BATCH_SIZE:
+                end += 1
+            self._matchImgs(toMatch[start:end])
+            start = end
 
-        T = len(p.iouThrs)
-        G = len(gt)
-        D = len(dt)
-        gtm  = np.zeros((T,G))
-        dtm  = np.zeros((T,D))
-        gtIg = np.array([g['_ignore'] for g in gt])
-        dtIg = np.zeros((T,D))
-        if not len(ious)==0:
-            for tind, t in enumerate(p.iouThrs):
-                for dind, d in enumerate(dt):
-                    # information about best match so far (m=-1 -> unmatched)
-                    iou = min([t,1-1e-10])
-                    m   = -1
-                    for gind, g in enumerate(gt):
-                        # if this gt already matched, and not a crowd, continue
-                        if gtm[tind,gind]>0 and not iscrowd[gind]:
-                            continue
-                        # if dt matched to reg gt, and on ignore gt, stop
-                        if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
-                            break
-                        # continue to next gt unless better match made
-                        if ious[dind,gind] < iou:
-                            continue
-                        # match successful and best so far, store appropriately
-                        iou=ious[dind,gind]
-                        m=gind
-                    # if match made store id of match for both dt and gt
-                    if m ==-1:
-                        continue
-                    dtIg[tind,dind] = gtIg[m]
-                    dtm[tind,dind]  = gt[m]['id']
-                    gtm[tind,m]     = d['id']
-        # set unmatched detections outside of area range to ignore
-        a = np.array([d['area']<aRng[0] or d['area']>aRng[1] for d in dt]).reshape((1, len(dt)))
-        dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
-        # store results for given image and category
-        return {
-                'image_id':     imgId,
-                'category_id':  catId,
-                'aRng':         aRng,
-                'maxDet':       maxDet,
-                'dtIds':        [d['id'] for d in dt],
-                'gtIds':        [g['id'] for g in gt],
-                'dtMatches':    dtm,
-                'gtMatches':    gtm,
-                'dtScores':     [d['score'] for d in dt],
-                'gtIgnore':     gtIg,
-                'dtIgnore':     dtIg,
-            }
+        # store results for given images and category, gt ignore last
+        for img in imgs:
+            dtIg = np.logical_or(img['dtIg'],
+                                 np.logical_and(img['dtm']==0, img['dtOut'][:, np.newaxis, :]))
+            for aind, aRng in enumerate(aRngs.tolist()):
+                gtind = np.argsort(img['gtIg'][aind], kind='mergesort')
+                evalImgs[img['index']][aind] = {
+                    'image_id':     imgIds[img['index']],
+                    'category_id':  catId,
+                    'aRng':         aRng,
+                    'maxDet':       maxDet,
+                    'dtIds':        img['dtIds'].tolist(),
+                    'gtIds':        img['gtIds'][gtind].tolist(),
+                    'dtMatches':    img['dtm'][aind],
+                    'gtMatches':    img['gtm'][aind][:, gtind],
+                    'dtScores':     img['dtScores'],
+                    'gtIgnore':     img['gtIg'][aind][gtind].astype(np.int),
+                    'dtIgnore':     dtIg[aind],
+                }
+        return evalImgs
+
+    def _matchImgs(self, imgs):
+        '''
+        Greedily match the dts of several images (highest score first) to their gts,
+        for all area ranges and IoU thresholds at once; images are padded to the
+        largest number of gts and dts
+        :return: None (fills the gtm, dtm and dtIg arrays of imgs)
+        '''
+        n = len(imgs)
+        A, T = imgs[0]['gtm'].shape[:2]
+        G = max(len(img['gtIds']) for img in imgs)
+        D = max(len(img['dtIds']) for img in imgs)
+        # padded gts and dts overlap nothing
+        ious    = -np.ones((n,D,G))
+        gtIds   = np.zeros((n,G))
+        dtIds   = np.zeros((n,D))
+        iscrowd = np.zeros((n,G), dtype=np.bool)
+        gtIg    = np.ones((n,A,G), dtype=np.bool)
+        for i, img in enumerate(imgs):
+            Gi, Di = len(img['gtIds']), len(img['dtIds'])
+            ious[i,:Di,:Gi] = img['ious']
+            gtIds[i,:Gi]    = img['gtIds']
+            dtIds[i,:Di]    = img['dtIds']
+            iscrowd[i,:Gi]  = img['iscrowd']
+            gtIg[i,:,:Gi]   = img['gtIg']
+
+        gtm  = np.zeros((n,A,T,G))
+        dtm  = np.zeros((n,A,T,D))
+        dtIg = np.zeros((n,A,T,D), dtype=np.bool)
+        thrs = np.minimum(self.params.iouThrs, 1-1e-10)[:, np.newaxis]
+        # a dt is matched to the best available regular gt, or else to the best
+        # available ignored gt; of equally good gts the last one wins
+        prefer = 2 * (~gtIg)[:, :, np.newaxis, :]
+        iscrowd = iscrowd[:, np.newaxis, np.newaxis, :]
+        for dind in range(D):
+            iou = ious[:, np.newaxis, np.newaxis, dind, :]
+            # gts that are not yet matched (or crowd) and overlap enough
+            ok = ((gtm <= 0) | iscrowd) & (iou >= thrs)
+            score = np.where(ok, iou + prefer, -1)
+            m = G - 1 - np.argmax(score[..., ::-1], axis=3)
+            iind, aind, tind = np.nonzero(ok.any(axis=3))
+            m = m[iind, aind, tind]
+            dtIg[iind,aind,tind,dind] = gtIg[iind,aind,m]
+            dtm[iind,aind,tind,dind]  = gtIds[iind,m]
+            gtm[iind,aind,tind,m]     = dtIds[iind,dind]
+
+        for i, img in enumerate(imgs):
+            Gi, Di = len(img['gtIds']), len(img['dtIds'])
+            img['gtm']  = gtm[i,:,:,:Gi]
+            img['dtm']  = dtm[i,:,:,:Di]
+            img['dtIg'] = dtIg[i,:,:,:Di]
 
     def accumulate(self, p = None):
         '''
@@ -308,61 +394,54 @@ class COCOeval:
         # K0 = len(_pe.catIds)
         I0 = len(_pe.imgIds)
         A0 = len(_pe.areaRng)
-        # retrieve E at each category, area range, and max number of detections
+        # retrieve E at each category and area range, once for all max numbers of detections
         for k, k0 in enumerate(k_list):
             Nk = k0*A0*I0
             for a, a0 in enumerate(a_list):
                 Na = a0*I0
+                E = [self.evalImgs[Nk+Na+i] for i in i_list]
+                E = filter(None, E)
+                if len(E) == 0:
+                    continue
+                maxDetAll = max(m_list)
+                dtScores = np.concatenate([e['dtScores'][0:maxDetAll] for e in E])
+                # rank of each dt within its image
+                dtRank = np.concatenate([np.arange(len(e['dtScores'][0:maxDetAll])) for e in E])
+                dtmAll  = np.concatenate([e['dtMatches'][:,0:maxDetAll] for e in E], axis=1)
+                dtIgAll = np.concatenate([e['dtIgnore'][:,0:maxDetAll]  for e in E], axis=1)
+                gtIg = np.concatenate([e['gtIgnore']  for e in E])
+                npig = np.count_nonzero(gtIg == 0)
+                if npig == 0:
+                    continue
                 for m, maxDet in enumerate(m_list):
-                    E = [self.evalImgs[Nk+Na+i] for i in i_list]
-                    E = filter(None, E)
-                    if len(E) == 0:
-                        continue
-                    dtScores = np.concatenate([e['dtScores'][0:maxDet] for e in E])
-
+                    keep = dtRank < maxDet
                     # different sorting method generates slightly different results.
                     # mergesort is used to be consistent as Matlab implementation.
-                    inds = np.argsort(-dtScores, kind='mergesort')
-
-                    dtm  = np.concatenate([e['dtMatches'][:,0:maxDet] for e in E], axis=1)[:,inds]
-                    dtIg = np.concatenate([e['dtIgnore'][:,0:maxDet]  for e in E], axis=1)[:,inds]
-                    gtIg = np.concatenate([e['gtIgnore']  for e in E])
-                    npig = len([ig for ig in gtIg if ig == 0])
-                    if npig == 0:
-                        continue
+                    inds = np.argsort(-dtScores[keep], kind='mergesort')
+
+                    dtm  = dtmAll[:, keep][:, inds]
+                    dtIg = dtIgAll[:, keep][:, inds]
                     tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
                     fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
 
                     tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
                     fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
-                    for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
-                        tp = np.array(tp)
-                        fp = np.array(fp)
-                        nd = len(tp)
-                        rc = tp / npig
-                        pr = tp / (fp+tp+np.spacing(1))
-                        q  = np.zeros((R,))
-
-                        if nd:
-                            recall[t,k,a,m] = rc[-1]
-                        else:
-                            recall[t,k,a,m] = 0
-
-                        # numpy is slow without cython optimization for accessing elements
-                        # use python array gets significant speed improvement
-                        pr = pr.tolist(); q = q.tolist()
-
-                        for i in range(nd-1, 0, -1):
-                            if pr[i] > pr[i-1]:
-                                pr[i-1] = pr[i]
-
-                        inds = np.searchsorted(rc, p.recThrs)
-                        try:
-                            for ri, pi in enumerate(inds):
-                                q[ri] = pr[pi]
-                        except:
-                            pass
-                        precision[t,:,k,a,m] = np.array(q)
+                    nd = tp_sum.shape[1]
+                    rc = tp_sum / npig
+                    pr = tp_sum / (fp_sum+tp_sum+np.spacing(1))
+                    if nd:
+                        recall[:,k,a,m] = rc[:, -1]
+                    else:
+                        recall[:,k,a,m] = 0
+
+                    # precision envelope: max precision at any higher recall
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    for t in range(T):
+                        inds = np.searchsorted(rc[t], p.recThrs)
+                        valid = inds < nd
+                        q = np.zeros((R,))
+                        q[valid] = pr[t, inds[valid]]
+                        precision[t,:,k,a,m] = q
         self.eval = {
             'params': p,
             'counts': [T, R, K, A, M],
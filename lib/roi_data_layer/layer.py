@@ -13,18 +13,32 @@ RoIDataLayer implements a Caffe Python layer.
 import caffe
 from fast_rcnn.config import cfg
 from roi_data_layer.minibatch import get_minibatch
+from roi_data_layer.roidb import flipped_entry
 import numpy as np
 import yaml
 from multiprocessing import Process, Queue
 
+def _num_samples(roidb):
+    """Number of samples per epoch: with cfg.TRAIN.USE_FLIPPED, sample
+    len(roidb) + i is roidb entry i flipped horizontally."""
+    return len(roidb) * (2 if cfg.TRAIN.USE_FLIPPED else 1)
+
+def _get_minibatch_db(roidb, sample_inds):
+    """The roidb entries of the samples sample_inds."""
+    num_entries = len(roidb)
+    return [roidb[i] if i < num_entries else
+            flipped_entry(roidb, i - num_entries) for i in sample_inds]
+
 class RoIDataLayer(caffe.Layer):
     """Fast R-CNN data layer used for training."""
 
     def _shuffle_roidb_inds(self):
         """Randomly permute the training roidb."""
+        num_samples = _num_samples(self._roidb)
         if cfg.TRAIN.ASPECT_GROUPING:
-            widths = np.array([r['width'] for r in self._roidb])
-            heights = np.array([r['height'] for r in self._roidb])
+            entry_inds = np.arange(num_samples) % len(self._roidb)
+            widths = np.array([r['width'] for r in self._roidb])[entry_inds]
+            heights = np.array([r['height'] for r in self._roidb])[entry_inds]
             horz = (widths >= heights)
             vert = np.logical_not(horz)
             horz_inds = np.where(horz)[0]
@@ -37,12 +51,12 @@ class RoIDataLayer(caffe.Layer):
             inds = np.reshape(inds[row_perm, :], (-1,))
             self._perm = inds
         else:
-            self._perm = np.random.permutation(np.arange(len(self._roidb)))
+            self._perm = np.random.permutation(np.arange(num_samples))
         self._cur = 0
 
     def _get_next_minibatch_inds(self):
-        """Return the roidb indices for the next minibatch."""
-        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= len(self._roidb):
+        """Return the sample indices for the next minibatch."""
+        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= _num_samples(self._roidb):
             self._shuffle_roidb_inds()
 
         db_inds = self._perm[self._cur:self._cur + cfg.TRAIN.IMS_PER_BATCH]
@@ -59,7 +73,7 @@ class RoIDataLayer(caffe.Layer):
             return self._blob_queue.get()
         else:
             db_inds = self._get_next_minibatch_inds()
-            minibatch_db = [self._roidb[i] for i in db_inds]
+            minibatch_db = _get_minibatch_db(self._roidb, db_inds)
             return get_minibatch(minibatch_db, self._num_classes)
 
     def set_roidb(self, roidb):
@@ -174,13 +188,13 @@ class BlobFetcher(Process):
     def _shuffle_roidb_inds(self):
         """Randomly permute the training roidb."""
         # TODO(rbg): remove duplicated code
-        self._perm = np.random.permutation(np.arange(len(self._roidb)))
+        self._perm = np.random.permutation(np.arange(_num_samples(self._roidb)))
         self._cur = 0
 
     def _get_next_minibatch_inds(self):
-        """Return the roidb indices for the next minibatch."""
+        """Return the sample indices for the next minibatch."""
         # TODO(rbg): remove duplicated code
-        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= len(self._roidb):
+        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= _num_samples(self._roidb):
             self._shuffle_roidb_inds()
 
         db_inds = self._perm[self._cur:self._cur + cfg.TRAIN.IMS_PER_BATCH]
@@ -191,6 +205,6 @@ class BlobFetcher(Process):
         print 'BlobFetcher started'
         while True:
             db_inds = self._get_next_minibatch_inds()
-            minibatch_db = [self._roidb[i] for i in db_inds]
+            minibatch_db = _get_minibatch_db(self._roidb, db_inds)
             blobs = get_minibatch(minibatch_db, self._num_classes)
             self._queue.put(blobs)
@@ -11,7 +11,7 @@ import numpy as np
 import numpy.random as npr
 import cv2
 from fast_rcnn.config import cfg
-from utils.blob import prep_im_for_blob, im_list_to_blob
+from utils.blob import resize_im_for_blob, ims_to_blob
 
 def get_minibatch(roidb, num_classes):
     """Given a roidb, construct a minibatch sampled from it."""
@@ -138,13 +138,14 @@ def _get_image_blob(roidb, scale_inds):
         if roidb[i]['flipped']:
             im = im[:, ::-1, :]
         target_size = cfg.TRAIN.SCALES[scale_inds[i]]
-        im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
-                                        cfg.TRAIN.MAX_SIZE, cfg.TRAIN.SCALE_MULTIPLE_OF)
+        im, im_scale = resize_im_for_blob(im, target_size, cfg.TRAIN.MAX_SIZE,
+                                          cfg.TRAIN.SCALE_MULTIPLE_OF)
         im_scales.append(im_scale)
         processed_ims.append(im)
 
-    # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    # Create a blob to hold the input images (subtracting the means on the
+    # fly)
+    blob = ims_to_blob(processed_ims, cfg.PIXEL_MEANS)
 
     return blob, im_scales
 
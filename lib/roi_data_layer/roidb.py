@@ -11,7 +11,10 @@ import numpy as np
 from fast_rcnn.config import cfg
 from fast_rcnn.bbox_transform import bbox_transform
 from utils.cython_bbox import bbox_overlaps
-import PIL
+from datasets.columnar_roidb import ColumnarRoidb
+
+# rows of a columnar gt_overlaps matrix densified at a time
+_DENSE_CHUNK_SIZE = 1 << 16
 
 def prepare_roidb(imdb):
     """Enrich the imdb's roidb by adding some derived quantities that
@@ -20,9 +23,11 @@ def prepare_roidb(imdb):
     each ground-truth box. The class with maximum overlap is also
     recorded.
     """
-    sizes = [PIL.Image.open(imdb.image_path_at(i)).size
-             for i in xrange(imdb.num_images)]
+    sizes = imdb._get_sizes()
     roidb = imdb.roidb
+    if isinstance(roidb, ColumnarRoidb):
+        _prepare_columnar_roidb(imdb, roidb, sizes)
+        return
     for i in xrange(len(imdb.image_index)):
         roidb[i]['image'] = imdb.image_path_at(i)
         roidb[i]['width'] = sizes[i][0]
@@ -43,10 +48,36 @@ def prepare_roidb(imdb):
         nonzero_inds = np.where(max_overlaps > 0)[0]
         assert all(max_classes[nonzero_inds] != 0)
 
+def _prepare_columnar_roidb(imdb, roidb, sizes):
+    """prepare_roidb for a ColumnarRoidb, computed over all boxes at once."""
+    roidb.set_image_column('image', [imdb.image_path_at(i)
+                                     for i in xrange(len(imdb.image_index))])
+    sizes = np.array(sizes, dtype=np.int32).reshape(-1, 2)
+    roidb.set_image_column('width', sizes[:, 0])
+    roidb.set_image_column('height', sizes[:, 1])
+    gt_overlaps = roidb.gt_overlaps
+    max_overlaps = np.zeros(roidb.num_boxes, dtype=gt_overlaps.dtype)
+    max_classes = np.zeros(roidb.num_boxes, dtype=np.int32)
+    # densify in chunks, the sparse argmax loops over the rows in Python
+    for start in xrange(0, roidb.num_boxes, _DENSE_CHUNK_SIZE):
+        stop = min(start + _DENSE_CHUNK_SIZE, roidb.num_boxes)
+        chunk = gt_overlaps[start:stop].toarray()
+        max_overlaps[start:stop] = chunk.max(axis=1)
+        max_classes[start:stop] = chunk.argmax(axis=1)
+    roidb.columns['max_overlaps'] = max_overlaps
+    roidb.columns['max_classes'] = max_classes
+    # sanity checks
+    # max overlap of 0 => class should be zero (background)
+    assert all(max_classes[max_overlaps == 0] == 0)
+    # max overlap > 0 => class should not be zero (must be a fg class)
+    assert all(max_classes[max_overlaps > 0] != 0)
+
 def add_bbox_regression_targets(roidb):
     """Add information needed to train bounding-box regressors."""
     assert len(roidb) > 0
     assert 'max_classes' in roidb[0], 'Did you call prepare_roidb first?'
+    if isinstance(roidb, ColumnarRoidb):
+        return _add_columnar_bbox_regression_targets(roidb)
 
     num_images = len(roidb)
     # Infer number of classes from the number of columns in gt_overlaps
@@ -79,6 +110,10 @@ def add_bbox_regression_targets(roidb):
                     sums[cls, :] += targets[cls_inds, 1:].sum(axis=0)
                     squared_sums[cls, :] += \
                             (targets[cls_inds, 1:] ** 2).sum(axis=0)
+        if cfg.TRAIN.USE_FLIPPED:
+            # the data layer also samples every entry flipped, which negates
+            # its x targets: the x sums cancel, the other moments are the same
+            sums[:, 0] = 0
 
         means = sums / class_counts
         stds = np.sqrt(squared_sums / class_counts - means ** 2)
@@ -106,6 +141,113 @@ def add_bbox_regression_targets(roidb):
     # (the predicts will need to be unnormalized and uncentered)
     return means.ravel(), stds.ravel()
 
+def _add_columnar_bbox_regression_targets(roidb):
+    """add_bbox_regression_targets for a ColumnarRoidb.
+
+    Targets are computed once per stored image; the statistics count every
+    stored image once per entry, with the sign of the x targets of flipped
+    entries reversed. Flipped entries get their normalized x targets back
+    through roidb.bbox_flip_offsets.
+    """
+    num_classes = roidb.gt_overlaps.shape[1]
+    offsets = roidb.offsets
+    targets = np.zeros((roidb.num_boxes, 5), dtype=np.float32)
+    for j in xrange(roidb.num_stored_images):
+        start, stop = offsets[j], offsets[j + 1]
+        targets[start:stop] = _compute_targets(
+            roidb.columns['boxes'][start:stop],
+            roidb.columns['max_overlaps'][start:stop],
+            roidb.columns['max_classes'][start:stop])
+    clss = targets[:, 0].astype(np.int64)
+
+    if cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED:
+        # Use fixed / precomputed "means" and "stds" instead of empirical values
+        means = np.tile(
+                np.array(cfg.TRAIN.BBOX_NORMALIZE_MEANS), (num_classes, 1))
+        stds = np.tile(
+                np.array(cfg.TRAIN.BBOX_NORMALIZE_STDS), (num_classes, 1))
+    else:
+        # Compute values needed for means and stds
+        # var(x) = E(x^2) - E(x)^2
+        num_stored = roidb.num_stored_images
+        num_plain = np.bincount(roidb.image_inds[~roidb.flip],
+                                minlength=num_stored)
+        num_flipped = np.bincount(roidb.image_inds[roidb.flip],
+                                  minlength=num_stored)
+        box_images = roidb.box_image_inds()
+        weights = (num_plain + num_flipped)[box_images]
+        x_weights = (num_plain - num_flipped)[box_images]
+        fg = clss > 0
+        class_counts = np.zeros((num_classes, 1)) + cfg.EPS
+        class_counts[:, 0] += np.bincount(clss[fg], weights[fg],
+                                          minlength=num_classes)
+        sums = np.zeros((num_classes, 4))
+        squared_sums = np.zeros((num_classes, 4))
+        for k in xrange(4):
+            values = targets[fg, k + 1].astype(np.float64)
+            sums[:, k] = np.bincount(
+                clss[fg], (x_weights if k == 0 else weights)[fg] * values,
+                minlength=num_classes)
+            squared_sums[:, k] = np.bincount(
+                clss[fg], weights[fg] * values ** 2, minlength=num_classes)
+        if cfg.TRAIN.USE_FLIPPED:
+            # as for list roidbs, flipped samples cancel the x sums
+            sums[:, 0] = 0
+
+        means = sums / class_counts
+        stds = np.sqrt(squared_sums / class_counts - means ** 2)
+
+    print 'bbox target means:'
+    print means
+    print means[1:, :].mean(axis=0) # ignore bg class
+    print 'bbox target stdevs:'
+    print stds
+    print stds[1:, :].mean(axis=0) # ignore bg class
+
+    # Normalize targets
+    flip_offsets = np.zeros(num_classes)
+    if cfg.TRAIN.BBOX_NORMALIZE_TARGETS:
+        print "Normalizing targets"
+        fg_inds = np.where(clss > 0)[0]
+        targets[fg_inds, 1:] -= means[clss[fg_inds]]
+        targets[fg_inds, 1:] /= stds[clss[fg_inds]]
+        # (-x - mean) / std = -(x - mean) / std - 2 * mean / std
+        flip_offsets[1:] = -2 * means[1:, 0] / stds[1:, 0]
+    else:
+        print "NOT normalizing targets"
+    roidb.columns['bbox_targets'] = targets
+    roidb.bbox_flip_offsets = flip_offsets
+
+    # These values will be needed for making predictions
+    # (the predicts will need to be unnormalized and uncentered)
+    return means.ravel(), stds.ravel()
+
+def flipped_entry(roidb, i):
+    """Entry i of a prepared roidb, flipped horizontally."""
+    if isinstance(roidb, ColumnarRoidb):
+        return roidb.flipped(i)
+    entry = roidb[i]
+    flipped = dict(entry)
+    flipped['flipped'] = not entry['flipped']
+    boxes = entry['boxes'].copy()
+    boxes[:, 0] = entry['width'] - entry['boxes'][:, 2] - 1
+    boxes[:, 2] = entry['width'] - entry['boxes'][:, 0] - 1
+    assert (boxes[:, 2] >= boxes[:, 0]).all()
+    flipped['boxes'] = boxes
+    if 'bbox_targets' in entry:
+        # flipping negates the x target; normalized by mean and std, the
+        # flipped target is -target - 2 * mean / std, where the mean is 0
+        # unless precomputed (see add_bbox_regression_targets)
+        targets = entry['bbox_targets'].copy()
+        targets[:, 1] = -targets[:, 1]
+        if cfg.TRAIN.BBOX_NORMALIZE_TARGETS and \
+                cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED:
+            fg_inds = np.where(targets[:, 0] > 0)[0]
+            targets[fg_inds, 1] -= 2 * cfg.TRAIN.BBOX_NORMALIZE_MEANS[0] / \
+                cfg.TRAIN.BBOX_NORMALIZE_STDS[0]
+        flipped['bbox_targets'] = targets
+    return flipped
+
 def _compute_targets(rois, overlaps, labels):
     """Compute bounding-box regression targets for an image."""
     # Indices of ground-truth ROIs
@@ -0,0 +1,112 @@
+# --------------------------------------------------------
+# Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Cache of shifted anchor grids shared by the RPN layers.
+
+Input images are resized to a multiple of SCALE_MULTIPLE_OF, so only a few
+distinct feature map sizes occur in practice. Rebuilding the (H * W * A, 4)
+shifted anchors for each of them on every forward is wasted work.
+"""
+
+from collections import OrderedDict
+import numpy as np
+from generate_anchors import generate_anchors
+
+class AnchorGridCache(object):
+    """A bounded LRU cache of shifted anchors and inside-image indices."""
+
+    def __init__(self, max_size=32):
+        self._max_size = max_size
+        self._anchors = OrderedDict()
+        self._inside = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, table, key):
+        value = table.pop(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            # re-insert to mark as most recently used
+            table[key] = value
+        return value
+
+    def _store(self, table, key, value):
+        value.setflags(write=False)
+        table[key] = value
+        while len(table) > self._max_size:
+            table.popitem(last=False)
+        return value
+
+    def anchors(self, height, width, feat_stride, scales, ratios):
+        """Return the (height * width * A, 4) shifted anchors of a feature map.
+
+        Rows are ordered by (h, w, a) in slowest to fastest order. The
+        returned array is shared and must not be modified.
+        """
+        key = (height, width, feat_stride, tuple(scales), tuple(ratios))
+        all_anchors = self._lookup(self._anchors, key)
+        if all_anchors is not None:
+            return all_anchors
+
+        base_anchors = generate_anchors(ratios=ratios, scales=np.array(scales))
+
+        # Enumerate all shifts
+        shift_x = np.arange(0, width) * feat_stride
+        shift_y = np.arange(0, height) * feat_stride
+        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
+                            shift_x.ravel(), shift_y.ravel())).transpose()
+
+        # Enumerate all shifted anchors:
+        #
+        # add A anchors (1, A, 4) to
+        # cell K shifts (K, 1, 4) to get
+        # shift anchors (K, A, 4)
+        # reshape to (K*A, 4) shifted anchors
+        A = base_anchors.shape[0]
+        K = shifts.shape[0]
+        all_anchors = (base_anchors.reshape((1, A, 4)) +
+                       shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
+        all_anchors = all_anchors.reshape((K * A, 4))
+        return self._store(self._anchors, key, all_anchors)
+
+    def inside_inds(self, height, width, feat_stride, scales, ratios,
+                    im_height, im_width, allowed_border=0):
+        """Return the indices of the anchors that lie inside the image.
+
+        Anchors may sit over the edge of the image by allowed_border pixels.
+        The returned array is shared and must not be modified.
+        """
+        key = (height, width, feat_stride, tuple(scales), tuple(ratios),
+               im_height, im_width, allowed_border)
+        inds_inside = self._lookup(self._inside, key)
+        if inds_inside is not None:
+            return inds_inside
+
+        all_anchors = self.anchors(height, width, feat_stride, scales, ratios)
+        inds_inside = np.where(
+            (all_anchors[:, 0] >= -allowed_border) &
+            (all_anchors[:, 1] >= -allowed_border) &
+            (all_anchors[:, 2] < im_width + allowed_border) &  # width
+            (all_anchors[:, 3] < im_height + allowed_border)   # height
+        )[0]
+        return self._store(self._inside, key, inds_inside)
+
+    def stats(self):
+        """Return the hit/miss counters and current cache occupancy."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'anchor_grids': len(self._anchors),
+                'inside_masks': len(self._inside)}
+
+    def clear(self):
+        self._anchors.clear()
+        self._inside.clear()
+        self.hits = 0
+        self.misses = 0
+
+# Shared by all RPN layers in the process
+anchor_grid_cache = AnchorGridCache()
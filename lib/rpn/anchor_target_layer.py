@@ -12,11 +12,16 @@ from fast_rcnn.config import cfg
 import numpy as np
 import numpy.random as npr
 from generate_anchors import generate_anchors
-from utils.cython_bbox import bbox_overlaps
+from anchor_grid import anchor_grid_cache
+from utils.cython_bbox import bbox_overlaps, bbox_overlaps_parallel
 from fast_rcnn.bbox_transform import bbox_transform
 
 DEBUG = False
 
+# Below this many anchor x gt pairs, starting the OpenMP threads of
+# bbox_overlaps_parallel costs more than it saves
+PARALLEL_OVERLAPS_MIN_PAIRS = 50000
+
 class AnchorTargetLayer(caffe.Layer):
     """
     Assign anchors to ground-truth targets. Produces anchor classification
@@ -25,9 +30,10 @@ class AnchorTargetLayer(caffe.Layer):
 
     def setup(self, bottom, top):
         layer_params = yaml.load(self.param_str)
-        anchor_scales = layer_params.get('scales', (8, 16, 32))
-        anchor_ratios = layer_params.get('ratios', ((0.5, 1, 2)))
-        self._anchors = generate_anchors(ratios=anchor_ratios, scales=np.array(anchor_scales))
+        self._anchor_scales = tuple(layer_params.get('scales', (8, 16, 32)))
+        self._anchor_ratios = tuple(layer_params.get('ratios', ((0.5, 1, 2))))
+        self._anchors = generate_anchors(ratios=self._anchor_ratios,
+                                         scales=np.array(self._anchor_scales))
         self._num_anchors = self._anchors.shape[0]
         self._feat_stride = layer_params['feat_stride']
 
@@ -91,29 +97,19 @@ class AnchorTargetLayer(caffe.Layer):
             print 'rpn: gt_boxes', gt_boxes
 
         # 1. Generate proposals from bbox deltas and shifted anchors
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                            shift_x.ravel(), shift_y.ravel())).transpose()
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
+        # (shifted anchors and the inside-image indices are cached per
+        # feature map and image size)
         A = self._num_anchors
-        K = shifts.shape[0]
-        all_anchors = (self._anchors.reshape((1, A, 4)) +
-                       shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
-        all_anchors = all_anchors.reshape((K * A, 4))
-        total_anchors = int(K * A)
+        all_anchors = anchor_grid_cache.anchors(
+            height, width, self._feat_stride,
+            self._anchor_scales, self._anchor_ratios)
+        total_anchors = all_anchors.shape[0]
 
         # only keep anchors inside the image
-        inds_inside = np.where(
-            (all_anchors[:, 0] >= -self._allowed_border) &
-            (all_anchors[:, 1] >= -self._allowed_border) &
-            (all_anchors[:, 2] < im_info[1] + self._allowed_border) &  # width
-            (all_anchors[:, 3] < im_info[0] + self._allowed_border)    # height
-        )[0]
+        inds_inside = anchor_grid_cache.inside_inds(
+            height, width, self._feat_stride,
+            self._anchor_scales, self._anchor_ratios,
+            im_info[0], im_info[1], self._allowed_border)
 
         if DEBUG:
             print 'total_anchors', total_anchors
@@ -130,9 +126,13 @@ class AnchorTargetLayer(caffe.Layer):
 
         # overlaps between the anchors and the gt boxes
         # overlaps (ex, gt)
-        overlaps = bbox_overlaps(
-            np.ascontiguousarray(anchors, dtype=np.float),
-            np.ascontiguousarray(gt_boxes, dtype=np.float))
+        anchors_ = np.ascontiguousarray(anchors, dtype=np.float)
+        gt_boxes_ = np.ascontiguousarray(gt_boxes, dtype=np.float)
+        if len(anchors_) * len(gt_boxes_) >= PARALLEL_OVERLAPS_MIN_PAIRS:
+            overlaps = bbox_overlaps_parallel(anchors_, gt_boxes_,
+                                              cfg.CPU_THREADS)
+        else:
+            overlaps = bbox_overlaps(anchors_, gt_boxes_)
         argmax_overlaps = overlaps.argmax(axis=1)
         max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
         gt_argmax_overlaps = overlaps.argmax(axis=0)
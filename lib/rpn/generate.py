@@ -6,7 +6,7 @@
 # --------------------------------------------------------
 
 from fast_rcnn.config import cfg
-from utils.blob import im_list_to_blob
+from utils.blob import resize_im_for_blob, ims_to_blob
 from utils.timer import Timer
 import numpy as np
 import cv2
@@ -55,31 +55,15 @@ def _get_image_blob(im):
         im_scale_factors (list): list of image scales (relative to im) used
             in the image pyramid
     """
-    im_orig = im.astype(np.float32, copy=True)
-    im_orig -= cfg.PIXEL_MEANS
-
-    im_shape = im_orig.shape
-    im_size_min = np.min(im_shape[0:2])
-    im_size_max = np.max(im_shape[0:2])
-
-    processed_ims = []
-
     assert len(cfg.TEST.SCALES) == 1
     target_size = cfg.TEST.SCALES[0]
 
-    im_scale = float(target_size) / float(im_size_min)
-    # Prevent the biggest axis from being more than MAX_SIZE
-    if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
-        im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
-    im_scale_x = np.floor(im.shape[1] * im_scale / cfg.TEST.SCALE_MULTIPLE_OF) * cfg.TEST.SCALE_MULTIPLE_OF / im.shape[1]
-    im_scale_y = np.floor(im.shape[0] * im_scale / cfg.TEST.SCALE_MULTIPLE_OF) * cfg.TEST.SCALE_MULTIPLE_OF / im.shape[0]
-    im = cv2.resize(im_orig, None, None, fx=im_scale_x, fy=im_scale_y,
-                    interpolation=cv2.INTER_LINEAR)
-    im_info = np.hstack((im.shape[:2], np.array([im_scale_x, im_scale_y, im_scale_x, im_scale_y])))[np.newaxis, :]
-    processed_ims.append(im)
+    im, im_scale = resize_im_for_blob(im, target_size, cfg.TEST.MAX_SIZE,
+                                      cfg.TEST.SCALE_MULTIPLE_OF)
+    im_info = np.hstack((im.shape[:2], im_scale))[np.newaxis, :]
 
     # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    blob = ims_to_blob([im], cfg.PIXEL_MEANS)
 
     return blob, im_info
 
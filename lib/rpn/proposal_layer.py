@@ -10,6 +10,7 @@ import numpy as np
 import yaml
 from fast_rcnn.config import cfg
 from generate_anchors import generate_anchors
+from anchor_grid import anchor_grid_cache
 from fast_rcnn.bbox_transform import bbox_transform_inv, clip_boxes
 from fast_rcnn.nms_wrapper import nms
 
@@ -21,14 +22,22 @@ class ProposalLayer(caffe.Layer):
     transformations to a set of regular boxes (called "anchors").
     """
 
+    # Per-detector config set with set_cfg (None: use the global cfg)
+    _cfg = None
+
+    def set_cfg(self, config):
+        """Read the RPN options from config instead of the global cfg."""
+        self._cfg = config
+
     def setup(self, bottom, top):
         # parse the layer parameter string, which must be valid YAML
         layer_params = yaml.load(self.param_str)
 
         self._feat_stride = layer_params['feat_stride']
-        anchor_scales = layer_params.get('scales', (8, 16, 32))
-        anchor_ratios = layer_params.get('ratios', ((0.5, 1, 2)))
-        self._anchors = generate_anchors(ratios=anchor_ratios, scales=np.array(anchor_scales))
+        self._anchor_scales = tuple(layer_params.get('scales', (8, 16, 32)))
+        self._anchor_ratios = tuple(layer_params.get('ratios', ((0.5, 1, 2))))
+        self._anchors = generate_anchors(ratios=self._anchor_ratios,
+                                         scales=np.array(self._anchor_scales))
         self._num_anchors = self._anchors.shape[0]
 
         if DEBUG:
@@ -59,14 +68,12 @@ class ProposalLayer(caffe.Layer):
         # take after_nms_topN proposals after NMS
         # return the top proposals (-> RoIs top, scores top)
 
-        assert bottom[0].data.shape[0] == 1, \
-            'Only single item batches are supported'
-
+        config = self._cfg if self._cfg is not None else cfg
         cfg_key = self.phase # either 'TRAIN' or 'TEST'
         if cfg_key == 0:
-          cfg_ = cfg.TRAIN
+          cfg_ = config.TRAIN
         else:
-          cfg_ = cfg.TEST
+          cfg_ = config.TEST
         pre_nms_topN  = cfg_.RPN_PRE_NMS_TOP_N
         post_nms_topN = cfg_.RPN_POST_NMS_TOP_N
         nms_thresh    = cfg_.RPN_NMS_THRESH
@@ -76,11 +83,7 @@ class ProposalLayer(caffe.Layer):
         # the second set are the fg probs, which we want
         scores = bottom[0].data[:, self._num_anchors:, :, :]
         bbox_deltas = bottom[1].data
-        im_info = bottom[2].data[0, :]
-
-        if DEBUG:
-            print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
-            print 'scale: {}'.format(im_info[2])
+        num_images = scores.shape[0]
 
         # 1. Generate proposals from bbox deltas and shifted anchors
         height, width = scores.shape[-2:]
@@ -88,80 +91,39 @@ class ProposalLayer(caffe.Layer):
         if DEBUG:
             print 'score map size: {}'.format(scores.shape)
 
-        # Enumerate all shifts
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                            shift_x.ravel(), shift_y.ravel())).transpose()
+        # Shifted anchors (K*A, 4) of this feature map size
+        anchors = anchor_grid_cache.anchors(height, width, self._feat_stride,
+                                            self._anchor_scales,
+                                            self._anchor_ratios)
 
-        # Enumerate all shifted anchors:
-        #
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = self._num_anchors
-        K = shifts.shape[0]
-        anchors = self._anchors.reshape((1, A, 4)) + \
-                  shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-        anchors = anchors.reshape((K * A, 4))
-
-        # Transpose and reshape predicted bbox transformations to get them
-        # into the same order as the anchors:
-        #
-        # bbox deltas will be (1, 4 * A, H, W) format
-        # transpose to (1, H, W, 4 * A)
-        # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
-        # in slowest to fastest order
-        bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
+        # Proposals are generated independently for every image in the batch
+        # and tagged with its batch index n
+        blobs = []
+        all_scores = []
+        for n in xrange(num_images):
+            im_info = bottom[2].data[n, :]
 
-        # Same story for the scores:
-        #
-        # scores are (1, A, H, W) format
-        # transpose to (1, H, W, A)
-        # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
-        scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+            if DEBUG:
+                print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
+                print 'scale: {}'.format(im_info[2])
 
-        # Convert anchors into proposals via bbox transformations
-        proposals = bbox_transform_inv(anchors, bbox_deltas)
+            proposals, im_scores = _image_proposals(
+                anchors, scores[n:n + 1], bbox_deltas[n:n + 1], im_info,
+                pre_nms_topN, post_nms_topN, nms_thresh, min_size)
 
-        # 2. clip predicted boxes to image
-        proposals = clip_boxes(proposals, im_info[:2])
-
-        # 3. remove predicted boxes with either height or width < threshold
-        # (NOTE: convert min_size to input image scale stored in im_info[2])
-        keep = _filter_boxes(proposals, min_size * im_info[2])
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # 5. take top pre_nms_topN (e.g. 6000)
-        order = scores.ravel().argsort()[::-1]
-        if pre_nms_topN > 0:
-            order = order[:pre_nms_topN]
-        proposals = proposals[order, :]
-        scores = scores[order]
-
-        # 6. apply nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
-        # 8. return the top proposals (-> RoIs top)
-        keep = nms(np.hstack((proposals, scores)), nms_thresh)
-        if post_nms_topN > 0:
-            keep = keep[:post_nms_topN]
-        proposals = proposals[keep, :]
-        scores = scores[keep]
+            batch_inds = n * np.ones((proposals.shape[0], 1), dtype=np.float32)
+            blobs.append(np.hstack((batch_inds,
+                                    proposals.astype(np.float32, copy=False))))
+            all_scores.append(im_scores)
 
         # Output rois blob
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        batch_inds = np.zeros((proposals.shape[0], 1), dtype=np.float32)
-        blob = np.hstack((batch_inds, proposals.astype(np.float32, copy=False)))
+        blob = np.vstack(blobs)
         top[0].reshape(*(blob.shape))
         top[0].data[...] = blob
 
         # [Optional] output scores blob
         if len(top) > 1:
+            scores = np.vstack(all_scores)
             top[1].reshape(*(scores.shape))
             top[1].data[...] = scores
 
@@ -173,6 +135,114 @@ class ProposalLayer(caffe.Layer):
         """Reshaping happens during the call to forward."""
         pass
 
+def _image_proposals(anchors, scores, bbox_deltas, im_info,
+                     pre_nms_topN, post_nms_topN, nms_thresh, min_size):
+    """Generate the top proposals and their scores for a single image.
+
+    scores is (1, A, H, W) and bbox_deltas is (1, 4 * A, H, W); anchors are
+    the (H * W * A, 4) shifted anchors of the feature map.
+    """
+    proposals, scores = _pre_nms_proposals(anchors, scores, bbox_deltas,
+                                           im_info, pre_nms_topN, min_size)
+
+    # 6. apply nms (e.g. threshold = 0.7)
+    # 7. take after_nms_topN (e.g. 300)
+    # 8. return the top proposals (-> RoIs top)
+    keep = nms(np.hstack((proposals, scores)), nms_thresh)
+    if post_nms_topN > 0:
+        keep = keep[:post_nms_topN]
+    proposals = proposals[keep, :]
+    scores = scores[keep]
+
+    return proposals, scores
+
+def _pre_nms_proposals(anchors, scores, bbox_deltas, im_info,
+                       pre_nms_topN, min_size):
+    """Decode, clip and filter the pre_nms_topN highest scoring anchors."""
+    # Transpose and reshape predicted bbox transformations to get them
+    # into the same order as the anchors:
+    #
+    # bbox deltas will be (1, 4 * A, H, W) format
+    # transpose to (1, H, W, 4 * A)
+    # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
+    # in slowest to fastest order
+    bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
+
+    # Same story for the scores:
+    #
+    # scores are (1, A, H, W) format
+    # transpose to (1, H, W, A)
+    # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
+    scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+
+    # 4. sort all (proposal, score) pairs by score from highest to lowest
+    # 5. take top pre_nms_topN (e.g. 6000)
+    #
+    # Only the top scoring candidates are decoded, clipped and filtered. If
+    # too many of them are removed by the size filter, the candidate pool is
+    # grown until pre_nms_topN proposals survive (or all anchors were used),
+    # which yields exactly the proposals of a full sort of the survivors.
+    num_anchors = scores.shape[0]
+    if pre_nms_topN <= 0 or 4 * pre_nms_topN >= num_anchors:
+        # Small feature maps: decoding every anchor is cheaper than selecting
+        proposals = bbox_transform_inv(anchors, bbox_deltas)
+        proposals = clip_boxes(proposals, im_info[:2])
+        keep = _filter_boxes(proposals, min_size * im_info[2])
+        keep = keep[np.argsort(-scores[keep].ravel(), kind='mergesort')]
+        if pre_nms_topN > 0:
+            keep = keep[:pre_nms_topN]
+        return proposals[keep, :], scores[keep]
+
+    num_candidates = pre_nms_topN
+    proposals = []
+    keep = []
+    num_decoded = 0
+    while True:
+        # the order of a larger pool extends the order of a smaller one, so
+        # only the newly added candidates need to be decoded
+        order = _top_k_order(scores.ravel(), num_candidates)
+        new_inds = order[num_decoded:]
+
+        # Convert anchors into proposals via bbox transformations
+        new_proposals = bbox_transform_inv(anchors[new_inds, :],
+                                           bbox_deltas[new_inds, :])
+
+        # 2. clip predicted boxes to image
+        new_proposals = clip_boxes(new_proposals, im_info[:2])
+
+        # 3. remove predicted boxes with either height or width < threshold
+        # (NOTE: convert min_size to input image scale stored in im_info[2])
+        new_keep = _filter_boxes(new_proposals, min_size * im_info[2])
+        proposals.append(new_proposals[new_keep, :])
+        keep.append(order[num_decoded + new_keep])
+        num_decoded = num_candidates
+
+        num_kept = sum(len(k) for k in keep)
+        if num_candidates == num_anchors or num_kept >= pre_nms_topN:
+            break
+        num_candidates = min(2 * num_candidates, num_anchors)
+
+    proposals = np.vstack(proposals)[:pre_nms_topN, :]
+    scores = scores[np.hstack(keep)[:pre_nms_topN]]
+
+    return proposals, scores
+
+def _top_k_order(scores, k):
+    """Indices of the k highest scores, sorted from highest to lowest.
+
+    Uses a partial selection instead of sorting every score. Ties are broken
+    by position, so the result is the first k entries of a stable descending
+    sort of all scores.
+    """
+    if k >= scores.shape[0]:
+        return np.argsort(-scores, kind='mergesort')
+    kth_score = -np.partition(-scores, k - 1)[k - 1]
+    # candidates are in ascending index order, so the stable sort keeps the
+    # lowest indices first among equal scores
+    inds = np.where(scores >= kth_score)[0]
+    order = inds[np.argsort(-scores[inds], kind='mergesort')]
+    return order[:k]
+
 def _filter_boxes(boxes, min_size):
     """Remove all boxes with any side smaller than min_size."""
     ws = boxes[:, 2] - boxes[:, 0] + 1
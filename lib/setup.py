@@ -113,13 +113,19 @@ ext_modules = [
     Extension(
         "utils.cython_bbox",
         ["utils/bbox.pyx"],
-        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
+        # OpenMP for bbox_overlaps_parallel
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function",
+                                    "-fopenmp"]},
+        extra_link_args=["-fopenmp"],
         include_dirs = [numpy_include]
     ),
     Extension(
         "nms.cpu_nms",
         ["nms/cpu_nms.pyx"],
-        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
+        # OpenMP for cpu_nms_parallel
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function",
+                                    "-fopenmp"]},
+        extra_link_args=["-fopenmp"],
         include_dirs = [numpy_include]
     ),
     Extension('nms.gpu_nms',
@@ -8,6 +8,7 @@
 cimport cython
 import numpy as np
 cimport numpy as np
+from cython.parallel cimport prange
 
 DTYPE = np.float
 ctypedef np.float_t DTYPE_t
@@ -54,6 +55,69 @@ def bbox_overlaps(
                     overlaps[n, k] = iw * ih / ua
     return overlaps
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _overlaps_row(DTYPE_t[:, ::1] boxes,
+                               DTYPE_t[:, ::1] query_boxes,
+                               DTYPE_t[::1] query_areas,
+                               unsigned int n,
+                               DTYPE_t[:, ::1] overlaps) nogil:
+    cdef unsigned int k
+    cdef DTYPE_t iw, ih, ua
+    for k in range(query_boxes.shape[0]):
+        iw = (
+            min(boxes[n, 2], query_boxes[k, 2]) -
+            max(boxes[n, 0], query_boxes[k, 0]) + 1
+        )
+        if iw > 0:
+            ih = (
+                min(boxes[n, 3], query_boxes[k, 3]) -
+                max(boxes[n, 1], query_boxes[k, 1]) + 1
+            )
+            if ih > 0:
+                ua = (
+                    (boxes[n, 2] - boxes[n, 0] + 1) *
+                    (boxes[n, 3] - boxes[n, 1] + 1) +
+                    query_areas[k] - iw * ih
+                )
+                overlaps[n, k] = iw * ih / ua
+
+def bbox_overlaps_parallel(
+        np.ndarray[DTYPE_t, ndim=2] boxes,
+        np.ndarray[DTYPE_t, ndim=2] query_boxes,
+        int num_threads=0):
+    """
+    Multi-threaded (OpenMP) bbox_overlaps; the rows of boxes are split
+    between num_threads threads (<= 0: the OpenMP default).
+
+    Parameters
+    ----------
+    boxes: (N, 4) ndarray of float
+    query_boxes: (K, 4) ndarray of float
+    num_threads: number of threads
+    Returns
+    -------
+    overlaps: (N, K) ndarray of overlap between boxes and query_boxes
+    """
+    cdef unsigned int N = boxes.shape[0]
+    cdef DTYPE_t[:, ::1] boxes_ = np.ascontiguousarray(boxes)
+    cdef DTYPE_t[:, ::1] query_boxes_ = np.ascontiguousarray(query_boxes)
+    cdef DTYPE_t[::1] query_areas = np.ascontiguousarray(
+        (query_boxes[:, 2] - query_boxes[:, 0] + 1) *
+        (query_boxes[:, 3] - query_boxes[:, 1] + 1))
+    overlaps = np.zeros((N, query_boxes.shape[0]), dtype=DTYPE)
+    cdef DTYPE_t[:, ::1] overlaps_ = overlaps
+    cdef unsigned int n
+
+    if num_threads > 0:
+        for n in prange(N, nogil=True, num_threads=num_threads,
+                        schedule='static'):
+            _overlaps_row(boxes_, query_boxes_, query_areas, n, overlaps_)
+    else:
+        for n in prange(N, nogil=True, schedule='static'):
+            _overlaps_row(boxes_, query_boxes_, query_areas, n, overlaps_)
+    return overlaps
+
 # Compute bounding box voting
 def bbox_vote(
         np.ndarray[float, ndim=2] dets_NMS,
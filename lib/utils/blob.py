@@ -10,28 +10,56 @@
 import numpy as np
 import cv2
 
-def im_list_to_blob(ims):
-    """Convert a list of images into a network input.
+class BlobBuffer(object):
+    """A growable float32 buffer that input blobs are written into.
 
-    Assumes images are already prepared (means subtracted, BGR order, ...).
+    Successive blobs reuse the same memory, so a blob obtained from the
+    buffer is only valid until the buffer is used again.
     """
-    max_shape = np.array([im.shape for im in ims]).max(axis=0)
-    num_images = len(ims)
-    blob = np.zeros((num_images, max_shape[0], max_shape[1], 3),
-                    dtype=np.float32)
-    for i in xrange(num_images):
-        im = ims[i]
-        blob[i, 0:im.shape[0], 0:im.shape[1], :] = im
-    # Move channels (axis 3) to axis 1
-    # Axis order will become: (batch elem, channel, height, width)
-    channel_swap = (0, 3, 1, 2)
-    blob = blob.transpose(channel_swap)
+    def __init__(self):
+        self._data = np.zeros((0,), dtype=np.float32)
+
+    def get(self, shape):
+        size = int(np.prod(shape))
+        if size > self._data.size:
+            self._data = np.empty((size,), dtype=np.float32)
+        return self._data[:size].reshape(shape)
+
+def ims_to_blob(ims, pixel_means, out=None, min_shape=None):
+    """Mean subtract raw (e.g. uint8) images while packing them into a
+    contiguous NCHW float32 network input.
+
+    The images are written straight into the blob, which is allocated from
+    out (a BlobBuffer) if given. The blob is zero padded to at least
+    min_shape (height, width) if given.
+    """
+    max_h = max(im.shape[0] for im in ims)
+    max_w = max(im.shape[1] for im in ims)
+    if min_shape is not None:
+        max_h = max(max_h, min_shape[0])
+        max_w = max(max_w, min_shape[1])
+    shape = (len(ims), 3, max_h, max_w)
+    if out is not None:
+        blob = out.get(shape)
+    else:
+        blob = np.empty(shape, dtype=np.float32)
+    pixel_means = np.asarray(pixel_means, dtype=np.float32).ravel()
+    for i, im in enumerate(ims):
+        h, w = im.shape[0:2]
+        for c in xrange(3):
+            np.subtract(im[:, :, c], pixel_means[c], out=blob[i, c, :h, :w],
+                        dtype=np.float32)
+        # zero padding
+        blob[i, :, h:, :] = 0
+        blob[i, :, :h, w:] = 0
     return blob
 
-def prep_im_for_blob(im, pixel_means, target_size, max_size, multiple):
-    """Mean subtract and scale an image for use in a blob."""
-    im = im.astype(np.float32, copy=False)
-    im -= pixel_means
+def resize_im_for_blob(im, target_size, max_size, multiple):
+    """Scale an image (without mean subtraction) for use in a blob.
+
+    Raw uint8 images are resized as such, which is several times cheaper
+    than resizing a float copy of the full resolution image.
+    """
     im_shape = im.shape
     im_size_min = np.min(im_shape[0:2])
     im_size_max = np.max(im_shape[0:2])
@@ -39,6 +67,7 @@ def prep_im_for_blob(im, pixel_means, target_size, max_size, multiple):
     # Prevent the biggest axis from being more than MAX_SIZE
     if np.round(im_scale * im_size_max) > max_size:
         im_scale = float(max_size) / float(im_size_max)
+    # Make width and height be multiples of a specified number
     im_scale_x = np.floor(im.shape[1] * im_scale / multiple) * multiple / im.shape[1]
     im_scale_y = np.floor(im.shape[0] * im_scale / multiple) * multiple / im.shape[0]
     im = cv2.resize(im, None, None, fx=im_scale_x, fy=im_scale_y,
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Check batched_nms against NMS class by class.
+
+Runs batched_nms and the per-class loop test_net used to run (threshold,
+cpu_nms and max_per_image) on synthetic detector outputs with COCO's 81
+classes by default, checks that both keep the same detections, and reports
+their times.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from nms.batched_nms import batched_nms
+from nms.cpu_nms import cpu_nms
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Check batched NMS')
+    parser.add_argument('--proposals', dest='num_proposals',
+                        help='number of proposals per image',
+                        default=150, type=int)
+    parser.add_argument('--classes', dest='num_classes',
+                        help='number of object classes (without background)',
+                        default=80, type=int)
+    parser.add_argument('--thresh', dest='thresh',
+                        help='score threshold (test_net uses 0.01)',
+                        default=0.01, type=float)
+    parser.add_argument('--num_dets', dest='max_per_image',
+                        help='max number of detections per image',
+                        default=100, type=int)
+    parser.add_argument('--iters', dest='iters', help='number of images',
+                        default=40, type=int)
+    args = parser.parse_args()
+    return args
+
+def _synthetic_outputs(num_proposals, num_classes):
+    """Clustered proposals with class scores and per-class boxes."""
+    K = num_classes + 1
+    centers = np.random.rand(num_proposals // 10 + 1, 2) * 1000
+    xy = centers[np.random.randint(0, len(centers), num_proposals)] + \
+        np.random.randn(num_proposals, 2) * 10
+    wh = np.random.rand(num_proposals, 2) * 200 + 20
+    boxes = np.hstack((xy, xy + wh))
+    boxes = np.tile(boxes, (1, K)) + np.random.randn(num_proposals, 4 * K) * 4
+    scores = np.random.dirichlet(np.ones(K) * 0.2, num_proposals)
+    return scores.astype(np.float32), boxes.astype(np.float32)
+
+def _per_class_nms(scores, boxes, score_thresh, nms_thresh, max_per_image):
+    """The former loop over the classes."""
+    dets_list = []
+    labels_list = []
+    for j in xrange(1, scores.shape[1]):
+        inds = np.where(scores[:, j] > score_thresh)[0]
+        cls_dets = np.hstack((boxes[inds, j * 4:(j + 1) * 4],
+                              scores[inds, j, np.newaxis])) \
+            .astype(np.float32, copy=False)
+        keep = cpu_nms(cls_dets, nms_thresh)
+        dets_list.append(cls_dets[keep, :])
+        labels_list.append(np.repeat(j, len(keep)))
+    dets = np.vstack(dets_list)
+    labels = np.hstack(labels_list)
+    if max_per_image > 0 and len(dets) > max_per_image:
+        image_thresh = np.sort(dets[:, -1])[-max_per_image]
+        keep = np.where(dets[:, -1] >= image_thresh)[0]
+        dets = dets[keep, :]
+        labels = labels[keep]
+    return dets, labels
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+
+    images = [_synthetic_outputs(args.num_proposals, args.num_classes)
+              for _ in xrange(args.iters)]
+
+    t_loop, t_batched = Timer(), Timer()
+    num_dets = 0
+    for scores, boxes in images:
+        t_loop.tic()
+        ref_dets, ref_labels = _per_class_nms(
+            scores, boxes, args.thresh, cfg.TEST.NMS, args.max_per_image)
+        t_loop.toc()
+        t_batched.tic()
+        dets, labels = batched_nms(scores, boxes, args.thresh, cfg.TEST.NMS,
+                                   args.max_per_image, nms_func=cpu_nms)
+        t_batched.toc()
+        if not (np.array_equal(labels, ref_labels) and
+                np.array_equal(dets, ref_dets)):
+            print 'Mismatch with the per-class NMS'
+            sys.exit(1)
+        num_dets += len(dets)
+
+    print ('{:d} classes, {:d} proposals ({:.1f} dets per image): '
+           'per class {:.4f}s  batched {:.4f}s  ({:.2f}x)') \
+          .format(args.num_classes + 1, args.num_proposals,
+                  num_dets / float(args.iters), t_loop.average_time,
+                  t_batched.average_time,
+                  t_loop.average_time / t_batched.average_time)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Benchmark box voting.
+
+Votes the NMS survivors of synthetic detector outputs (300 proposals x 20
+classes by default), as batched_nms passes them to the vote function (all
+classes of an image at once), with the per-detection loop that
+fast_rcnn.test.bbox_vote used to run and with the vectorized version, for
+each BBOX_VOTE_N_WEIGHTED_SCORE setting of the PVANet presets, and checks
+that both agree.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg, freeze_cfg
+from fast_rcnn.test import bbox_vote
+from nms.batched_nms import batched_nms
+from nms.cpu_nms import cpu_nms
+from utils.cython_bbox import bbox_overlaps
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark box voting')
+    parser.add_argument('--proposals', dest='num_proposals',
+                        help='number of proposals per image',
+                        default=300, type=int)
+    parser.add_argument('--classes', dest='num_classes',
+                        help='number of object classes (without background)',
+                        default=20, type=int)
+    parser.add_argument('--thresh', dest='thresh', help='score threshold',
+                        default=0.003, type=float)
+    parser.add_argument('--iters', dest='iters', help='number of images',
+                        default=20, type=int)
+    args = parser.parse_args()
+    return args
+
+def _reference_bbox_vote(dets_NMS, dets_all, thresh=0.5, config=cfg):
+    """The former per-detection loop."""
+    dets_voted = np.zeros_like(dets_NMS)
+
+    _overlaps = bbox_overlaps(
+        np.ascontiguousarray(dets_NMS[:, 0:4], dtype=np.float),
+        np.ascontiguousarray(dets_all[:, 0:4], dtype=np.float))
+
+    for i, det in enumerate(dets_NMS):
+        dets_overlapped = dets_all[np.where(_overlaps[i, :] >= thresh)[0]]
+        boxes = dets_overlapped[:, 0:4]
+        scores = dets_overlapped[:, 4]
+
+        dets_voted[i][0:4] = np.dot(scores, boxes) / sum(scores)
+        dets_voted[i][4] = det[4]
+
+        if config.TEST.BBOX_VOTE_N_WEIGHTED_SCORE > 1:
+            n_agreement = config.TEST.BBOX_VOTE_N_WEIGHTED_SCORE
+            w_empty = config.TEST.BBOX_VOTE_WEIGHT_EMPTY
+            n_detected = len(scores)
+            if n_detected >= n_agreement:
+                new_score = np.average(-np.sort(-scores)[:n_agreement])
+            else:
+                new_score = np.average(scores) * \
+                    (n_detected * 1.0 + (n_agreement - n_detected) * w_empty) / n_agreement
+            dets_voted[i][4] = min(new_score, dets_voted[i][4])
+
+    return dets_voted
+
+def _synthetic_outputs(num_proposals, num_classes):
+    """Clustered proposals with class scores and per-class boxes."""
+    K = num_classes + 1
+    centers = np.random.rand(num_proposals // 10 + 1, 2) * 800
+    xy = centers[np.random.randint(0, len(centers), num_proposals)] + \
+        np.random.randn(num_proposals, 2) * 10
+    wh = np.random.rand(num_proposals, 2) * 200 + 20
+    boxes = np.hstack((xy, xy + wh))
+    boxes = np.tile(boxes, (1, K)) + np.random.randn(num_proposals, 4 * K) * 4
+    scores = np.random.dirichlet(np.ones(K) * 0.2, num_proposals)
+    return scores.astype(np.float32), boxes.astype(np.float32)
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+
+    images = [_synthetic_outputs(args.num_proposals, args.num_classes)
+              for _ in xrange(args.iters)]
+
+    # the NMS survivors and all candidates of every image, with the classes
+    # offset apart as batched_nms passes them
+    vote_inputs = []
+    def _capture(dets_NMS, dets_all):
+        vote_inputs.append((dets_NMS.copy(), dets_all.copy()))
+        return dets_NMS
+    for scores, boxes in images:
+        batched_nms(scores, boxes, args.thresh, cfg.TEST.NMS,
+                    nms_func=cpu_nms, vote_func=_capture)
+
+    for n_agreement in (1, 5):
+        config = freeze_cfg({'TEST': {'BBOX_VOTE_N_WEIGHTED_SCORE': n_agreement,
+                                      'BBOX_VOTE_WEIGHT_EMPTY': 0.3}})
+        t_loop, t_vec = Timer(), Timer()
+        max_diff = 0
+        for dets_NMS, dets_all in vote_inputs:
+            t_loop.tic()
+            ref = _reference_bbox_vote(dets_NMS, dets_all, config=config)
+            t_loop.toc()
+            t_vec.tic()
+            dets = bbox_vote(dets_NMS, dets_all, config=config)
+            t_vec.toc()
+            if not np.allclose(ref, dets, rtol=1e-6, atol=1e-6):
+                print 'Mismatch with BBOX_VOTE_N_WEIGHTED_SCORE {}'.format(n_agreement)
+                sys.exit(1)
+            max_diff = max(max_diff, np.abs(ref - dets).max())
+
+        print ('N = {:d} ({:.0f} dets, {:.0f} candidates per image): '
+               'loop {:.4f}s  vectorized {:.4f}s  ({:.2f}x, max diff {:.2g})') \
+              .format(n_agreement,
+                      np.mean([len(d) for d, _ in vote_inputs]),
+                      np.mean([len(d) for _, d in vote_inputs]),
+                      t_loop.average_time, t_vec.average_time,
+                      t_loop.average_time / t_vec.average_time, max_diff)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Benchmark the OpenMP CPU kernels against the serial ones.
+
+Compares cpu_nms with cpu_nms_parallel on RPN sized sets of proposals, and
+bbox_overlaps with bbox_overlaps_parallel on anchors x gt boxes (the overlap
+matrix of AnchorTargetLayer, see PARALLEL_OVERLAPS_MIN_PAIRS), for each
+number of threads, and checks that the results are identical.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from rpn.anchor_grid import anchor_grid_cache
+from nms.cpu_nms import cpu_nms, cpu_nms_parallel
+from utils.cython_bbox import bbox_overlaps, bbox_overlaps_parallel
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark OpenMP CPU kernels')
+    parser.add_argument('--boxes', dest='num_boxes', help='numbers of boxes',
+                        default=[2000, 6000, 12000, 18000], type=int, nargs='+')
+    parser.add_argument('--threads', dest='threads',
+                        help='numbers of threads to try',
+                        default=[1, 2, 4, 8], type=int, nargs='+')
+    parser.add_argument('--gt', dest='num_gt',
+                        help='numbers of gt boxes of the overlaps',
+                        default=[1, 5, 20], type=int, nargs='+')
+    parser.add_argument('--nms', dest='nms_thresh', help='NMS threshold',
+                        default=0.7, type=float)
+    parser.add_argument('--iters', dest='iters', help='iterations per size',
+                        default=3, type=int)
+    args = parser.parse_args()
+    return args
+
+def _proposals(num_boxes):
+    """Jittered PVANet anchors of a 1056 x 640 image, sorted by score."""
+    anchors = anchor_grid_cache.anchors(40, 66, 16, (2, 3, 5, 9, 16, 32),
+                                        (0.333, 0.5, 0.667, 1, 1.5, 2, 3))
+    inds = np.random.choice(anchors.shape[0], num_boxes,
+                            replace=num_boxes > anchors.shape[0])
+    boxes = anchors[inds] + np.random.randn(num_boxes, 4) * 8
+    boxes[:, 2:] = np.maximum(boxes[:, 2:], boxes[:, :2])
+    scores = np.sort(np.random.rand(num_boxes))[::-1]
+    return np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32)
+
+def _time(func, iters):
+    timer = Timer()
+    for _ in xrange(iters):
+        timer.tic()
+        result = func()
+        timer.toc()
+    return result, timer.average_time
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+
+    for num_boxes in args.num_boxes:
+        dets = _proposals(num_boxes)
+        ref, t_ref = _time(lambda: cpu_nms(dets, args.nms_thresh), args.iters)
+        line = 'nms {:6d} boxes: serial {:.4f}s'.format(num_boxes, t_ref)
+        for num_threads in args.threads:
+            keep, t = _time(lambda: cpu_nms_parallel(dets, args.nms_thresh,
+                                                     num_threads), args.iters)
+            if keep != ref:
+                print 'NMS mismatch with {} boxes'.format(num_boxes)
+                sys.exit(1)
+            line += '  {:d} threads {:.4f}s ({:.2f}x)'.format(
+                num_threads, t, t_ref / t)
+        print line
+
+    for num_boxes in args.num_boxes:
+        boxes = _proposals(num_boxes)[:, :4].astype(np.float)
+        for num_gt in args.num_gt:
+            query_boxes = _proposals(num_gt)[:, :4].astype(np.float)
+            ref, t_ref = _time(lambda: bbox_overlaps(boxes, query_boxes),
+                               args.iters)
+            line = 'overlaps {:6d} x {:3d}: serial {:.5f}s'.format(
+                num_boxes, num_gt, t_ref)
+            for num_threads in args.threads:
+                overlaps, t = _time(lambda: bbox_overlaps_parallel(
+                    boxes, query_boxes, num_threads), args.iters)
+                if not np.array_equal(overlaps, ref):
+                    print 'Overlaps mismatch with {} x {} boxes'.format(
+                        num_boxes, num_gt)
+                    sys.exit(1)
+                line += '  {:d} threads {:.5f}s ({:.2f}x)'.format(
+                    num_threads, t, t_ref / t)
+            print line
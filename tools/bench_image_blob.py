@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Benchmark test-time input blob preparation.
+
+Compares the float path (convert the full resolution image to float32,
+subtract the means, resize, pack into NHWC and transpose) against resizing
+the uint8 image and subtracting the means while writing into a reused NCHW
+buffer. Reports time, temporary bytes allocated per image and the largest
+pixel difference between the two blobs.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from utils.blob import BlobBuffer, ims_to_blob, resize_im_for_blob
+from utils.timer import Timer
+import argparse
+import numpy as np
+import cv2
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark input blob preparation')
+    parser.add_argument('--sizes', dest='sizes', help='shorter image sides',
+                        default=[608, 1008, 1504, 2000], type=int, nargs='+')
+    parser.add_argument('--iters', dest='iters', help='iterations per size',
+                        default=10, type=int)
+    args = parser.parse_args()
+    return args
+
+def _float_blob(im, target_size, max_size, multiple):
+    """The float path, returning the blob and its temporary bytes."""
+    im_orig = im.astype(np.float32, copy=True)
+    im_orig -= cfg.PIXEL_MEANS
+    im_resized, _ = resize_im_for_blob(im_orig, target_size, max_size, multiple)
+    blob = np.zeros((1, im_resized.shape[0], im_resized.shape[1], 3),
+                    dtype=np.float32)
+    blob[0] = im_resized
+    # caffe copies the non-contiguous transposed view once more
+    blob = np.ascontiguousarray(blob.transpose((0, 3, 1, 2)))
+    nbytes = im_orig.nbytes + im_resized.nbytes + 2 * blob.nbytes
+    return blob, nbytes
+
+def _uint8_blob(im, target_size, max_size, multiple, out):
+    """The fused path, returning the blob and its temporary bytes."""
+    im_resized, _ = resize_im_for_blob(im, target_size, max_size, multiple)
+    blob = ims_to_blob([im_resized], cfg.PIXEL_MEANS, out=out)
+    return blob, im_resized.nbytes
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+
+    max_size = 2000
+    multiple = 32
+    # a camera sized source image; smooth so that resizing is realistic
+    im = np.random.randint(0, 256, (375, 500, 3)).astype(np.uint8)
+    im = cv2.resize(im, (3000, 2250), interpolation=cv2.INTER_LINEAR)
+
+    out = BlobBuffer()
+    for size in args.sizes:
+        t_float, t_uint8 = Timer(), Timer()
+        for _ in xrange(args.iters):
+            t_float.tic()
+            ref, ref_bytes = _float_blob(im, size, max_size, multiple)
+            t_float.toc()
+            t_uint8.tic()
+            blob, blob_bytes = _uint8_blob(im, size, max_size, multiple, out)
+            t_uint8.toc()
+        assert ref.shape == blob.shape and blob.flags['C_CONTIGUOUS']
+        print ('{:5d}px {}: float {:.4f}s {:6.1f}MB  uint8 {:.4f}s {:6.1f}MB  '
+               '({:.2f}x, max diff {:.2f})') \
+              .format(size, blob.shape[2:], t_float.average_time,
+                      ref_bytes / 1e6, t_uint8.average_time, blob_bytes / 1e6,
+                      t_float.average_time / t_uint8.average_time,
+                      np.abs(ref - blob).max())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Micro-benchmark the top-k candidate selection of the proposal layer.
+
+Compares the full decode + sort of every anchor against the partial
+selection used by rpn.proposal_layer on synthetic RPN outputs, and checks
+that both produce identical pre-NMS proposals.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from fast_rcnn.bbox_transform import bbox_transform_inv, clip_boxes
+from rpn.anchor_grid import anchor_grid_cache
+from rpn.proposal_layer import _pre_nms_proposals, _filter_boxes
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark proposal top-k selection')
+    parser.add_argument('--sizes', dest='sizes', help='longest image sides',
+                        default=[608, 1008, 1504, 2000], type=int, nargs='+')
+    parser.add_argument('--pre_nms', dest='pre_nms_topN',
+                        help='number of proposals kept before NMS',
+                        default=12000, type=int)
+    parser.add_argument('--iters', dest='iters', help='iterations per size',
+                        default=10, type=int)
+    args = parser.parse_args()
+    return args
+
+def _reference_proposals(anchors, scores, bbox_deltas, im_info,
+                         pre_nms_topN, min_size):
+    """Decode and sort every anchor (ties broken by anchor position)."""
+    bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
+    scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+    proposals = bbox_transform_inv(anchors, bbox_deltas)
+    proposals = clip_boxes(proposals, im_info[:2])
+    keep = _filter_boxes(proposals, min_size * im_info[2])
+    proposals = proposals[keep, :]
+    scores = scores[keep]
+    order = np.argsort(-scores.ravel(), kind='mergesort')
+    if pre_nms_topN > 0:
+        order = order[:pre_nms_topN]
+    proposals = proposals[order, :]
+    scores = scores[order]
+    return proposals, scores
+
+def _synthetic_inputs(height, width, feat_stride, scales, ratios):
+    all_anchors = anchor_grid_cache.anchors(height, width, feat_stride,
+                                            scales, ratios)
+    A = len(scales) * len(ratios)
+    scores = np.random.rand(1, A, height, width).astype(np.float32)
+    # saturated scores produce ties, as with a trained RPN
+    scores[scores > 0.999] = 1.0
+    bbox_deltas = 0.1 * np.random.randn(1, 4 * A, height, width) \
+        .astype(np.float32)
+    return all_anchors, scores, bbox_deltas
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+
+    feat_stride = 16
+    scales = (2, 3, 5, 9, 16, 32)
+    ratios = (0.333, 0.5, 0.667, 1, 1.5, 2, 3)
+
+    for size in args.sizes:
+        im_h = int(size * 0.56) // 32 * 32
+        im_w = size // 32 * 32
+        height, width = im_h // feat_stride, im_w // feat_stride
+        im_info = np.array([im_h, im_w, 1.0], dtype=np.float32)
+        all_anchors, scores, bbox_deltas = \
+            _synthetic_inputs(height, width, feat_stride, scales, ratios)
+        params = (args.pre_nms_topN, cfg.TEST.RPN_MIN_SIZE)
+
+        t_full, t_topk = Timer(), Timer()
+        for _ in xrange(args.iters):
+            t_full.tic()
+            ref = _reference_proposals(all_anchors, scores, bbox_deltas,
+                                       im_info, *params)
+            t_full.toc()
+            t_topk.tic()
+            out = _pre_nms_proposals(all_anchors, scores, bbox_deltas,
+                                   im_info, *params)
+            t_topk.toc()
+            if not (np.array_equal(ref[0], out[0]) and
+                    np.array_equal(ref[1], out[1])):
+                print 'Mismatch at size {}'.format(size)
+                sys.exit(1)
+
+        print '{:5d}px ({:7d} anchors): full {:.4f}s  top-k {:.4f}s  ({:.2f}x)' \
+              .format(size, all_anchors.shape[0], t_full.average_time,
+                      t_topk.average_time,
+                      t_full.average_time / t_topk.average_time)
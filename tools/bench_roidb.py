@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Benchmark the columnar roidb against the list of dicts.
+
+Builds the training roidb of a synthetic image database (ground truth plus
+proposals, prepared and with regression targets) in both formats, checks
+that every entry and its flipped version agree, and reports their memory, build time, time
+to save and load them (cPickle for the list, .npz for the columnar roidb)
+and time to read the fields of random entries.
+
+It also times a start from the roidb cache of the dataset (written and read
+by imdb._save_roidb_cache and imdb._load_roidb_cache): the pickled list, the
+pickled list compacted as TRAIN.COLUMNAR_ROIDB used to, and the .npz cache
+of TRAIN.COLUMNAR_ROIDB. The files are in the page cache, so the times are
+those of decoding them.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from datasets.imdb import imdb
+from datasets.columnar_roidb import ColumnarRoidb
+import roi_data_layer.roidb as rdl_roidb
+from roi_data_layer.roidb import flipped_entry
+from utils.timer import Timer
+import argparse
+import cPickle
+import numpy as np
+import os
+import scipy.sparse
+import shutil
+import sys
+import tempfile
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark roidb formats')
+    parser.add_argument('--images', dest='num_images', help='number of images',
+                        default=2000, type=int)
+    parser.add_argument('--proposals', dest='num_proposals',
+                        help='number of proposals per image',
+                        default=2000, type=int)
+    parser.add_argument('--classes', dest='num_classes',
+                        help='number of object classes (without background)',
+                        default=20, type=int)
+    parser.add_argument('--samples', dest='num_samples',
+                        help='number of entries to read',
+                        default=2000, type=int)
+    args = parser.parse_args()
+    return args
+
+class _synthetic(imdb):
+    """Random images with up to 10 objects and jittered proposals."""
+
+    def __init__(self, num_images, num_proposals, num_classes):
+        imdb.__init__(self, 'synthetic')
+        self._classes = ['__background__'] + \
+            ['class{}'.format(i) for i in xrange(num_classes)]
+        self._image_index = range(num_images)
+        self._num_proposals = num_proposals
+        rng = np.random.RandomState(cfg.RNG_SEED)
+        self._sizes = [(int(w), int(h)) for w, h in
+                       rng.randint(300, 1000, (num_images, 2))]
+        self._roidb_handler = self._proposals_roidb
+
+    def image_path_at(self, i):
+        return 'synthetic/{:06d}.jpg'.format(self._image_index[i])
+
+    def _get_sizes(self):
+        return [self._sizes[index] for index in self._image_index]
+
+    def _get_widths(self):
+        return [size[0] for size in self._get_sizes()]
+
+    def _random_boxes(self, rng, width, height, num_boxes):
+        xy = rng.rand(num_boxes, 2) * (width * 0.8, height * 0.8)
+        wh = rng.rand(num_boxes, 2) * (width * 0.5, height * 0.5) + 8
+        boxes = np.hstack((xy, np.minimum(xy + wh, (width - 1, height - 1))))
+        return boxes.astype(np.uint16)
+
+    def _proposals_roidb(self):
+        rng = np.random.RandomState(cfg.RNG_SEED)
+        gt_roidb = []
+        box_list = []
+        for width, height in self._sizes:
+            num_objs = rng.randint(1, 11)
+            boxes = self._random_boxes(rng, width, height, num_objs)
+            gt_classes = rng.randint(1, self.num_classes,
+                                     num_objs).astype(np.int32)
+            overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
+            overlaps[np.arange(num_objs), gt_classes] = 1.0
+            seg_areas = ((boxes[:, 2] - boxes[:, 0] + 1.0) *
+                         (boxes[:, 3] - boxes[:, 1] + 1.0)).astype(np.float32)
+            gt_roidb.append({'boxes' : boxes,
+                             'gt_classes': gt_classes,
+                             'gt_overlaps' : scipy.sparse.csr_matrix(overlaps),
+                             'flipped' : False,
+                             'seg_areas' : seg_areas})
+            # proposals jittered around the objects and spread at random
+            near = boxes[rng.randint(0, num_objs, self._num_proposals // 2)]
+            near = near + rng.randn(len(near), 4) * 16
+            near[:, 2:] = np.maximum(near[:, 2:], near[:, :2])
+            near = np.clip(near, 0, (width - 1, height - 1) * 2)
+            far = self._random_boxes(rng, width, height,
+                                     self._num_proposals - len(near))
+            box_list.append(np.vstack((near, far)).astype(np.uint16))
+        return imdb.merge_roidbs(gt_roidb,
+                                 self.create_roidb_from_box_list(box_list,
+                                                                 gt_roidb))
+
+def _deep_size(obj, seen=None):
+    """Bytes held by a roidb of either format, counting shared objects
+    once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if hasattr(obj, 'nbytes') and callable(obj.nbytes):
+        return obj.nbytes() + sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        # getsizeof includes the data of arrays that own it
+        return sys.getsizeof(obj) + (obj.nbytes if obj.base is not None else 0)
+    if scipy.sparse.issparse(obj):
+        return sys.getsizeof(obj) + sys.getsizeof(obj.__dict__) + \
+            sum(_deep_size(a, seen)
+                for a in (obj.data, obj.indices, obj.indptr))
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_deep_size(k, seen) +
+                                        _deep_size(v, seen)
+                                        for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return sys.getsizeof(obj) + sum(_deep_size(v, seen) for v in obj)
+    return sys.getsizeof(obj)
+
+def _training_roidb(columnar, args):
+    """The roidb train_net would train on, and the time to build it."""
+    timer = Timer()
+    timer.tic()
+    db = _synthetic(args.num_images, args.num_proposals, args.num_classes)
+    db.roidb
+    if columnar:
+        db.compact_roidb()
+    rdl_roidb.prepare_roidb(db)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        rdl_roidb.add_bbox_regression_targets(db.roidb)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    timer.toc()
+    return db.roidb, timer.average_time
+
+def _check_entries(roidb, columnar_roidb):
+    assert len(roidb) == len(columnar_roidb)
+    for i in xrange(len(roidb)):
+        for entry, view in ((roidb[i], columnar_roidb[i]),
+                            (flipped_entry(roidb, i),
+                             flipped_entry(columnar_roidb, i))):
+            for key in ('flipped', 'image', 'width', 'height'):
+                assert entry[key] == view[key], key
+            for key in ('boxes', 'gt_classes', 'seg_areas', 'max_classes',
+                        'max_overlaps', 'bbox_targets'):
+                assert np.allclose(entry[key], view[key],
+                                   rtol=1e-5, atol=1e-5), key
+            assert (entry['gt_overlaps'] != view['gt_overlaps']).nnz == 0
+
+def _time_save_load(roidb, columnar):
+    fd, filename = tempfile.mkstemp(suffix='.npz' if columnar else '.pkl')
+    os.close(fd)
+    try:
+        save_timer, load_timer = Timer(), Timer()
+        save_timer.tic()
+        if columnar:
+            roidb.save(filename)
+        else:
+            with open(filename, 'wb') as fid:
+                cPickle.dump(roidb, fid, cPickle.HIGHEST_PROTOCOL)
+        save_timer.toc()
+        load_timer.tic()
+        if columnar:
+            roidb = roidb.load(filename)
+        else:
+            with open(filename, 'rb') as fid:
+                roidb = cPickle.load(fid)
+        load_timer.toc()
+        return (os.path.getsize(filename), save_timer.average_time,
+                load_timer.average_time)
+    finally:
+        os.remove(filename)
+
+def _time_cache_start(db):
+    """File size and time from the roidb cache of db to its roidb, for
+    each kind of cache."""
+    cache_dir = tempfile.mkdtemp()
+    try:
+        results = []
+        for name, ext, compact in (('pickle', '.pkl', False),
+                                   ('pickle+compact', '.pkl', True),
+                                   ('npz', '.npz', False)):
+            cache_file = os.path.join(cache_dir, 'roidb' + ext)
+            if not os.path.exists(cache_file):
+                imdb._save_roidb_cache(db.roidb, cache_file)
+            timer = Timer()
+            timer.tic()
+            roidb = imdb._load_roidb_cache(cache_file)
+            if compact:
+                roidb = ColumnarRoidb.from_roidb(roidb)
+            timer.toc()
+            results.append((name, os.path.getsize(cache_file),
+                            timer.average_time))
+        return results
+    finally:
+        shutil.rmtree(cache_dir)
+
+def _time_access(roidb, inds):
+    """Time to read the fields minibatch sampling reads from entries."""
+    timer = Timer()
+    timer.tic()
+    for i in inds:
+        entry = roidb[i]
+        for key in ('image', 'flipped', 'boxes', 'gt_classes', 'max_classes',
+                    'max_overlaps', 'bbox_targets'):
+            entry[key]
+    timer.toc()
+    return timer.average_time
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    roidb, t_list = _training_roidb(False, args)
+    columnar_roidb, t_columnar = _training_roidb(True, args)
+    _check_entries(roidb, columnar_roidb)
+    inds = np.random.RandomState(cfg.RNG_SEED).randint(
+        0, len(roidb), args.num_samples)
+
+    print '{:d} entries, {:d} boxes per image'.format(
+        len(roidb), columnar_roidb.num_boxes // columnar_roidb.num_stored_images)
+    print '{:>10s} {:>10s} {:>8s} {:>10s} {:>8s} {:>8s} {:>8s}'.format(
+        'format', 'memory', 'build', 'file', 'save', 'load', 'access')
+    for name, db, t_build in (('list', roidb, t_list),
+                              ('columnar', columnar_roidb, t_columnar)):
+        size, t_save, t_load = _time_save_load(db, name == 'columnar')
+        t_access = _time_access(db, inds)
+        print '{:>10s} {:8.1f}MB {:7.2f}s {:8.1f}MB {:7.2f}s {:7.2f}s {:7.2f}s'.format(
+            name, _deep_size(db) / 2. ** 20, t_build, size / 2. ** 20, t_save,
+            t_load, t_access)
+
+    print '{:>16s} {:>10s} {:>8s}'.format('cache', 'file', 'start')
+    db = _synthetic(args.num_images, args.num_proposals, args.num_classes)
+    for name, size, t_start in _time_cache_start(db):
+        print '{:>16s} {:8.1f}MB {:7.2f}s'.format(name, size / 2. ** 20,
+                                                   t_start)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Calibrate the automatic NMS dispatch on this machine.
+
+Times the Python, Cython serial, Cython parallel and (with USE_GPU_NMS) GPU
+NMS implementations on synthetic detections, caches the timings for
+cfg.NMS_BACKEND = 'auto' and prints the implementation chosen for each size.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from fast_rcnn.nms_wrapper import nms_dispatcher
+import argparse
+import pprint
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Calibrate NMS dispatch')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+    parser.add_argument('--nms', dest='nms_thresh', help='NMS threshold',
+                        default=0.7, type=float)
+    parser.add_argument('--iters', dest='iters', help='iterations per size',
+                        default=3, type=int)
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    print 'Using config:'
+    pprint.pprint(cfg)
+
+    timings = nms_dispatcher.calibrate(args.nms_thresh, args.iters)
+    names = sorted(timings)
+    print 'Saved timings to {}'.format(nms_dispatcher.cache_file)
+    print '{:>6s} '.format('boxes') + \
+        ''.join('{:>14s}'.format(name) for name in names) + '  choice'
+    for i, num_boxes in enumerate(nms_dispatcher.SIZES):
+        print '{:6d} '.format(num_boxes) + \
+            ''.join('{:13.5f}s'.format(timings[name][i]) for name in names) + \
+            '  ' + nms_dispatcher.backend_for(num_boxes)
@@ -20,6 +20,15 @@ def parse_args():
                         default='selective_search', type=str)
     parser.add_argument('--rpn-file', dest='rpn_file',
                         default=None, type=str)
+    parser.add_argument('--areas', dest='areas',
+                        help='gt area ranges (all, small, medium, large, ...)',
+                        default=['all'], nargs='+', type=str)
+    parser.add_argument('--limits', dest='limits',
+                        help='numbers of proposals per image (0 for all)',
+                        default=[0], nargs='+', type=int)
+    parser.add_argument('--workers', dest='num_workers',
+                        help='number of processes matching the images',
+                        default=1, type=int)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -46,25 +55,34 @@ if __name__ == '__main__':
         raw_data = sio.loadmat(filename)['aboxes'].ravel()
         candidate_boxes = raw_data
 
-    ar, gt_overlaps, recalls, thresholds = \
-        imdb.evaluate_recall(candidate_boxes=candidate_boxes)
+    limits = [limit or None for limit in args.limits]
+    all_results = imdb.evaluate_recalls(candidate_boxes=candidate_boxes,
+                                        areas=args.areas, limits=limits,
+                                        num_workers=args.num_workers)
     print 'Method: {}'.format(args.method)
-    print 'AverageRec: {:.3f}'.format(ar)
+    for area in args.areas:
+        for limit in limits:
+            results = all_results[area, limit]
+            ar = results['ar']
+            recalls = results['recalls']
+            thresholds = results['thresholds']
 
-    def recall_at(t):
-        ind = np.where(thresholds > t - 1e-5)[0][0]
-        assert np.isclose(thresholds[ind], t)
-        return recalls[ind]
+            def recall_at(t):
+                ind = np.where(thresholds > t - 1e-5)[0][0]
+                assert np.isclose(thresholds[ind], t)
+                return recalls[ind]
 
-    print 'Recall@0.5: {:.3f}'.format(recall_at(0.5))
-    print 'Recall@0.6: {:.3f}'.format(recall_at(0.6))
-    print 'Recall@0.7: {:.3f}'.format(recall_at(0.7))
-    print 'Recall@0.8: {:.3f}'.format(recall_at(0.8))
-    print 'Recall@0.9: {:.3f}'.format(recall_at(0.9))
-    # print again for easy spreadsheet copying
-    print '{:.3f}'.format(ar)
-    print '{:.3f}'.format(recall_at(0.5))
-    print '{:.3f}'.format(recall_at(0.6))
-    print '{:.3f}'.format(recall_at(0.7))
-    print '{:.3f}'.format(recall_at(0.8))
-    print '{:.3f}'.format(recall_at(0.9))
+            print 'Area: {}  Proposals: {}'.format(area, limit or 'all')
+            print 'AverageRec: {:.3f}'.format(ar)
+            print 'Recall@0.5: {:.3f}'.format(recall_at(0.5))
+            print 'Recall@0.6: {:.3f}'.format(recall_at(0.6))
+            print 'Recall@0.7: {:.3f}'.format(recall_at(0.7))
+            print 'Recall@0.8: {:.3f}'.format(recall_at(0.8))
+            print 'Recall@0.9: {:.3f}'.format(recall_at(0.9))
+            # print again for easy spreadsheet copying
+            print '{:.3f}'.format(ar)
+            print '{:.3f}'.format(recall_at(0.5))
+            print '{:.3f}'.format(recall_at(0.6))
+            print '{:.3f}'.format(recall_at(0.7))
+            print '{:.3f}'.format(recall_at(0.8))
+            print '{:.3f}'.format(recall_at(0.9))
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Faster R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Long-lived PVANet detection server.
+
+Images are POSTed (encoded as JPEG, PNG, ...) to /detect over HTTP or a
+Unix socket. Requests are queued and grouped into micro-batches of up to
+--batch images, waiting at most --max_wait ms for a batch to fill. Batches
+are processed by worker processes that each hold a warmed up PVANet. All
+--presets are served by the same net in each worker; a request picks one
+with ?preset=NAME (default: the first).
+
+Detections are returned as an N x 6 array of (cls, x1, y1, x2, y2, score),
+either as JSON (default) or as raw little-endian float32 bytes when the
+request asks for ?format=binary or Accept: application/octet-stream.
+
+    curl --data-binary @data/demo/000456.jpg http://localhost:8000/detect
+    curl --unix-socket /tmp/pvanet.sock --data-binary @im.jpg http://x/detect
+"""
+
+import _init_paths
+from test_pvanet import PVANet
+import argparse
+import BaseHTTPServer
+import SocketServer
+import Queue
+import multiprocessing
+import threading
+import itertools
+import urlparse
+import json
+import os
+import sys
+import time
+import traceback
+import numpy as np
+import cv2
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='PVANet detection server')
+    parser.add_argument('--host', dest='host', help='address to listen on',
+                        default='127.0.0.1', type=str)
+    parser.add_argument('--port', dest='port', help='port to listen on',
+                        default=8000, type=int)
+    parser.add_argument('--unix', dest='unix_socket',
+                        help='listen on this Unix socket instead of TCP',
+                        default=None, type=str)
+    parser.add_argument('--gpus', dest='gpu_ids', help='GPU ids to use',
+                        default=[0], type=int, nargs='+')
+    parser.add_argument('--cpu', dest='cpu_mode', help='use CPU mode',
+                        action='store_true')
+    parser.add_argument('--workers', dest='num_workers',
+                        help='number of worker processes (default: one per GPU)',
+                        default=0, type=int)
+    parser.add_argument('--batch', dest='max_batch',
+                        help='maximum number of images per forward pass',
+                        default=4, type=int)
+    parser.add_argument('--max_wait', dest='max_wait',
+                        help='maximum time (ms) to wait for a batch to fill',
+                        default=10, type=float)
+    parser.add_argument('--timeout', dest='timeout',
+                        help='request timeout in seconds',
+                        default=60, type=float)
+    parser.add_argument('--init_timeout', dest='init_timeout',
+                        help='time (s) the workers have to load their nets',
+                        default=600, type=float)
+    parser.add_argument('--model', dest='model', help='PVANet model',
+                        default='voc12', choices=['voc07', 'voc12', 'comp'])
+    parser.add_argument('--presets', dest='presets',
+                        help='compute presets to serve (the first is the default)',
+                        default=['base'], choices=['fast', 'base', 'full'],
+                        nargs='+')
+    parser.add_argument('--shorter', dest='shorter',
+                        help='shorter side of the resized input images',
+                        default=608, type=int)
+    args = parser.parse_args()
+    return args
+
+MODELS = {'voc07': PVANet.MODEL_VOC07, 'voc12': PVANet.MODEL_VOC12,
+          'comp': PVANet.MODEL_COMP}
+PRESETS = {'fast': PVANet.COMPUTE_FAST, 'base': PVANet.COMPUTE_BASE,
+           'full': PVANet.COMPUTE_FULL}
+
+def _detect_batch(pvanets, batch):
+    """Decode and detect a batch of (request id, preset, encoded image).
+
+    Returns a list of (request id, detections, error) results.
+    """
+    results = []
+    by_preset = {}
+    for req_id, preset, data in batch:
+        im = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                          cv2.IMREAD_COLOR)
+        if im is None:
+            results.append((req_id, None, 'could not decode image'))
+        else:
+            by_preset.setdefault(preset, []).append((req_id, im))
+    for preset, requests in by_preset.iteritems():
+        req_ids, ims = zip(*requests)
+        results.extend(_detect_ims(pvanets[preset], req_ids, ims))
+    return results
+
+def _detect_ims(pvanet, req_ids, ims):
+    """Detect decoded images with a single forward pass."""
+    try:
+        if len(ims) == 1:
+            all_dets = [pvanet.process_img(ims[0])]
+        else:
+            all_dets = pvanet.process_imgs(list(ims))
+    except Exception as e:
+        return [(req_id, None, str(e)) for req_id in req_ids]
+    return [(req_id, dets.astype(np.float32), None)
+            for req_id, dets in zip(req_ids, all_dets)]
+
+def _worker(worker_id, model, shorter, gpu_id, presets, task_queue,
+            result_queue):
+    """Worker process: hold a warmed up net and detect batches of images."""
+    try:
+        pvanets = {}
+        net = None
+        for name, preset in presets:
+            pvanets[name] = PVANet(model, shorter=shorter, gpu_id=gpu_id,
+                                   preset=preset, net=net)
+            net = pvanets[name].net
+    except Exception:
+        # the server fails to start with this error
+        result_queue.put((None, worker_id, traceback.format_exc()))
+        return
+    # tell the server this worker is ready
+    result_queue.put((None, worker_id, None))
+    while True:
+        batch = task_queue.get()
+        if batch is None:
+            break
+        for result in _detect_batch(pvanets, batch):
+            result_queue.put(result)
+
+class DetectionService(object):
+    """Queue, micro-batch and dispatch detection requests to workers."""
+
+    def __init__(self, model, shorter, gpu_ids, presets, num_workers,
+                 max_batch=4, max_wait=0.01, init_timeout=600):
+        # presets is a list of (name, preset) pairs; the first is the default
+        self._presets = [name for name, _ in presets]
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._requests = Queue.Queue()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count()
+        self._task_queue = multiprocessing.Queue()
+        self._result_queue = multiprocessing.Queue()
+        self._stats = {'requests': 0, 'errors': 0, 'batches': 0, 'images': 0,
+                       'latency': 0.0}
+        self._stats_lock = threading.Lock()
+
+        self._workers = []
+        for i in xrange(num_workers):
+            gpu_id = None if gpu_ids is None else gpu_ids[i % len(gpu_ids)]
+            p = multiprocessing.Process(
+                target=_worker,
+                args=(i, model, shorter, gpu_id, presets,
+                      self._task_queue, self._result_queue))
+            p.daemon = True
+            p.start()
+            self._workers.append(p)
+
+        try:
+            self._wait_for_workers(init_timeout)
+        except:
+            for p in self._workers:
+                p.terminate()
+            raise
+
+        for target in (self._batch_requests, self._collect_results):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def _wait_for_workers(self, timeout):
+        """Wait until all workers have loaded their nets.
+
+        Raises RuntimeError if a worker fails to load its net or dies, or if
+        they are not all ready within timeout seconds.
+        """
+        ready = set()
+        deadline = time.time() + timeout
+        while len(ready) < len(self._workers):
+            # a worker flushes its messages before it exits, so one found
+            # dead here has nothing left to receive after an empty get
+            dead = [i for i, p in enumerate(self._workers)
+                    if i not in ready and not p.is_alive()]
+            try:
+                _, worker_id, error = self._result_queue.get(timeout=1.0)
+            except Queue.Empty:
+                if dead:
+                    raise RuntimeError(
+                        'Worker {:d} died during startup (exit code {})'
+                        .format(dead[0], self._workers[dead[0]].exitcode))
+                if time.time() > deadline:
+                    raise RuntimeError(
+                        '{:d} of {:d} workers not ready after {:.0f}s'.format(
+                            len(self._workers) - len(ready),
+                            len(self._workers), timeout))
+                continue
+            if error is not None:
+                raise RuntimeError('Worker {:d} failed to start:\n{}'
+                                   .format(worker_id, error))
+            ready.add(worker_id)
+            print 'Worker {:d} ready'.format(worker_id)
+
+    def _batch_requests(self):
+        """Group queued requests into batches of up to max_batch images."""
+        while True:
+            batch = [self._requests.get()]
+            deadline = time.time() + self._max_wait
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            self._count(batches=1, images=len(batch))
+            self._task_queue.put(batch)
+
+    def _collect_results(self):
+        """Hand the results of the workers back to the waiting requests."""
+        while True:
+            req_id, dets, error = self._result_queue.get()
+            with self._pending_lock:
+                request = self._pending.pop(req_id, None)
+            # the request may have timed out already
+            if request is not None:
+                request['dets'] = dets
+                request['error'] = error
+                request['done'].set()
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for key, value in counts.iteritems():
+                self._stats[key] += value
+
+    def detect(self, data, preset=None, timeout=None):
+        """Detect objects in an encoded image using the named preset.
+
+        Returns the N x 6 float32 array of (cls, x1, y1, x2, y2, score)
+        detections. Raises ValueError if the image cannot be processed and
+        RuntimeError on timeout.
+        """
+        if preset is None:
+            preset = self._presets[0]
+        elif preset not in self._presets:
+            raise ValueError('unknown preset {}'.format(preset))
+        req_id = next(self._ids)
+        request = {'done': threading.Event(), 'dets': None, 'error': None}
+        with self._pending_lock:
+            self._pending[req_id] = request
+        start = time.time()
+        self._requests.put((req_id, preset, data))
+
+        if not request['done'].wait(timeout):
+            with self._pending_lock:
+                self._pending.pop(req_id, None)
+            self._count(requests=1, errors=1)
+            raise RuntimeError('detection timed out')
+        if request['error'] is not None:
+            self._count(requests=1, errors=1)
+            raise ValueError(request['error'])
+        self._count(requests=1, latency=time.time() - start)
+        return request['dets']
+
+    def stats(self):
+        """Return request, batch and latency counters."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._requests.qsize()
+        stats['avg_batch'] = stats['images'] / float(max(stats['batches'], 1))
+        served = stats['requests'] - stats['errors']
+        stats['avg_latency'] = stats.pop('latency') / float(max(served, 1))
+        return stats
+
+    def close(self):
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for p in self._workers:
+            p.join()
+
+class DetectionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """POST /detect with an encoded image; GET /stats for server counters."""
+
+    def _reply(self, code, body, content_type='application/json',
+               headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_json(self, code, obj):
+        self._reply(code, json.dumps(obj))
+
+    def do_GET(self):
+        if urlparse.urlparse(self.path).path == '/stats':
+            self._reply_json(200, self.server.service.stats())
+        else:
+            self._reply_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/detect':
+            self._reply_json(404, {'error': 'not found'})
+            return
+        length = int(self.headers.getheader('Content-Length', 0))
+        if length <= 0:
+            self._reply_json(400, {'error': 'empty request'})
+            return
+        data = self.rfile.read(length)
+        query = urlparse.parse_qs(url.query)
+
+        try:
+            dets = self.server.service.detect(data, query.get('preset', [None])[0],
+                                              self.server.request_timeout)
+        except ValueError as e:
+            self._reply_json(400, {'error': str(e)})
+            return
+        except RuntimeError as e:
+            self._reply_json(503, {'error': str(e)})
+            return
+
+        binary = (query.get('format') == ['binary'] or
+                  'application/octet-stream' in
+                  self.headers.getheader('Accept', ''))
+        if binary:
+            self._reply(200, dets.astype('<f4').tostring(),
+                        content_type='application/octet-stream',
+                        headers={'X-Detections': str(dets.shape[0])})
+        else:
+            self._reply_json(200, {'detections': dets.tolist()})
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn,
+                              SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Unix socket clients have no address, but the request handler logs
+        # client_address[0]
+        request, _ = self.socket.accept()
+        return request, (self.server_address, 0)
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    if args.cpu_mode:
+        gpu_ids = None
+        num_workers = max(args.num_workers, 1)
+    else:
+        gpu_ids = args.gpu_ids
+        num_workers = args.num_workers or len(gpu_ids)
+
+    presets = [(name, PRESETS[name]) for name in args.presets]
+    service = DetectionService(MODELS[args.model], args.shorter, gpu_ids,
+                               presets, num_workers,
+                               max_batch=args.max_batch,
+                               max_wait=args.max_wait / 1000.0,
+                               init_timeout=args.init_timeout)
+
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, DetectionHandler)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), DetectionHandler)
+    server.service = service
+    server.request_timeout = args.timeout
+
+    print 'Serving on {}'.format(args.unix_socket or
+                                 '{}:{:d}'.format(args.host, args.port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
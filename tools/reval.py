@@ -12,6 +12,7 @@
 import _init_paths
 from fast_rcnn.test import apply_nms
 from fast_rcnn.config import cfg
+from fast_rcnn.detection_store import DETECTIONS_DIR, DetectionStore
 from datasets.factory import get_imdb
 import cPickle
 import os, sys, argparse
@@ -46,8 +47,13 @@ def from_dets(imdb_name, output_dir, args):
     imdb = get_imdb(imdb_name)
     imdb.competition_mode(args.comp_mode)
     imdb.config['matlab_eval'] = args.matlab_eval
-    with open(os.path.join(output_dir, 'detections.pkl'), 'rb') as f:
-        dets = cPickle.load(f)
+    store_path = os.path.join(output_dir, DETECTIONS_DIR)
+    if os.path.isdir(store_path):
+        dets = DetectionStore(store_path)
+    else:
+        # detections saved by older versions of test_net
+        with open(os.path.join(output_dir, 'detections.pkl'), 'rb') as f:
+            dets = cPickle.load(f)
 
     if args.apply_nms:
         print 'Applying NMS to all detections'
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Sweep the post-processing options over the cached outputs of test_net.
+
+Re-runs only the post-processing (NMS, box voting, score threshold and
+detections per image) on the raw outputs test_net saved with
+TEST.CACHE_RAW_OUTPUTS, for every combination of the given options, and
+reports the mAP and post-processing time per image of each. Combinations
+are evaluated in parallel, in memory, so the image database needs an
+in-memory evaluator (e.g. PASCAL VOC). The time is measured in the worker
+processes, so use at most one worker per core for comparable timings. NMS
+runs on the CPU, as in the test_net_parallel workers.
+Settings on the mAP / time frontier are marked with a *.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list, freeze_cfg
+from fast_rcnn.detection_store import RAW_OUTPUTS_DIR, RawOutputStore
+from fast_rcnn.test import postprocess_detections
+from fast_rcnn.nms_wrapper import prepare_nms
+from datasets.factory import get_imdb
+from utils.timer import Timer
+import argparse
+import copy
+import cPickle
+import itertools
+import multiprocessing
+import os
+import pprint
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Sweep post-processing options over cached outputs')
+    parser.add_argument('output_dir', nargs=1, help='results directory',
+                        type=str)
+    parser.add_argument('--imdb', dest='imdb_name',
+                        help='dataset the outputs are of',
+                        default='voc_2007_test', type=str)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+    parser.add_argument('--nms', dest='nms', help='TEST.NMS values',
+                        default=None, type=float, nargs='+')
+    parser.add_argument('--vote', dest='vote',
+                        help='TEST.BBOX_VOTE values (0 or 1)',
+                        default=None, type=int, nargs='+')
+    parser.add_argument('--vote_n', dest='vote_n',
+                        help='TEST.BBOX_VOTE_N_WEIGHTED_SCORE values',
+                        default=None, type=int, nargs='+')
+    parser.add_argument('--vote_empty', dest='vote_empty',
+                        help='TEST.BBOX_VOTE_WEIGHT_EMPTY values',
+                        default=None, type=float, nargs='+')
+    parser.add_argument('--thresh', dest='thresh', help='score thresholds',
+                        default=[0.01], type=float, nargs='+')
+    parser.add_argument('--num_dets', dest='max_per_image',
+                        help='max numbers of detections per image',
+                        default=[100], type=int, nargs='+')
+    parser.add_argument('--workers', dest='num_workers',
+                        help='number of worker processes (0: all cores)',
+                        default=0, type=int)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+def _grid(args):
+    """The settings to evaluate, without the ones that only differ in
+    options that are unused (e.g. the voting options without voting)."""
+    nms = args.nms or [cfg.TEST.NMS]
+    vote = [bool(v) for v in args.vote] if args.vote is not None \
+        else [cfg.TEST.BBOX_VOTE]
+    vote_n = args.vote_n or [cfg.TEST.BBOX_VOTE_N_WEIGHTED_SCORE]
+    vote_empty = args.vote_empty or [cfg.TEST.BBOX_VOTE_WEIGHT_EMPTY]
+    points = []
+    for point in itertools.product(nms, vote, vote_n, vote_empty,
+                                   args.thresh, args.max_per_image):
+        nms_thresh, v, n, w, thresh, max_per_image = point
+        if not v or cfg.TEST.NMS_METHOD == 'weighted':
+            n = vote_n[0]
+        if not v or n <= 1:
+            w = vote_empty[0]
+        point = (nms_thresh, v, n, w, thresh, max_per_image)
+        if point not in points:
+            points.append(point)
+    return points
+
+# State the forked workers inherit
+_sweep = {}
+
+def _eval_point(point):
+    """mAP and post-processing time per image of one setting."""
+    nms_thresh, vote, vote_n, vote_empty, thresh, max_per_image = point
+    config = freeze_cfg({'TEST': {'NMS': nms_thresh,
+                                  'BBOX_VOTE': vote,
+                                  'BBOX_VOTE_N_WEIGHTED_SCORE': vote_n,
+                                  'BBOX_VOTE_WEIGHT_EMPTY': vote_empty}})
+    store = _sweep['store']
+    evaluator = copy.deepcopy(_sweep['evaluator'])
+    # warm up, so that the first image does not pay for the lazy setup of
+    # the worker
+    if store.num_images > 0:
+        scores, boxes = store[0]
+        postprocess_detections(scores, boxes, store.num_classes,
+                               max_per_image, thresh, config)
+    timer = Timer()
+    for i, (scores, boxes) in enumerate(store):
+        timer.tic()
+        cls_dets = postprocess_detections(scores, boxes, store.num_classes,
+                                          max_per_image, thresh, config)
+        timer.toc()
+        evaluator.add_image(i, cls_dets)
+    return evaluator.mean_ap(), timer.average_time
+
+def _frontier(results):
+    """Whether each (mAP, time) is not beaten by another on both."""
+    return [not any(ap2 >= ap and t2 <= t and (ap2, t2) != (ap, t)
+                    for ap2, t2 in results)
+            for ap, t in results]
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    print 'Using config:'
+    pprint.pprint(cfg)
+
+    output_dir = os.path.abspath(args.output_dir[0])
+    store = RawOutputStore(os.path.join(output_dir, RAW_OUTPUTS_DIR))
+    imdb = get_imdb(args.imdb_name)
+    assert store.num_images == len(imdb.image_index) and \
+        store.num_classes == imdb.num_classes, \
+        'The raw outputs are not of {}'.format(imdb.name)
+    evaluator = imdb.get_evaluator()
+    if evaluator is None:
+        print 'No in-memory evaluation for {}'.format(imdb.name)
+        sys.exit(1)
+    _sweep['store'] = store
+    _sweep['evaluator'] = evaluator
+    # the forked workers must not initialize CUDA inside their timings
+    cfg.USE_GPU_NMS = False
+    prepare_nms()
+
+    points = _grid(args)
+    num_workers = min(args.num_workers or multiprocessing.cpu_count(),
+                      len(points))
+    print 'Evaluating {:d} settings on {:d} images with {:d} workers'.format(
+        len(points), store.num_images, num_workers)
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            results = pool.map(_eval_point, points, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_eval_point, points)
+
+    sweep_file = os.path.join(output_dir, 'sweep_postproc.pkl')
+    with open(sweep_file, 'wb') as f:
+        cPickle.dump({'settings': points, 'results': results}, f,
+                     cPickle.HIGHEST_PROTOCOL)
+    print 'Wrote results to {}'.format(sweep_file)
+
+    print '{:>6s} {:>5s} {:>7s} {:>10s} {:>7s} {:>5s} {:>7s} {:>11s}'.format(
+        'nms', 'vote', 'vote_n', 'vote_empty', 'thresh', 'dets', 'mAP',
+        'postproc')
+    for point, (ap, t), best in zip(points, results, _frontier(results)):
+        nms_thresh, vote, vote_n, vote_empty, thresh, max_per_image = point
+        print '{:6.3f} {:>5s} {:7d} {:10.3f} {:7.4f} {:5d} {:7.4f} ' \
+              '{:9.4f}s{}'.format(nms_thresh, str(vote), vote_n, vote_empty,
+                                  thresh, max_per_image, ap, t,
+                                  ' *' if best else '')
@@ -10,7 +10,7 @@
 """Test a Fast R-CNN network on an image database."""
 
 import _init_paths
-from fast_rcnn.test import test_net
+from fast_rcnn.test import test_net, test_net_parallel, test_net_pipelined
 from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
 from datasets.factory import get_imdb
 import caffe
@@ -49,6 +49,18 @@ def parse_args():
     parser.add_argument('--num_dets', dest='max_per_image',
                         help='max number of detections per image',
                         default=100, type=int)
+    parser.add_argument('--workers', dest='num_workers',
+                        help='test on the CPU with this many worker processes '
+                             '(0: single process on --gpu)',
+                        default=0, type=int)
+    parser.add_argument('--prefetch', dest='prefetch',
+                        help='overlap image loading, forward and '
+                             'post-processing with queues of this size '
+                             '(0: sequential)',
+                        default=0, type=int)
+    parser.add_argument('--readers', dest='num_readers',
+                        help='number of image reader threads for --prefetch',
+                        default=2, type=int)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -77,14 +89,29 @@ if __name__ == '__main__':
         print('Waiting for {} to exist...'.format(args.caffemodel))
         time.sleep(10)
 
-    caffe.set_mode_gpu()
-    caffe.set_device(args.gpu_id)
-    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
-    net.name = os.path.splitext(os.path.basename(args.caffemodel))[0]
-
     imdb = get_imdb(args.imdb_name)
     imdb.competition_mode(args.comp_mode)
     if not cfg.TEST.HAS_RPN:
         imdb.set_proposal_method(cfg.TEST.PROPOSAL_METHOD)
 
-    test_net(net, imdb, max_per_image=args.max_per_image, vis=args.vis)
+    net_name = os.path.splitext(os.path.basename(args.caffemodel))[0]
+    if args.num_workers > 0:
+        # every worker process loads its own CPU net
+        test_net_parallel(args.prototxt, args.caffemodel, net_name, imdb,
+                          args.num_workers, max_per_image=args.max_per_image)
+        sys.exit(0)
+
+    caffe.set_mode_gpu()
+    caffe.set_device(args.gpu_id)
+    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
+    net.name = net_name
+    # identify the net in the checkpoints of test_net
+    net.prototxt = args.prototxt
+    net.caffemodel = args.caffemodel
+
+    if args.prefetch > 0:
+        test_net_pipelined(net, imdb, max_per_image=args.max_per_image,
+                           num_readers=args.num_readers,
+                           queue_size=args.prefetch)
+    else:
+        test_net(net, imdb, max_per_image=args.max_per_image, vis=args.vis)
@@ -5,9 +5,10 @@ Wrapper function for PVANet
 """
 
 import _init_paths
-from fast_rcnn.config import cfg, cfg_from_file
-from fast_rcnn.test import im_detect, bbox_vote
-from fast_rcnn.nms_wrapper import nms
+from fast_rcnn.config import cfg, cfg_from_file, freeze_cfg
+from fast_rcnn.test import im_detect, im_detect_batch, get_vote_func
+from fast_rcnn.nms_wrapper import get_nms_func
+from nms.batched_nms import batched_nms
 import caffe, os, cv2
 from utils.timer import Timer
 import numpy as np
@@ -26,21 +27,30 @@ class PVANet:
     COMPUTE_FULL = {'bbox_vote': True, 'bbox_vote_n': 5, 'rpn_nms': 18000, 'proposals': 300}
     N_CLASSES = 20
     _net = None
+    _cfg = None
     _im = None
     _thresh = 0.003
 
-    def __init__(self, model=MODEL_VOC12, shorter=608, gpu_id=0, preset=COMPUTE_BASE):
-        # Load cfg
-        cfg.TEST.HAS_RPN = True
-        cfg.TEST.SCALE_MULTIPLE_OF = 32
-        cfg.TEST.MAX_SIZE = 2000
-        cfg.TEST.SCALES = [shorter]
-        cfg.TEST.BBOX_VOTE = preset['bbox_vote']
-        cfg.TEST.BBOX_VOTE_N_WEIGHTED_SCORE = preset['bbox_vote_n']
-        cfg.TEST.BBOX_VOTE_WEIGHT_EMPTY = 0.3
-        cfg.TEST.NMS = 0.4
-        cfg.TEST.RPN_PRE_NMS_TOP_N = preset['rpn_nms']
-        cfg.TEST.RPN_POST_NMS_TOP_N = preset['proposals']
+    def __init__(self, model=MODEL_VOC12, shorter=608, gpu_id=0, preset=COMPUTE_BASE,
+                 net=None):
+        # Per-detector cfg (the global cfg is left untouched), so detectors
+        # with different presets can live in one process
+        self._cfg = freeze_cfg({'TEST': {
+            'HAS_RPN': True,
+            'SCALE_MULTIPLE_OF': 32,
+            'MAX_SIZE': 2000,
+            'SCALES': (shorter,),
+            'BBOX_VOTE': preset['bbox_vote'],
+            'BBOX_VOTE_N_WEIGHTED_SCORE': preset['bbox_vote_n'],
+            'BBOX_VOTE_WEIGHT_EMPTY': 0.3,
+            'NMS': 0.4,
+            'RPN_PRE_NMS_TOP_N': preset['rpn_nms'],
+            'RPN_POST_NMS_TOP_N': preset['proposals']}})
+
+        # Share an already loaded net (e.g. of another preset)
+        if net is not None:
+            self._net = net
+            return
 
         # Load model & pt
         pvanet_dir = os.path.abspath(os.path.join(cfg.ROOT_DIR, 'models', 'pvanet', 'pva9.1'))
@@ -64,10 +74,14 @@ class PVANet:
         # Warmup on a dummy image
         im = 128 * np.ones((300, 500, 3), dtype=np.uint8)
         for i in xrange(2):
-            _, _ = im_detect(net, im)
+            _, _ = im_detect(net, im, config=self._cfg)
 
         self._net = net
 
+    @property
+    def net(self):
+        return self._net
+
     def read_img(self, filepath):
         self._im = cv2.imread(filepath)
         return self._im
@@ -76,33 +90,31 @@ class PVANet:
         if im is None:
             im = self._im
 
-        scores, boxes = im_detect(self._net, im)
+        scores, boxes = im_detect(self._net, im, config=self._cfg)
+        return self._detections(scores, boxes)
+
+    def process_imgs(self, ims):
+        """Detect objects in a list of images with a single forward pass.
+
+        Returns one N x 6 array of detections per image, as process_img.
+        """
+        scores_list, boxes_list = im_detect_batch(self._net, ims,
+                                                  config=self._cfg)
+        return [self._detections(scores, boxes)
+                for scores, boxes in zip(scores_list, boxes_list)]
 
+    def _detections(self, scores, boxes):
         # all detections are collected into:
-        #    all_boxes[cls] = N x 5 array of detections in
-        #    (i, x1, y1, x2, y2, score)
-        all_boxes = np.zeros((0, 6))
-
-        # skip j = 0, because it's the background class
-        for j in xrange(1, PVANet.N_CLASSES):
-            inds = np.where(scores[:, j] > self._thresh)[0]
-            cls_scores = scores[inds, j]
-            cls_boxes = boxes[inds, j * 4:(j + 1) * 4]
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-
-            keep = nms(cls_dets, cfg.TEST.NMS)
-
-            dets_NMSed = cls_dets[keep, :]
-            if cfg.TEST.BBOX_VOTE:
-                cls_dets = bbox_vote(dets_NMSed, cls_dets)
-            else:
-                cls_dets = dets_NMSed
-
-            if len(cls_dets) > 0:
-                all_boxes = np.vstack((all_boxes,
-                                      np.hstack((np.ones((cls_dets.shape[0], 1)) * j,cls_dets))
-                                       ))
+        #    all_boxes = N x 6 array of detections in
+        #    (cls, x1, y1, x2, y2, score)
+        config = self._cfg
+        dets, labels = batched_nms(scores, boxes, self._thresh, config.TEST.NMS,
+                                   nms_func=get_nms_func(config),
+                                   vote_func=get_vote_func(config))
+
+        # group detections by class
+        order = np.argsort(labels, kind='mergesort')
+        all_boxes = np.hstack((labels[order, np.newaxis], dets[order, :]))
 
         return all_boxes
 